@@ -0,0 +1,7 @@
+"""
+Performance benchmarks for tigger computations.
+
+Run ``python -m benchmark --help`` from the project root for the list of commands.
+Results are stored in a JSON file keyed by the device and the commit,
+so that the results for the current tree can be compared against a baseline.
+"""
@@ -0,0 +1,154 @@
+"""
+Command line interface for the benchmarks.
+
+Examples::
+
+    # Run quick benchmarks on all OpenCL devices whose name contains "pthread" (pocl)
+    # and store the results for the current commit
+    python -m benchmark run --api ocl --device pthread --quick
+
+    # Measure only the preparation time, with the breakdown by phases
+    python -m benchmark prepare --filter FFT
+
+    # Measure the import time of the library modules
+    python -m benchmark imports
+
+    # Measure the kernel launch overhead
+    python -m benchmark launch --attempts 1000
+
+    # Compare the stored results for the current commit with the ones for the given commit
+    python -m benchmark compare --baseline 1a2b3c4 --threshold time=0.05
+
+    # Run and compare right away (the exit code is 1 if there are regressions)
+    python -m benchmark run --baseline 1a2b3c4
+"""
+
+from __future__ import print_function
+
+import argparse
+import re
+import sys
+
+import numpy
+
+import tigger.cluda as cluda
+
+from benchmark.cases import get_cases
+from benchmark.runner import run
+from benchmark import storage
+from benchmark import imports
+from benchmark import launch
+
+
+def get_contexts(api_ids, device_mask):
+    for api_id in api_ids:
+        api = cluda.api(api_id)
+        for platform in api.get_platforms():
+            for device in platform.get_devices():
+                ctx = api.Context.create(device=device)
+                if device_mask is None or re.search(device_mask, ctx.device_params.name):
+                    yield ctx
+                else:
+                    ctx.release()
+
+
+def parse_thresholds(thresholds):
+    result = dict(storage.THRESHOLDS)
+    for threshold in thresholds:
+        name, value = threshold.split('=')
+        result[name] = float(value)
+    return result
+
+
+def report_regressions(path, device, results, baseline_commit, thresholds):
+    """
+    Prints regressions compared to the baseline commit and returns ``True`` if there are any.
+    """
+    if baseline_commit is None:
+        return False
+
+    baseline = storage.load(path).get(device, {}).get(baseline_commit)
+    if baseline is None:
+        print("  No results for the baseline commit " + baseline_commit)
+        return False
+
+    regressions = storage.compare(results, baseline, thresholds=thresholds)
+    for case_id, name, old, new in regressions:
+        print("  REGRESSION " + case_id + ": " + name +
+            " {old:.4g} -> {new:.4g}".format(old=old, new=new))
+    return len(regressions) > 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmark")
+    parser.add_argument('command', choices=['run', 'prepare', 'imports', 'launch', 'compare'],
+        help="'run' measures preparation and execution, "
+            "'prepare' measures only the preparation with the breakdown by phases, "
+            "'imports' measures the import time of the library modules, "
+            "'launch' measures the kernel launch overhead, "
+            "'compare' compares stored results")
+    parser.add_argument('--api', choices=cluda.APIS, action='append',
+        help="API to use (can be given several times, all supported APIs by default)")
+    parser.add_argument('--device', help="regular expression to match device names against")
+    parser.add_argument('--quick', action='store_true',
+        help="use smaller problem sizes (suitable for CPU devices)")
+    parser.add_argument('--doubles', action='store_true',
+        help="include double precision cases")
+    parser.add_argument('--filter', help="regular expression to match case identifiers against")
+    parser.add_argument('--attempts', type=int, default=10,
+        help="number of calls to average the execution time over")
+    parser.add_argument('--results', default='benchmark_results.json',
+        help="file to store results in")
+    parser.add_argument('--commit', help="commit to store results for (current one by default)")
+    parser.add_argument('--baseline', help="commit to compare with (required for 'compare')")
+    parser.add_argument('--threshold', action='append', default=[],
+        help="relative regression threshold in the form name=value, "
+            "where name is one of " + ", ".join(sorted(storage.THRESHOLDS)) +
+            ", gflops, gbps, or prepare_<phase>")
+    args = parser.parse_args(argv)
+
+    api_ids = args.api if args.api is not None else cluda.supported_apis()
+    commit = args.commit if args.commit is not None else storage.current_commit()
+    thresholds = parse_thresholds(args.threshold)
+
+    if args.command == 'compare' and args.baseline is None:
+        parser.error("--baseline is required for 'compare'")
+
+    if args.command == 'imports':
+        device = storage.host_key()
+        print("Host " + device + ", commit " + commit)
+        results = imports.run(attempts=args.attempts, log=lambda s: print("  " + s))
+        storage.save(args.results, device, commit, results)
+        return 1 if report_regressions(args.results, device, results, args.baseline, thresholds) \
+            else 0
+
+    regressions_found = False
+    for ctx in get_contexts(api_ids, args.device):
+        device = storage.device_key(ctx)
+        print("Device " + device + ", commit " + commit)
+
+        if args.command in ('run', 'prepare'):
+            cases = get_cases(quick=args.quick,
+                doubles=args.doubles and ctx.supports_dtype(numpy.float64))
+            if args.filter is not None:
+                cases = [case for case in cases if re.search(args.filter, case.id)]
+
+            results = run(ctx, cases, attempts=args.attempts, log=lambda s: print("  " + s),
+                prepare_only=(args.command == 'prepare'))
+            storage.save(args.results, device, commit, results)
+        elif args.command == 'launch':
+            results = launch.run(ctx, attempts=args.attempts, log=lambda s: print("  " + s))
+            storage.save(args.results, device, commit, results)
+        else:
+            results = storage.load(args.results).get(device, {}).get(commit, {})
+
+        if report_regressions(args.results, device, results, args.baseline, thresholds):
+            regressions_found = True
+
+        ctx.release()
+
+    return 1 if regressions_found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+"""
+Benchmark cases for the computations.
+
+Every case is a :py:class:`Case` object which, given a context, creates the arrays,
+prepares the computation and returns it along with the call arguments.
+"""
+
+import numpy
+
+import tigger.cluda.dtypes as dtypes
+from tigger.helpers import product
+from tigger.elementwise import specialize_elementwise
+from tigger.reduce import Reduce
+from tigger.transpose import Transpose
+from tigger.matrixmul import MatrixMul
+from tigger.fft import FFT
+
+
+class Case:
+    """
+    A single benchmark case.
+
+    :param computation: name of the computation (used in the case identifier).
+    :param params: dictionary of case parameters (used in the case identifier).
+    :param dtype: data type of the arrays.
+    :param flops: number of floating point operations per call.
+    :param bytes_moved: number of bytes read and written in the global memory per call.
+    :param prepare: function taking a context and returning a tuple
+        ``(computation, args)``, where ``computation`` is the prepared computation
+        and ``args`` is a list of arguments to call it with.
+    """
+
+    def __init__(self, computation, params, dtype, flops, bytes_moved, prepare):
+        self.computation = computation
+        self.params = params
+        self.dtype = dtypes.normalize_type(dtype)
+        self.flops = flops
+        self.bytes_moved = bytes_moved
+        self.prepare = prepare
+
+    @property
+    def id(self):
+        params = ",".join(key + "=" + str(self.params[key]) for key in sorted(self.params))
+        return self.computation + "[" + str(self.dtype) + "," + params + "]"
+
+
+def random_array(shape, dtype):
+    dtype = numpy.dtype(dtype)
+    if dtypes.is_complex(dtype):
+        return (numpy.random.rand(*shape) + 1j * numpy.random.rand(*shape)).astype(dtype)
+    else:
+        return numpy.random.rand(*shape).astype(dtype)
+
+
+def elementwise_cases(sizes, dtypes_list):
+    code = dict(kernel="""
+        ${output.store}(idx, ${func.mul(input.dtype, param.dtype, out=output.dtype)}(
+            ${input.load}(idx), ${param}));
+        """)
+
+    for dtype in dtypes_list:
+        for size in sizes:
+            def prepare(ctx, size=size, dtype=dtype):
+                input = ctx.to_device(random_array((size,), dtype))
+                output = ctx.empty_like(input)
+                param = numpy.dtype(dtype).type(2)
+                comp = specialize_elementwise('output', 'input', 'param', code)(ctx)
+                return comp.prepare_for(output, input, param), [output, input, param]
+
+            itemsize = numpy.dtype(dtype).itemsize
+            yield Case('Elementwise', dict(size=size), dtype,
+                size, size * itemsize * 2, prepare)
+
+
+def reduce_cases(sizes, dtypes_list):
+    for dtype in dtypes_list:
+        for size in sizes:
+            def prepare(ctx, size=size, dtype=dtype):
+                input = ctx.to_device(random_array((size,), dtype))
+                output = ctx.allocate((1,), dtype)
+                comp = Reduce(ctx).prepare_for(output, input)
+                return comp, [output, input]
+
+            itemsize = numpy.dtype(dtype).itemsize
+            yield Case('Reduce', dict(size=size), dtype,
+                size, size * itemsize, prepare)
+
+
+def transpose_cases(sizes, dtypes_list):
+    for dtype in dtypes_list:
+        for size in sizes:
+            def prepare(ctx, size=size, dtype=dtype):
+                input = ctx.to_device(random_array((size, size), dtype))
+                output = ctx.empty_like(input)
+                comp = Transpose(ctx).prepare_for(output, input)
+                return comp, [output, input]
+
+            itemsize = numpy.dtype(dtype).itemsize
+            yield Case('Transpose', dict(size=size), dtype,
+                0, size ** 2 * itemsize * 2, prepare)
+
+
+def matrixmul_cases(sizes, dtypes_list):
+    for dtype in dtypes_list:
+        for size in sizes:
+            def prepare(ctx, size=size, dtype=dtype):
+                a = ctx.to_device(random_array((size, size), dtype))
+                b = ctx.to_device(random_array((size, size), dtype))
+                output = ctx.empty_like(a)
+                comp = MatrixMul(ctx).prepare_for(output, a, b)
+                return comp, [output, a, b]
+
+            itemsize = numpy.dtype(dtype).itemsize
+            yield Case('MatrixMul', dict(size=size), dtype,
+                size ** 3 * 2, size ** 2 * itemsize * 3, prepare)
+
+
+def fft_cases(shapes, dtypes_list):
+    for dtype in dtypes_list:
+        for shape in shapes:
+            def prepare(ctx, shape=shape, dtype=dtype):
+                input = ctx.to_device(random_array(shape, dtype))
+                output = ctx.empty_like(input)
+                comp = FFT(ctx).prepare_for(output, input, None)
+                return comp, [output, input, -1]
+
+            itemsize = numpy.dtype(dtype).itemsize
+            size = product(shape)
+            yield Case('FFT', dict(shape="x".join(str(l) for l in shape)), dtype,
+                5 * size * numpy.log2(size), size * itemsize * 2, prepare)
+
+
+def get_cases(quick=False, doubles=False):
+    """
+    Returns a list of :py:class:`Case` objects.
+    If ``quick`` is ``True``, the sizes are reduced
+    (useful for CPU devices, for example, the ones provided by pocl).
+    """
+    real_dtypes = [numpy.float32] + ([numpy.float64] if doubles else [])
+    complex_dtypes = [numpy.complex64] + ([numpy.complex128] if doubles else [])
+
+    if quick:
+        vector_sizes = [2 ** 16, 2 ** 20]
+        matrix_sizes = [128, 256]
+        fft_shapes = [(64, 64), (4, 1024)]
+    else:
+        vector_sizes = [2 ** 16, 2 ** 20, 2 ** 24]
+        matrix_sizes = [256, 512, 1024]
+        fft_shapes = [(512, 512), (16, 16384), (64, 64, 64)]
+
+    cases = []
+    cases += list(elementwise_cases(vector_sizes, real_dtypes))
+    cases += list(reduce_cases(vector_sizes, real_dtypes))
+    cases += list(transpose_cases(matrix_sizes, real_dtypes))
+    cases += list(matrixmul_cases(matrix_sizes, real_dtypes))
+    cases += list(fft_cases(fft_shapes, complex_dtypes))
+    return cases
@@ -0,0 +1,60 @@
+"""
+Import time benchmarks.
+
+Every module is imported in a fresh interpreter.
+The time is measured after numpy is imported, since it is required by the library anyway.
+"""
+
+import subprocess
+import sys
+
+
+MODULES = [
+    'tigger.cluda.dtypes',
+    'tigger',
+    'tigger.cluda',
+    'tigger.elementwise',
+    'tigger.reduce',
+    'tigger.transpose',
+    'tigger.matrixmul',
+    'tigger.fft',
+]
+
+SCRIPT = """
+import time
+import numpy
+t1 = time.time()
+{imports}
+print(time.time() - t1)
+"""
+
+
+def import_time(module, attempts=5):
+    """
+    Returns the minimum time (in seconds) of importing ``module`` in a new interpreter.
+    """
+    script = SCRIPT.format(imports="import " + module if module is not None else "")
+    times = []
+    for i in range(attempts):
+        out = subprocess.Popen([sys.executable, '-c', script],
+            stdout=subprocess.PIPE).communicate()[0]
+        times.append(float(out.strip().decode('ascii')))
+    return min(times)
+
+
+def run(modules=None, attempts=5, log=None):
+    """
+    Measures import times for ``modules`` (:py:data:`MODULES` by default)
+    and returns a dictionary ``{case_id: dict(time=seconds)}``.
+    """
+    if modules is None:
+        modules = MODULES
+
+    results = {}
+    for module in modules:
+        case_id = "import[" + module + "]"
+        results[case_id] = dict(time=import_time(module, attempts=attempts))
+        if log is not None:
+            log(case_id + ": {t:.1f} ms".format(t=results[case_id]['time'] * 1e3))
+
+    return results
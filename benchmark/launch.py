@@ -0,0 +1,89 @@
+"""
+Kernel launch overhead benchmarks.
+
+The kernels are trivial, so the measured time is dominated by the host code of a launch.
+For static kernels the time of a launch through the generic call interface of PyOpenCL/PyCUDA
+(setting all the arguments every time) is measured too, for comparison.
+"""
+
+import time
+
+import numpy
+
+from tigger.cluda import API_OCL
+from tigger.elementwise import specialize_elementwise
+
+
+SRC = """
+KERNEL void launch_test(GLOBAL_MEM float *dest, GLOBAL_MEM float *src, float coeff)
+{
+    VIRTUAL_SKIP_THREADS;
+    const int i = virtual_global_flat_id();
+    dest[i] = src[i] * coeff;
+}
+"""
+
+
+def min_launch_time(launch, attempts):
+    """
+    Returns the minimum time (in seconds) spent in the host code of ``launch()``.
+    """
+    # warm-up
+    launch()
+
+    times = []
+    for i in range(attempts):
+        t1 = time.time()
+        launch()
+        times.append(time.time() - t1)
+    return min(times)
+
+
+def generic_launch(ctx, kernel, args):
+    """
+    Returns a function launching the static kernel through the generic call interface.
+    """
+    if ctx.api.API_ID == API_OCL:
+        from tigger.cluda.ocl import _static_kernel_arg
+        args = [_static_kernel_arg(arg) for arg in args]
+        return lambda: kernel._kernel(ctx._queue, kernel._global_size, kernel._local_size, *args)
+    else:
+        return lambda: kernel._kernel(*args,
+            grid=kernel._grid, block=kernel._local_size, stream=ctx._stream)
+
+
+def run(ctx, attempts=1000, log=None):
+    """
+    Measures launch overheads and returns a dictionary ``{case_id: results}``,
+    where ``results`` contain ``call_overhead``
+    (and ``generic_call_overhead`` for the static kernel case).
+    """
+    size = 16
+    src = ctx.to_device(numpy.ones(size, numpy.float32))
+    dest = ctx.allocate(size, numpy.float32)
+    coeff = numpy.float32(2)
+
+    results = {}
+
+    kernel = ctx.compile_static(SRC, 'launch_test', size)
+    args = (dest, src, coeff)
+    results['launch[static_kernel]'] = dict(
+        call_overhead=min_launch_time(lambda: kernel(*args), attempts),
+        generic_call_overhead=min_launch_time(generic_launch(ctx, kernel, args), attempts))
+
+    Multiply = specialize_elementwise('dest', 'src', 'coeff', dict(kernel="""
+        ${dest.store}(idx, ${src.load}(idx) * ${coeff});
+        """))
+    computation = Multiply(ctx).prepare_for(dest, src, coeff)
+    results['launch[computation]'] = dict(
+        call_overhead=min_launch_time(lambda: computation(dest, src, coeff), attempts))
+
+    ctx.synchronize()
+
+    if log is not None:
+        for case_id in sorted(results):
+            log(case_id + ": " + ", ".join(
+                "{name} {t:.1f} us".format(name=name, t=t * 1e6)
+                for name, t in sorted(results[case_id].items())))
+
+    return results
@@ -0,0 +1,109 @@
+"""
+Functions measuring the performance of benchmark cases.
+"""
+
+import time
+
+
+def measure_prepare(ctx, case):
+    """
+    Prepares the computation for the benchmark case.
+    Returns a tuple ``(computation, args, results)``, where ``results`` is a dictionary
+    with ``prepare_time`` (time spent in the preparation, in seconds)
+    and ``prepare_<phase>`` values for every phase from
+    :py:attr:`~tigger.core.Computation.prepare_timings`.
+    """
+    t1 = time.time()
+    computation, args = case.prepare(ctx)
+    ctx.synchronize()
+    results = dict(prepare_time=time.time() - t1)
+
+    for phase, phase_time in computation.prepare_timings.items():
+        if phase != 'total':
+            results['prepare_' + phase] = phase_time
+
+    return computation, args, results
+
+
+def measure(ctx, case, attempts=10):
+    """
+    Runs the benchmark case and returns a dictionary with the results:
+
+    * ``prepare_time`` and ``prepare_<phase>`` (see :py:func:`measure_prepare`);
+    * ``call_overhead``: time spent in the host code of a single call,
+      without waiting for the kernels to finish (in seconds);
+    * ``time``: time of a single call including the execution (in seconds);
+    * ``gflops``: performance in GFLOPS (``None`` if the case does not perform any arithmetic);
+    * ``gbps``: effective bandwidth in GB/s.
+    """
+    computation, args, results = measure_prepare(ctx, case)
+
+    # warm-up
+    computation(*args)
+    ctx.synchronize()
+
+    overheads = []
+    t1 = time.time()
+    for i in range(attempts):
+        t_call = time.time()
+        computation(*args)
+        overheads.append(time.time() - t_call)
+    ctx.synchronize()
+    call_time = (time.time() - t1) / attempts
+
+    results.update(
+        call_overhead=min(overheads),
+        time=call_time,
+        gflops=case.flops / call_time / 1e9 if case.flops > 0 else None,
+        gbps=case.bytes_moved / call_time / 1e9)
+    return results
+
+
+def run(ctx, cases, attempts=10, log=None, prepare_only=False):
+    """
+    Measures all ``cases`` and returns a dictionary ``{case_id: results}``.
+    If ``prepare_only`` is ``True``, only the preparation is measured.
+    Cases raising ``ValueError`` during preparation (for example, the ones
+    not supported by the device) are skipped.
+    """
+    results = {}
+    for case in cases:
+        try:
+            if prepare_only:
+                _, _, results[case.id] = measure_prepare(ctx, case)
+            else:
+                results[case.id] = measure(ctx, case, attempts=attempts)
+        except ValueError as e:
+            if log is not None:
+                log(case.id + ": skipped (" + str(e) + ")")
+            continue
+
+        if log is not None:
+            log(case.id + ": " + format_results(results[case.id]))
+
+    return results
+
+
+def format_results(results):
+    if 'time' not in results:
+        return format_prepare_results(results)
+
+    return (
+        "{time:.3f} ms, {gbps:.2f} GB/s{gflops}, "
+        "prepare {prepare:.3f} s, overhead {overhead:.3f} ms").format(
+        time=results['time'] * 1e3,
+        gbps=results['gbps'],
+        gflops="" if results['gflops'] is None
+            else ", {gflops:.2f} GFLOPS".format(gflops=results['gflops']),
+        prepare=results['prepare_time'],
+        overhead=results['call_overhead'] * 1e3)
+
+
+def format_prepare_results(results):
+    phases = sorted(
+        (name[len('prepare_'):], value) for name, value in results.items()
+        if name.startswith('prepare_') and name != 'prepare_time')
+    return "prepare {prepare:.3f} s ({phases})".format(
+        prepare=results['prepare_time'],
+        phases=", ".join("{name} {value:.3f} s".format(name=name, value=value)
+            for name, value in phases))
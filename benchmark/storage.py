@@ -0,0 +1,90 @@
+"""
+Storage of benchmark results and comparison with a baseline.
+
+The results file has the structure ``{device: {commit: {case_id: results}}}``.
+"""
+
+import json
+import os.path
+import platform
+import subprocess
+
+
+def current_commit():
+    """
+    Returns the SHA of the current Git revision, or ``"unknown"``.
+    """
+    try:
+        out = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+            stdout=subprocess.PIPE).communicate()[0]
+        commit = out.strip().decode('ascii')
+    except OSError:
+        commit = ""
+    return commit if len(commit) > 0 else "unknown"
+
+
+def device_key(ctx):
+    return ctx.api.API_ID + ":" + ctx.device_params.name
+
+
+def host_key():
+    return "python-" + platform.python_version() + ":" + platform.node()
+
+
+def load(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(path, device, commit, results):
+    """
+    Adds ``results`` for the given device and commit to the results file
+    (replacing the previous values for the same cases).
+    """
+    data = load(path)
+    stored = data.setdefault(device, {}).setdefault(commit, {})
+    for case_id, case_results in results.items():
+        stored.setdefault(case_id, {}).update(case_results)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+# Default relative thresholds for regressions.
+# Time-like values are regressed if they increased,
+# performance-like values if they decreased.
+THRESHOLDS = dict(time=0.1, prepare_time=0.25, call_overhead=0.25)
+HIGHER_IS_BETTER = set(['gflops', 'gbps'])
+
+
+def compare(results, baseline, thresholds=None):
+    """
+    Compares ``results`` with ``baseline`` (both are dictionaries ``{case_id: results}``).
+    ``thresholds`` is a dictionary ``{value_name: relative_change}``.
+    Returns a list of tuples ``(case_id, value_name, baseline_value, new_value)``
+    for the values that regressed more than allowed.
+    """
+    if thresholds is None:
+        thresholds = THRESHOLDS
+
+    regressions = []
+    for case_id in sorted(results):
+        if case_id not in baseline:
+            continue
+
+        for name, threshold in thresholds.items():
+            old = baseline[case_id].get(name)
+            new = results[case_id].get(name)
+            if old is None or new is None or old == 0:
+                continue
+
+            if name in HIGHER_IS_BETTER:
+                regressed = new < old * (1 - threshold)
+            else:
+                regressed = new > old * (1 + threshold)
+
+            if regressed:
+                regressions.append((case_id, name, old, new))
+
+    return regressions
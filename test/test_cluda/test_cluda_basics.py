@@ -1,9 +1,12 @@
 import itertools
+import threading
+import weakref
 
 import pytest
 
 import tigger.cluda as cluda
 import tigger.cluda.dtypes as dtypes
+from tigger.cluda.events import WAITER, future_for
 from tigger.helpers import product
 
 from helpers import *
@@ -136,6 +139,195 @@ def test_transfers(ctx):
         assert diff_is_negligible(a, a_back)
 
 
+def test_async_transfers(ctx):
+    a = get_test_array((16, 1024), numpy.float32)
+
+    a_host = ctx.allocate_host(a.shape, a.dtype)
+    a_host[:] = a
+    a_device = ctx.allocate(a.shape, a.dtype)
+    upload = ctx.to_device_async(a_host, a_device)
+
+    b_host = ctx.host_pool.allocate(a.shape, a.dtype)
+    download = ctx.from_device_async(a_device, b_host)
+    download.wait()
+    assert upload.is_done()
+    assert download.is_done()
+    assert diff_is_negligible(a, b_host)
+
+    # freed arrays are reused by the pool
+    ctx.host_pool.free(b_host)
+    assert ctx.host_pool.allocate(a.shape, a.dtype) is b_host
+
+    event = ctx.record_event()
+    event.wait()
+    assert event.is_done()
+
+    with pytest.raises(ValueError):
+        ctx.to_device_async(a_host[:8], a_device)
+
+
+def test_wrap_host(ctx):
+    # Works both in zero-copy mode and with actual copying
+    a = get_test_array(1024, numpy.float32)
+    a_host = a.copy()
+    a_device = ctx.wrap_host(a_host)
+
+    ctx.copy_array(a_device, dest=a_device, src_offset=512, size=512)
+    ctx.from_device(a_device, dest=a_host)
+    a_ref = a.copy()
+    a_ref[:512] = a[512:]
+    assert diff_is_negligible(a_host, a_ref)
+
+    a_host[:] = a
+    ctx.to_device(a_host, dest=a_device)
+    assert diff_is_negligible(a_device.get(), a)
+
+
+def test_kernel_arguments_update(ctx):
+    # Only the arguments changed since the previous call are set again,
+    # so every combination of changes must produce correct results
+    N = 256
+    kernel = ctx.compile_static("""
+    KERNEL void multiply(GLOBAL_MEM float *dest, GLOBAL_MEM float *src, float coeff)
+    {
+        VIRTUAL_SKIP_THREADS;
+        const int i = virtual_global_flat_id();
+        dest[i] = src[i] * coeff;
+    }
+    """, 'multiply', N)
+
+    a = get_test_array(N, numpy.float32)
+    b = get_test_array(N, numpy.float32)
+    a_dev = ctx.to_device(a)
+    b_dev = ctx.to_device(b)
+    dest1 = ctx.allocate(N, numpy.float32)
+    dest2 = ctx.allocate(N, numpy.float32)
+
+    calls = [
+        (dest1, a_dev, a, 2),
+        (dest1, a_dev, a, 2),
+        (dest2, a_dev, a, 2),
+        (dest2, b_dev, b, 2),
+        (dest2, b_dev, b, 3),
+        (dest2, b_dev, b, 0.),
+        (dest2, b_dev, b, -0.)]
+    for dest, src_dev, src, coeff in calls:
+        kernel(dest, src_dev, numpy.float32(coeff))
+        result = ctx.from_device(dest)
+        if coeff == 0:
+            # the relative difference is not defined for zero reference values
+            assert (result == 0).all()
+        else:
+            assert diff_is_negligible(result, src * coeff)
+        assert (numpy.signbit(result) == numpy.signbit(src * numpy.float32(coeff))).all()
+
+    # The kernel does not keep the arrays alive after the call
+    temp = ctx.allocate(N, numpy.float32)
+    kernel(temp, a_dev, numpy.float32(1))
+    ctx.synchronize()
+    temp_ref = weakref.ref(temp)
+    del temp
+    assert temp_ref() is None
+
+
+def test_await_events(ctx):
+    asyncio = pytest.importorskip('asyncio')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    a = get_test_array(1024, numpy.float32)
+    a_host = ctx.allocate_host(a.shape, a.dtype)
+    a_host[:] = a
+    a_device = ctx.allocate(a.shape, a.dtype)
+
+    result = loop.run_until_complete(ctx.to_device_async(a_host, a_device))
+    assert result is a_device
+    b_host = loop.run_until_complete(ctx.from_device_async(a_device))
+    assert diff_is_negligible(b_host, a)
+    assert loop.run_until_complete(ctx.record_event()) is None
+
+    loop.close()
+
+
+def test_future_for():
+    # Device-independent check of the waiting mechanism
+    asyncio = pytest.importorskip('asyncio')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    finished = threading.Event()
+    future = future_for(
+        lambda callback: WAITER.call_when_done(finished.wait, callback), result=1)
+    assert not future.done()
+    finished.set()
+    assert loop.run_until_complete(future) == 1
+
+    # Errors are passed to the future, and the waiting thread keeps working
+    def fail():
+        raise RuntimeError("failed")
+    future = future_for(lambda callback: WAITER.call_when_done(fail, callback))
+    with pytest.raises(RuntimeError):
+        loop.run_until_complete(future)
+
+    future = future_for(
+        lambda callback: WAITER.call_when_done(lambda: None, callback), result=2)
+    assert loop.run_until_complete(future) == 2
+
+    loop.close()
+
+
+def test_use_queue(ctx):
+    a = get_test_array(1024, numpy.float32)
+    queue = ctx.create_queue()
+
+    with ctx.use_queue(queue):
+        a_dev = ctx.to_device(a)
+        ctx.synchronize()
+
+    assert diff_is_negligible(ctx.from_device(a_dev), a)
+
+
+def test_thread_queues(cluda_api):
+    if cluda_api.API_ID == cluda.API_CUDA:
+        # The CUDA context would have to be made current in every thread
+        pytest.skip()
+
+    ctx = cluda_api.Context.create(thread_queues=True)
+    N = 1024
+    kernel = ctx.compile_static("""
+    KERNEL void multiply(GLOBAL_MEM float *dest, GLOBAL_MEM float *src, float coeff)
+    {
+        VIRTUAL_SKIP_THREADS;
+        const int i = virtual_global_flat_id();
+        dest[i] = src[i] * coeff;
+    }
+    """, 'multiply', N)
+
+    a = get_test_array(N, numpy.float32)
+    results = {}
+    queues = {}
+
+    def worker(i):
+        a_dev = ctx.to_device(a)
+        dest = ctx.allocate(N, numpy.float32)
+        for j in range(10):
+            kernel(dest, a_dev, numpy.float32(i + 1))
+        results[i] = ctx.from_device(dest)
+        queues[i] = ctx._queue
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(id(queue) for queue in queues.values())) == len(threads)
+    for i, result in results.items():
+        assert diff_is_negligible(result, a * (i + 1))
+
+    ctx.release()
+
+
 @pytest.mark.parametrize(
     "dtype", TEST_DTYPES,
     ids=[dtypes.normalize_type(dtype).name for dtype in TEST_DTYPES])
@@ -196,3 +388,53 @@ def test_find_local_size(ctx_and_global_size):
 
     assert diff_is_negligible(dest_dev.get().ravel(),
         numpy.arange(product(global_size)).astype(numpy.int32))
+
+
+def test_compact_source():
+    """
+    Check that the source post-processor removes comments, whitespace
+    and unused definitions, but leaves everything the kernel needs.
+    """
+    from tigger.cluda.source import compact_source
+
+    src = """
+    // comment
+    #define UNUSED_MACRO(x) \\
+        ((x) + 1)
+    #define USED_MACRO 3
+
+    WITHIN_KERNEL float used_indirectly(float x) { return x; }
+
+    WITHIN_KERNEL float used(float x)
+    {
+        return used_indirectly(x) * USED_MACRO; /* comment */
+    }
+
+    WITHIN_KERNEL float unused(float x)
+    {
+        return used(x);
+    }
+
+    KERNEL void test(GLOBAL_MEM float *dest)
+    {
+        const int i = get_global_id(0);
+        dest[i] = used(dest[i]); // "comment"
+    }
+    """
+
+    result = compact_source(src)
+    assert result == (
+        "#define USED_MACRO 3\n"
+        "WITHIN_KERNEL float used_indirectly(float x) { return x; }\n"
+        "WITHIN_KERNEL float used(float x)\n"
+        "{\n"
+        "return used_indirectly(x) * USED_MACRO;\n"
+        "}\n"
+        "KERNEL void test(GLOBAL_MEM float *dest)\n"
+        "{\n"
+        "const int i = get_global_id(0);\n"
+        "dest[i] = used(dest[i]);\n"
+        "}\n")
+
+    # The result does not depend on formatting
+    assert compact_source(src.replace("    ", "\t")) == result
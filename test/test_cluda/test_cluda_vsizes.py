@@ -43,6 +43,9 @@ def set_context_gs_limits(metafunc, cc):
 def pytest_generate_tests(metafunc):
     if 'ctx_with_gs_limits' in metafunc.funcargnames:
         parametrize_context_tuple(metafunc, 'ctx_with_gs_limits', set_context_gs_limits)
+    if 'persistent' in metafunc.funcargnames:
+        metafunc.parametrize('persistent', [False, True],
+            ids=["normal", "persistent"])
     if 'gs_is_multiple' in metafunc.funcargnames:
         metafunc.parametrize('gs_is_multiple', [True, False],
             ids=["gs_is_multiple", "gs_is_not_multiple"])
@@ -127,7 +130,7 @@ class ReferenceIds:
         return lids + gids * (self.local_size[dim] if dim < len(self.local_size) else 0)
 
 
-def test_ids(ctx_with_gs_limits, gl_size, gs_is_multiple):
+def test_ids(ctx_with_gs_limits, gl_size, gs_is_multiple, persistent):
     """
     Test that virtual IDs are correct for each thread.
     """
@@ -143,6 +146,7 @@ def test_ids(ctx_with_gs_limits, gl_size, gs_is_multiple):
         GLOBAL_MEM int *gx, GLOBAL_MEM int *gy, GLOBAL_MEM int *gz,
         GLOBAL_MEM int *glx, GLOBAL_MEM int *gly, GLOBAL_MEM int *glz)
     {
+        VIRTUAL_GROUP_LOOP_BEGIN
         VIRTUAL_SKIP_THREADS;
         const int i = virtual_global_flat_id();
         fid[i] = i;
@@ -155,8 +159,9 @@ def test_ids(ctx_with_gs_limits, gl_size, gs_is_multiple):
         glx[i] = virtual_global_id(0);
         gly[i] = virtual_global_id(1);
         glz[i] = virtual_global_id(2);
+        VIRTUAL_GROUP_LOOP_END
     }
-    """, 'get_ids', ref.global_size, local_size=ref.local_size)
+    """, 'get_ids', ref.global_size, local_size=ref.local_size, persistent=persistent)
 
     fid = ctx.allocate(product(ref.np_global_size), numpy.int32)
     lx = ctx.allocate(ref.np_global_size, numpy.int32)
@@ -236,3 +241,34 @@ def test_incorrect_sizes(ctx_with_gs_limits, incorrect_gl_size):
             temp[0] = 1;
         }
         """, 'test', ref.global_size, local_size=ref.local_size)
+
+
+def test_occupancy_local_size():
+    """
+    Check that the occupancy model prefers the local size
+    which allows more work items to reside on a compute unit simultaneously.
+    """
+    from tigger.helpers import AttrDict
+    from tigger.cluda.vsize import find_local_size, occupancy
+
+    device_params = AttrDict(
+        warp_size=32, max_work_group_size=1024, max_work_item_sizes=[1024, 1024, 64],
+        max_work_groups_per_unit=8, max_work_items_per_unit=1536,
+        registers_per_unit=32768, local_mem_per_unit=49152)
+
+    # 1024 work items per group only allow one resident group (1024 out of 1536 work items),
+    # while 768 or 512 fit 1536
+    local_size = find_local_size(device_params, 1024, 1)
+    assert local_size == (768,)
+    assert occupancy(device_params, 768) == (2, 'work items')
+
+    # Large register usage limits the occupancy
+    assert occupancy(device_params, 256, registers=32) == (4, 'registers')
+
+    # If local memory usage only allows one resident workgroup, the largest one is preferred
+    local_size = find_local_size(device_params, 1024, 2, local_mem=32768)
+    assert local_size == (1024, 1)
+
+    # With the occupancy model disabled the largest local size is picked
+    local_size = find_local_size(device_params, 1024, 1, use_occupancy=False)
+    assert local_size == (1024,)
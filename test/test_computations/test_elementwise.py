@@ -2,7 +2,7 @@ import numpy
 import pytest
 
 from helpers import *
-from tigger.elementwise import Elementwise
+from tigger.elementwise import Elementwise, specialize_elementwise
 import tigger.cluda.dtypes as dtypes
 
 
@@ -57,3 +57,90 @@ def test_nontrivial_code(ctx):
     elw.prepare_for(b_dev, a_dev, numpy.float32(param), code=code)
     elw(b_dev, a_dev, param)
     assert diff_is_negligible(ctx.from_device(b_dev), a[:N] + a[N:] + param)
+
+
+def test_items_per_thread(ctx):
+
+    argnames = (('output',), ('input',), ('param',))
+    code = dict(kernel="""
+        ${output.store}(idx, ${input.load}(idx) + ${param});
+        """)
+
+    # sizes which are not divisible by the number of items per thread
+    # check the handling of the tail
+    N = 1001
+    a = get_test_array(N, numpy.float32)
+    a_dev = ctx.to_device(a)
+    b_dev = ctx.allocate(N, numpy.float32)
+    param = 1
+
+    for ipt in [1, 2, 3, 8]:
+        elw = Elementwise(ctx).set_argnames(*argnames)
+        elw.prepare_for(b_dev, a_dev, numpy.float32(param), code=code,
+            items_per_thread_override=ipt)
+        elw(b_dev, a_dev, param)
+        assert diff_is_negligible(ctx.from_device(b_dev), a + param)
+
+
+def test_dynamic(ctx):
+    # The same prepared computation works with arrays of different sizes
+    argnames = (('output',), ('input',), ('param',))
+    code = dict(kernel="""
+        ${output.store}(idx, ${input.load}(idx) + ${param});
+        """)
+
+    elw = Elementwise(ctx).set_argnames(*argnames)
+    param = 1
+
+    for i, N in enumerate([1000, 1, 100000]):
+        a = get_test_array(N, numpy.float32)
+        a_dev = ctx.to_device(a)
+        b_dev = ctx.allocate(N, numpy.float32)
+        if i == 0:
+            elw.prepare_for(b_dev, a_dev, numpy.float32(param), code=code, dynamic=True)
+        elw(b_dev, a_dev, param)
+        assert diff_is_negligible(ctx.from_device(b_dev), a + param)
+
+
+def test_dynamic_profiling(ctx):
+    # The amount of memory moved is estimated from the actual sizes of the arguments
+    code = dict(kernel="${output.store}(idx, ${input.load}(idx));")
+    profiling_ctx = ctx.api.Context(ctx._context, profile=True)
+    elw = Elementwise(profiling_ctx).set_argnames(('output',), ('input',), ())
+
+    for i, N in enumerate([1000, 100]):
+        a_dev = profiling_ctx.to_device(get_test_array(N, numpy.float32))
+        b_dev = profiling_ctx.allocate(N, numpy.float32)
+        if i == 0:
+            elw.prepare_for(b_dev, a_dev, code=code, dynamic=True)
+        elw(b_dev, a_dev)
+
+    records = elw.profile().records
+    assert [record.bytes_moved for record in records] == [2 * 1000 * 4, 2 * 100 * 4]
+
+
+def test_specialized_keywords(ctx):
+    # Keywords of Elementwise.prepare_for() can be used with specialized computations
+    AddParam = specialize_elementwise('output', 'input', 'param', dict(kernel="""
+        ${output.store}(idx, ${input.load}(idx) + ${param});
+        """))
+    param = 1
+
+    elw = AddParam(ctx)
+    for i, N in enumerate([1000, 100000]):
+        a = get_test_array(N, numpy.float32)
+        a_dev = ctx.to_device(a)
+        b_dev = ctx.allocate(N, numpy.float32)
+        if i == 0:
+            elw.prepare_for(b_dev, a_dev, numpy.float32(param), dynamic=True)
+        elw(b_dev, a_dev, param)
+        assert diff_is_negligible(ctx.from_device(b_dev), a + param)
+
+    N = 1000
+    a = get_test_array(N, numpy.float32)
+    a_dev = ctx.to_device(a)
+    b_dev = ctx.allocate(N, numpy.float32)
+    elw = AddParam(ctx).prepare_for(b_dev, a_dev, numpy.float32(param),
+        items_per_thread_override=2)
+    elw(b_dev, a_dev, param)
+    assert diff_is_negligible(ctx.from_device(b_dev), a + param)
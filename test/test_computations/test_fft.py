@@ -167,6 +167,15 @@ def test_non_power_of_2_problem(ctx, non2problem_shape_and_axes):
     check_errors(ctx, non2problem_shape_and_axes)
 
 
+def test_negative_axes(ctx):
+    check_errors(ctx, ((16, 256), (-1,)))
+
+    # a 1D transform over the axis -1 is performed over the batch axis
+    arr = numpy.empty(16, numpy.complex64)
+    fft = FFT(ctx).prepare_for(arr, arr, None, axes=(-1,))
+    assert not fft._is_batch_independent(fft._basis)
+
+
 def test_non2batch(ctx, non2batch_shape_and_axes):
     """
     Tests that the normal algoritms supports both inner and outer batches that are not powers of 2.
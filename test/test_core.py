@@ -1,9 +1,19 @@
+import threading
+import time
+
 import numpy
 import pytest
 
 from tigger.helpers import *
 from tigger.core import *
+from tigger.core.transformation import wrap_value, leaf_index
+from tigger.core.operation import compilation_deferred
+from tigger.core.multidevice import MultiDevice, split_batch
+from tigger.core.dispatcher import Dispatcher
+from tigger.core.pipeline import Pipeline
+from tigger.elementwise import specialize_elementwise
 from tigger import Transformation, ArrayValue, ScalarValue
+from tigger.cluda import OutOfResourcesError, API_OCL
 
 import tigger.transformations as transformations
 
@@ -405,3 +415,700 @@ def test_scalar_fixed_type(some_ctx):
         "(array, int32, (1024,)) B, "
         "(scalar, int32) coeff, "
         "(scalar, int32) param")
+
+
+def test_array_views(ctx):
+    # Views into bigger arrays can be passed to computations without copying
+    coeff = numpy.float32(2)
+    D_param = numpy.float32(4)
+    N = 1024
+
+    d = Dummy(ctx)
+    d.connect(tr_scale, 'D', ['D_prime'], ['D_param'])
+
+    AB = get_test_array(N * 3, numpy.float32)
+    gpu_AB = ctx.to_device(AB)
+    gpu_CD = ctx.allocate(N * 3, numpy.float32)
+
+    gpu_A = gpu_AB[N:N*2]
+    gpu_B = gpu_AB[N*2:]
+    gpu_C = gpu_CD[:N]
+    gpu_D_prime = gpu_CD[N*2:]
+
+    d.prepare_for(gpu_C, gpu_D_prime, gpu_A, gpu_B, coeff, D_param)
+    d(gpu_C, gpu_D_prime, gpu_A, gpu_B, coeff, D_param)
+
+    C, D = mock_dummy(AB[N:N*2], AB[N*2:], coeff)
+    CD = ctx.from_device(gpu_CD)
+    assert diff_is_negligible(CD[:N], C)
+    assert diff_is_negligible(CD[N*2:], D * D_param)
+
+
+def test_strided_views(ctx):
+    # Non-contiguous views are processed in one pass
+    coeff = numpy.float32(2)
+    N = 1024
+
+    d = Dummy(ctx)
+
+    AB = get_test_array((N, 4), numpy.float32)
+    gpu_AB = ctx.to_device(AB)
+    gpu_CD = ctx.allocate((N, 2), numpy.float32)
+
+    gpu_A = gpu_AB[:, 1]
+    gpu_B = gpu_AB[:, 3]
+    gpu_C = gpu_CD[:, 0]
+    gpu_D = gpu_CD[:, 1]
+
+    d.prepare_for(gpu_C, gpu_D, gpu_A, gpu_B, coeff)
+    d(gpu_C, gpu_D, gpu_A, gpu_B, coeff)
+
+    C, D = mock_dummy(AB[:, 1], AB[:, 3], coeff)
+    CD = ctx.from_device(gpu_CD)
+    assert diff_is_negligible(CD[:, 0], C)
+    assert diff_is_negligible(CD[:, 1], D)
+
+
+def test_view_layout_mismatch(ctx):
+    # The layout of views is fixed at preparation, so views with different layouts are rejected
+    coeff = numpy.float32(2)
+    N = 1024
+
+    d = Dummy(ctx)
+    gpu_A = ctx.allocate(N, numpy.float32)
+    gpu_B = ctx.allocate(N, numpy.float32)
+    gpu_C = ctx.allocate(N, numpy.float32)
+    gpu_D = ctx.allocate(N, numpy.float32)
+    d.prepare_for(gpu_C, gpu_D, gpu_A, gpu_B, coeff)
+
+    gpu_AB = ctx.allocate((N, 2), numpy.float32)
+    with pytest.raises(ValueError):
+        d(gpu_C, gpu_D, gpu_AB[:, 0], gpu_B, coeff)
+
+
+def test_strided_leaf_index():
+    # Checks that the generated index expressions address the elements of numpy views correctly
+    a = numpy.arange(120).reshape(4, 6, 5)
+    views = [a[:, 1:3], a.transpose(2, 0, 1), a[:, ::2, :], a[::-1, 2:3, 1:4]]
+
+    for view in views:
+        value = wrap_value(view)
+        assert value.strides is not None
+
+        # In numpy views the pointer is shifted to the first element instead of an offset
+        flat = a.ravel()
+        offset = (view.__array_interface__['data'][0] - a.__array_interface__['data'][0]) // \
+            a.dtype.itemsize
+        expr = leaf_index(value).replace('/', '//')
+        for i, x in enumerate(view.ravel()):
+            assert flat[offset + eval(expr, dict(idx=i))] == x
+
+
+def test_multi_device(ctx):
+    # A second context for the same device will work as another device
+    ctxs = [ctx, ctx.api.Context(ctx._context)]
+    coeff = numpy.float32(2)
+    N = 1000
+
+    A = get_test_array(N, numpy.float32)
+    B = get_test_array(N, numpy.float32)
+    C = numpy.empty_like(A)
+    D = numpy.empty_like(A)
+
+    md = MultiDevice(ctxs, Dummy, ['C', 'D', 'A', 'B'], weights=[1, 3])
+    md.prepare_for(C, D, A, B, coeff)
+    md(C, D, A, B, coeff)
+
+    C_ref, D_ref = mock_dummy(A, B, coeff)
+    assert diff_is_negligible(C, C_ref)
+    assert diff_is_negligible(D, D_ref)
+
+
+def test_multi_device_fission(ctx):
+    # Sub-devices of an OpenCL device (e.g. a CPU) work as separate devices
+    if ctx.api.API_ID != API_OCL:
+        pytest.skip()
+
+    import pyopencl as cl
+    device = ctx._device
+    try:
+        sub_devices = device.create_sub_devices([cl.device_partition_property.EQUALLY,
+            max(1, device.max_compute_units // 2)])
+    except (cl.Error, AttributeError):
+        pytest.skip()
+    if len(sub_devices) < 2:
+        pytest.skip()
+
+    ctxs = [ctx.api.Context.create(device=sub_device) for sub_device in sub_devices[:2]]
+    coeff = numpy.float32(2)
+    N = 1000
+
+    A = get_test_array(N, numpy.float32)
+    B = get_test_array(N, numpy.float32)
+    C = numpy.empty_like(A)
+    D = numpy.empty_like(A)
+
+    try:
+        md = MultiDevice(ctxs, Dummy, ['C', 'D', 'A', 'B'])
+        md.prepare_for(C, D, A, B, coeff)
+        md(C, D, A, B, coeff)
+    finally:
+        for sub_ctx in ctxs:
+            sub_ctx.release()
+
+    C_ref, D_ref = mock_dummy(A, B, coeff)
+    assert diff_is_negligible(C, C_ref)
+    assert diff_is_negligible(D, D_ref)
+
+
+def test_multi_device_dependent_batch(ctx):
+    # Computations processing the first axis as a whole cannot be split
+    from tigger.fft import FFT
+
+    A = get_test_array((16, 16), numpy.complex64)
+    B = numpy.empty_like(A)
+
+    md = MultiDevice([ctx], FFT, ['output', 'input'])
+    with pytest.raises(ValueError):
+        md.prepare_for(B, A, numpy.int32(-1))
+
+
+def test_split_batch():
+    assert split_batch(10, [1, 1]) == [(0, 5), (5, 10)]
+    assert split_batch(10, [1, 3]) == [(0, 2), (2, 10)]
+    assert split_batch(2, [1, 1, 1]) == [(0, 1), (1, 1), (1, 2)]
+
+
+def test_dispatcher(ctx):
+    dispatcher = Dispatcher(ctx, Dummy, max_plans=2)
+    coeff = numpy.float32(2)
+
+    for N in [100, 200, 100, 300, 100]:
+        A = get_test_array(N, numpy.float32)
+        B = get_test_array(N, numpy.float32)
+        A_dev = ctx.to_device(A)
+        B_dev = ctx.to_device(B)
+        C_dev = ctx.allocate(N, numpy.float32)
+        D_dev = ctx.allocate(N, numpy.float32)
+
+        dispatcher(C_dev, D_dev, A_dev, B_dev, coeff)
+
+        C_ref, D_ref = mock_dummy(A, B, coeff)
+        assert diff_is_negligible(ctx.from_device(C_dev), C_ref)
+        assert diff_is_negligible(ctx.from_device(D_dev), D_ref)
+
+    assert dispatcher.statistics() == dict(hits=2, misses=3, evictions=1, plans=2)
+
+
+Scale = specialize_elementwise('output', 'input', 'coeff', dict(kernel="""
+    ${output.store}(idx, ${input.load}(idx) * ${coeff});
+    """))
+
+
+def test_dispatcher_threads(ctx):
+    """
+    Check that every thread gets its own prepared computation.
+    """
+    dispatcher = Dispatcher(ctx, Dummy)
+    arr = numpy.empty(100, numpy.float32)
+    args = (arr, arr, arr, arr, numpy.float32(2))
+    plans = {}
+    done = threading.Event()
+
+    def worker(i):
+        plans[i] = dispatcher.plan_for(*args)
+        # Thread identifiers can be reused, so both threads must be alive at the same time
+        done.wait()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for i in range(1000):
+        if len(plans) == len(threads):
+            break
+        time.sleep(0.01)
+    done.set()
+    for thread in threads:
+        thread.join()
+
+    assert plans[0] is not plans[1]
+    assert dispatcher.plan_for(*args) is dispatcher.plan_for(*args)
+
+
+def test_pipeline(ctx):
+    N = 1000
+    Add = specialize_elementwise('output', 'input', None, dict(kernel="""
+        ${output.store}(idx, ${input.load}(idx) + 1);
+        """))
+
+    arr = numpy.empty(N, numpy.float32)
+    scale = Scale(ctx).prepare_for(arr, arr, numpy.float32(2))
+    add = Add(ctx).prepare_for(arr, arr)
+
+    chunks = [get_test_array(N, numpy.float32) for i in range(5)]
+    pipeline = Pipeline(ctx, [(scale, (2,)), add], in_flight=2)
+    results = list(pipeline.run(iter(chunks)))
+
+    assert len(results) == len(chunks)
+    for chunk, result in zip(chunks, results):
+        assert diff_is_negligible(result, chunk * 2 + 1)
+    assert pipeline.statistics()['chunks'] == len(chunks)
+
+
+class DummyOutOfResources(Dummy):
+    """
+    Dummy computation which runs out of resources if the maximum workgroup size
+    is greater than 64.
+    """
+
+    def __init__(self, *args, **kwds):
+        Dummy.__init__(self, *args, **kwds)
+        self.attempts = []
+
+    def _construct_operations(self, basis, device_params):
+        self.attempts.append(device_params.max_work_group_size)
+        if device_params.max_work_group_size > 64:
+            raise OutOfResourcesError
+        return self._get_operation_recorder()
+
+
+def test_out_of_resources_fallback(some_ctx):
+    """
+    Check that if _construct_operations() raises OutOfResourcesError,
+    it is called again with the reduced workgroup size,
+    and that the successful limit is used for the next preparation right away.
+    """
+    import tigger.core.computation
+    tigger.core.computation._WORK_GROUP_SIZE_LIMITS.clear()
+
+    N = 1024
+    coeff = numpy.float32(1)
+    A = some_ctx.allocate(N, numpy.float32)
+    B = some_ctx.allocate(N, numpy.float32)
+    C = some_ctx.allocate(N, numpy.float32)
+    D = some_ctx.allocate(N, numpy.float32)
+
+    max_wgs = some_ctx.device_params.max_work_group_size
+    expected = [max_wgs]
+    while expected[-1] > 64:
+        expected.append(expected[-1] // 2)
+
+    test = DummyOutOfResources(some_ctx).prepare_for(C, D, A, B, coeff)
+    assert test.attempts == expected
+
+    test = DummyOutOfResources(some_ctx).prepare_for(C, D, A, B, coeff)
+    assert test.attempts == expected[-1:]
+
+
+def _fail_build(ctx):
+    raise OutOfResourcesError
+
+
+class DummyCompileOutOfResources(Dummy):
+    """
+    Dummy computation whose kernel fails to compile
+    if the maximum workgroup size is greater than 64.
+    """
+
+    def __init__(self, *args, **kwds):
+        Dummy.__init__(self, *args, **kwds)
+        self.attempts = []
+
+    def _construct_operations(self, basis, device_params):
+        self.attempts.append(device_params.max_work_group_size)
+        if device_params.max_work_group_size <= 64:
+            return self._get_operation_recorder()
+        if not compilation_deferred():
+            # the kernel would fail to compile right away
+            raise OutOfResourcesError
+
+        operations = Dummy._construct_operations(self, basis, device_params)
+        for kernel_call in operations.operations:
+            kernel_call.build = _fail_build
+        return operations
+
+
+class DummyNestedCompileOutOfResources(DummyNested):
+    """
+    Dummy computation with two nested computations, one of which fails to compile.
+    """
+
+    def __init__(self, *args, **kwds):
+        DummyNested.__init__(self, *args, **kwds)
+        self.constructions = 0
+
+    def _construct_operations(self, basis, device_params):
+        self.constructions += 1
+        operations = self._get_operation_recorder()
+        operations.add_computation(self.get_nested_computation(Dummy), 'C', 'D', 'A', 'B', 'coeff')
+        self.failing = self.get_nested_computation(DummyCompileOutOfResources)
+        operations.add_computation(self.failing, 'C', 'D', 'C', 'D', 'coeff')
+        return operations
+
+
+def test_out_of_resources_in_deferred_compilation(some_ctx):
+    """
+    Check that if a kernel fails to compile with OutOfResourcesError,
+    only the computation it belongs to is constructed again.
+    """
+    import tigger.core.computation
+    tigger.core.computation._WORK_GROUP_SIZE_LIMITS.clear()
+
+    N = 1024
+    coeff = numpy.float32(1)
+    A = some_ctx.allocate(N, numpy.float32)
+    B = some_ctx.allocate(N, numpy.float32)
+    C = some_ctx.allocate(N, numpy.float32)
+    D = some_ctx.allocate(N, numpy.float32)
+
+    max_wgs = some_ctx.device_params.max_work_group_size
+    expected = [max_wgs]
+    while expected[-1] > 64:
+        expected.append(expected[-1] // 2)
+
+    test = DummyNestedCompileOutOfResources(some_ctx).prepare_for(C, D, A, B, coeff)
+    assert test.constructions == 1
+    assert test.failing.attempts == expected
+
+
+def test_profiling(ctx):
+    """
+    Check that kernel launches of nested computations are recorded in the profiling report.
+    """
+    import json
+
+    N = 1024
+    coeff = numpy.float32(2)
+
+    profiling_ctx = ctx.api.Context(ctx._context, profile=True)
+    A = profiling_ctx.to_device(get_test_array(N, numpy.float32))
+    B = profiling_ctx.to_device(get_test_array(N, numpy.float32))
+    C = profiling_ctx.allocate(N, numpy.float32)
+    D = profiling_ctx.allocate(N, numpy.float32)
+
+    d = DummyNested(profiling_ctx).prepare_for(C, D, A, B, coeff)
+    d(C, D, A, B, coeff)
+    d(C, D, A, B, coeff)
+
+    report = d.profile()
+    assert len(report.records) == 2
+    for record in report.records:
+        assert record.path == "DummyNested/Dummy"
+        assert record.name == "dummy"
+        assert record.bytes_moved == 4 * N * 4
+        assert record.end >= record.start
+
+    summary = report.summary()
+    assert len(summary) == 1 and summary[0]['calls'] == 2
+
+    trace = json.loads(report.to_chrome_trace())
+    assert len(trace['traceEvents']) == 2
+
+    # The records are cleared after the report is created
+    assert len(d.profile().records) == 0
+
+
+def test_prepare_timings(ctx):
+    """
+    Check that the time spent in preparation phases is recorded,
+    including the phases of nested computations.
+    """
+    N = 1024
+    coeff = numpy.float32(2)
+    A = ctx.allocate(N, numpy.float32)
+    B = ctx.allocate(N, numpy.float32)
+    C = ctx.allocate(N, numpy.float32)
+    D = ctx.allocate(N, numpy.float32)
+
+    d = DummyNested(ctx)
+    assert d.prepare_timings is None
+    d.prepare_for(C, D, A, B, coeff)
+
+    timings = d.prepare_timings
+    for phase in ('basis', 'transformations', 'render', 'stub_compile', 'compile',
+            'allocations', 'total'):
+        assert phase in timings
+
+    assert sum(t for phase, t in timings.items() if phase != 'total') <= timings['total']
+
+
+class DummyNestedTwice(DummyNested):
+    """
+    Dummy computation with two nested computations (and therefore two kernels).
+    """
+
+    def _construct_operations(self, basis, device_params):
+        operations = self._get_operation_recorder()
+        operations.add_computation(self.get_nested_computation(Dummy), 'C', 'D', 'A', 'B', 'coeff')
+        operations.add_computation(self.get_nested_computation(Dummy), 'C', 'D', 'C', 'D', 'coeff')
+        return operations
+
+
+def test_parallel_compilation(ctx):
+    N = 1024
+    coeff = numpy.float32(2)
+    A = get_test_array(N, numpy.float32)
+    B = get_test_array(N, numpy.float32)
+    gpu_A = ctx.to_device(A)
+    gpu_B = ctx.to_device(B)
+    gpu_C = ctx.allocate(N, numpy.float32)
+    gpu_D = ctx.allocate(N, numpy.float32)
+
+    d = DummyNestedTwice(ctx).prepare_for(gpu_C, gpu_D, gpu_A, gpu_B, coeff)
+    d(gpu_C, gpu_D, gpu_A, gpu_B, coeff)
+
+    C, D = mock_dummy(A, B, coeff)
+    C, D = mock_dummy(C, D, coeff)
+    assert diff_is_negligible(ctx.from_device(gpu_C), C)
+    assert diff_is_negligible(ctx.from_device(gpu_D), D)
+
+
+def test_build_kernel_calls():
+    """
+    Check that postponed kernels are built concurrently,
+    and the build time is divided between phases.
+    """
+    import threading
+    import time
+    from tigger.core.operation import build_kernel_calls
+
+    class MockKernelCall:
+        def build(self, ctx):
+            with timed_phase('compile'):
+                time.sleep(0.1)
+            self.thread = threading.current_thread()
+
+    kernel_calls = [MockKernelCall() for i in range(4)]
+    with collect_phase_timings() as timings:
+        t1 = time.time()
+        build_kernel_calls(AttrDict(compile_threads=4), kernel_calls)
+        elapsed = time.time() - t1
+
+    assert len(set(kernel_call.thread for kernel_call in kernel_calls)) > 1
+    assert timings['compile'] <= elapsed
+
+
+def test_bundle(ctx, tmpdir):
+    """
+    Check that a computation can be prepared with a bundle without compiling kernels.
+    """
+    from tigger.bundle import Bundle, build_bundle
+
+    N = 1024
+    coeff = numpy.float32(2)
+    spec = dict(computation=DummyNested,
+        args=[dict(shape=[N], dtype='float32')] * 4 + [dict(dtype='float32')])
+
+    bundle = build_bundle(ctx, [spec])
+    assert len(bundle.binaries) > 0
+    path = str(tmpdir.join('bundle.pkl'))
+    bundle.save(path)
+
+    bundle = Bundle.load(path)
+    bundle_ctx = ctx.api.Context(ctx._context)
+    bundle.attach(bundle_ctx)
+    binaries_num = len(bundle.binaries)
+
+    A = get_test_array(N, numpy.float32)
+    B = get_test_array(N, numpy.float32)
+    gpu_A = bundle_ctx.to_device(A)
+    gpu_B = bundle_ctx.to_device(B)
+    gpu_C = bundle_ctx.allocate(N, numpy.float32)
+    gpu_D = bundle_ctx.allocate(N, numpy.float32)
+
+    d = DummyNested(bundle_ctx).prepare_for(gpu_C, gpu_D, gpu_A, gpu_B, coeff)
+    d(gpu_C, gpu_D, gpu_A, gpu_B, coeff)
+
+    # All the binaries were taken from the bundle
+    assert len(bundle.binaries) == binaries_num
+
+    # the nested computation takes the arguments in a different order
+    D, C = mock_dummy(B, A, coeff)
+    assert diff_is_negligible(bundle_ctx.from_device(gpu_C), C)
+    assert diff_is_negligible(bundle_ctx.from_device(gpu_D), D)
+
+
+def test_plan_server(ctx, tmpdir):
+    from tigger.server import PlanServer, PlanClient
+
+    address = str(tmpdir.join('server.sock'))
+    server = PlanServer(ctx, address, authkey=b'test')
+    server.register('scale', Scale, batch=True)
+
+    workers = 4
+    calls = 5
+    errors = []
+
+    def worker(i):
+        client = PlanClient(address, authkey=b'test', size=1024)
+        try:
+            for j in range(calls):
+                # different sizes to check the shared memory resizing
+                a = get_test_array((j + 1) * 100, numpy.float32)
+                b = numpy.empty_like(a)
+                client.call('scale', b, a, numpy.float32(i + 1))
+                if not diff_is_negligible(b, a * (i + 1)):
+                    errors.append((i, j))
+        finally:
+            client.close()
+
+    def run_workers():
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        server.stop()
+
+    # The server works in this thread, since the context may be bound to it
+    threading.Thread(target=run_workers).start()
+    server.serve_forever()
+
+    assert len(errors) == 0
+    assert server.statistics()['requests'] == workers * calls
+
+
+def serve_simultaneous_requests(ctx, address, create, requests, prepare_kwds=None):
+    """
+    Serves ``requests`` (a list of pairs ``(args, reference_results)``)
+    to a computation registered with ``batch=True``, every request coming from a separate worker.
+    The first preparation is held until the other requests are queued,
+    so that they can be executed together afterwards.
+    Returns the server statistics and the indices of requests with wrong results.
+    """
+    from tigger.server import PlanServer, PlanClient
+
+    server = PlanServer(ctx, address, authkey=b'test')
+    errors = []
+    held = []
+
+    def held_create(ctx):
+        if len(held) == 0:
+            held.append(True)
+            for i in range(1000):
+                if server._requests.qsize() >= len(requests) - 1:
+                    break
+                time.sleep(0.01)
+        return create(ctx)
+
+    server.register('test', held_create, prepare_kwds=prepare_kwds, batch=True)
+
+    def worker(i):
+        args, reference = requests[i]
+        client = PlanClient(address, authkey=b'test')
+        try:
+            client.call('test', *args)
+            # outputs go first, and the result is checked in place
+            for result, result_ref in zip(args, reference):
+                if not diff_is_negligible(result, result_ref):
+                    errors.append(i)
+        finally:
+            client.close()
+
+    def run_workers():
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(requests))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        server.stop()
+
+    threading.Thread(target=run_workers).start()
+    server.serve_forever()
+
+    return server.statistics(), errors
+
+
+def test_plan_server_batching(ctx, tmpdir):
+    """
+    Check that simultaneous requests with the same scalars and trailing shapes
+    are joined into a single call, and every worker gets its own part of the result.
+    """
+    coeff = numpy.float32(3)
+    requests = []
+    for i in range(4):
+        # different lengths; the trailing shape (empty) is the same
+        a = get_test_array((i + 1) * 100, numpy.float32)
+        requests.append(((numpy.empty_like(a), a, coeff), (a * coeff,)))
+
+    statistics, errors = serve_simultaneous_requests(
+        ctx, str(tmpdir.join('server.sock')), Scale, requests)
+
+    assert len(errors) == 0
+    assert statistics['requests'] == len(requests)
+    assert statistics['batched_calls'] > 0
+
+
+def test_plan_server_dependent_batch(ctx, tmpdir):
+    """
+    Check that requests to a computation processing the first axis as a whole
+    are not joined even if it is registered with ``batch=True``.
+    """
+    from tigger.reduce import Reduce
+
+    requests = []
+    for i in range(4):
+        a = get_test_array((100, 16), numpy.int64)
+        requests.append(((numpy.empty(16, numpy.int64), a), (a.sum(0),)))
+
+    statistics, errors = serve_simultaneous_requests(
+        ctx, str(tmpdir.join('server.sock')), Reduce, requests, prepare_kwds=dict(axis=0))
+
+    assert len(errors) == 0
+    assert statistics['requests'] == len(requests)
+    assert statistics['batched_calls'] == 0
+
+
+def test_save_load(ctx, tmpdir):
+    """
+    Check that a saved computation can be loaded into another context and executed.
+    """
+    from tigger.core.plan import save_computation, load_computation
+
+    N = 1024
+    coeff = numpy.float32(2)
+    A = get_test_array(N, numpy.float32)
+    B = get_test_array(N, numpy.float32)
+    gpu_A = ctx.to_device(A)
+    gpu_B = ctx.to_device(B)
+    gpu_C = ctx.allocate(N, numpy.float32)
+    gpu_D = ctx.allocate(N, numpy.float32)
+
+    # the nested computation takes the arguments in a different order
+    D, C = mock_dummy(B, A, coeff)
+
+    def fail_compile(*args, **kwds):
+        raise AssertionError("A kernel was compiled while loading")
+
+    for keep_binaries in (True, False):
+        d = DummyNested(ctx, keep_binaries=keep_binaries).prepare_for(
+            gpu_C, gpu_D, gpu_A, gpu_B, coeff)
+        path = str(tmpdir.join('computation.pkl'))
+        save_computation(d, path)
+
+        load_ctx = ctx.api.Context(ctx._context)
+        if keep_binaries:
+            # kernels are loaded from the saved binaries
+            load_ctx._compile = fail_compile
+        loaded = load_computation(load_ctx, path)
+        assert loaded.name == 'DummyNested'
+        assert loaded.signature_str() == d.signature_str()
+
+        load_A = load_ctx.to_device(A)
+        load_B = load_ctx.to_device(B)
+        load_C = load_ctx.allocate(N, numpy.float32)
+        load_D = load_ctx.allocate(N, numpy.float32)
+        loaded(load_C, load_D, load_A, load_B, coeff)
+
+        assert diff_is_negligible(load_ctx.from_device(load_C), C)
+        assert diff_is_negligible(load_ctx.from_device(load_D), D)
+
+
+def test_template_cache():
+    """
+    Check that templates created from the same source are reused.
+    """
+    src = "<%def name='test(x)'>${x}</%def>"
+    template = template_from(src)
+    assert template_from(src) is template
+    assert template.get_def('test').render(1).strip() == "1"
@@ -0,0 +1,206 @@
+"""
+Ahead-of-time preparation of computations.
+
+A bundle contains compiled kernel binaries and tuning results
+(workgroup size limits found by the ``OutOfResourcesError`` fallback)
+for a list of computation specifications and a particular device.
+A process loading the bundle prepares the same computations
+without compiling anything.
+
+Specifications are dictionaries (usually stored in a JSON file) with the following keys:
+
+* ``computation``: a computation class or its full name (e.g. ``"tigger.fft.FFT"``);
+* ``argnames`` (optional): a list ``[outputs, inputs, scalars]`` for
+  :py:meth:`~tigger.elementwise.Elementwise.set_argnames`;
+* ``connect`` (optional): a list of dictionaries with keys
+  ``transformation`` (a :py:class:`~tigger.core.Transformation` object,
+  or a full name of one, or of a function returning one, e.g. ``"tigger.transformations.scale_param"``),
+  ``args`` (optional arguments for this function), ``array_arg``,
+  ``new_array_args`` and ``new_scalar_args`` (optional),
+  passed to :py:meth:`~tigger.core.Computation.connect`;
+* ``args``: a list of arguments for :py:meth:`~tigger.core.Computation.prepare_for`,
+  where arrays are described as ``{"shape": [...], "dtype": "..."}``
+  and scalars as ``{"dtype": "..."}``;
+* ``kwds`` (optional): keyword arguments for :py:meth:`~tigger.core.Computation.prepare_for`.
+
+Command line usage::
+
+    python -m tigger.bundle specs.json bundle.pkl --api ocl --device Tesla
+"""
+
+from __future__ import print_function
+
+import argparse
+import importlib
+import json
+import pickle
+import re
+import sys
+
+import numpy
+
+import tigger.cluda as cluda
+from tigger.core import Transformation, ArrayValue, ScalarValue
+import tigger.core.computation as computation
+
+
+FORMAT_VERSION = 1
+
+
+class Bundle:
+    """
+    Compiled kernels and tuning results for a device.
+
+    .. py:attribute:: binaries
+
+        Dictionary with kernel binaries, used as a
+        :py:attr:`~tigger.cluda.api.Context.binary_cache` of the context.
+
+    .. py:attribute:: work_group_size_limits
+
+        Dictionary with the workgroup size limits found for computations.
+    """
+
+    def __init__(self, api_id, device_name, binaries=None, work_group_size_limits=None):
+        self.api_id = api_id
+        self.device_name = device_name
+        self.binaries = {} if binaries is None else binaries
+        self.work_group_size_limits = {} if work_group_size_limits is None \
+            else work_group_size_limits
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        if data['version'] != FORMAT_VERSION:
+            raise ValueError("Unsupported bundle format version: " + str(data['version']))
+        return cls(data['api_id'], data['device_name'],
+            binaries=data['binaries'], work_group_size_limits=data['work_group_size_limits'])
+
+    def save(self, path):
+        data = dict(version=FORMAT_VERSION,
+            api_id=self.api_id, device_name=self.device_name,
+            binaries=self.binaries, work_group_size_limits=self.work_group_size_limits)
+        with open(path, 'wb') as f:
+            pickle.dump(data, f, protocol=2)
+
+    def attach(self, ctx):
+        """
+        Makes the context use the binaries and tuning results from the bundle.
+        Kernels missing from the bundle are compiled as usual and added to it.
+        """
+        if ctx.api.API_ID != self.api_id or ctx.device_params.name != self.device_name:
+            raise ValueError("The bundle was built for " + self.api_id + ":" + self.device_name +
+                ", got " + ctx.api.API_ID + ":" + ctx.device_params.name)
+        ctx.binary_cache = self.binaries
+        for key, limit in self.work_group_size_limits.items():
+            computation.set_work_group_size_limit(key, limit)
+
+
+def resolve_name(name):
+    """
+    Returns the object with the given full name (e.g. ``"tigger.fft.FFT"``).
+    """
+    module_name, _, attr = name.rpartition('.')
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def _value(arg):
+    if 'shape' in arg:
+        return ArrayValue(tuple(arg['shape']), numpy.dtype(arg['dtype']))
+    else:
+        return ScalarValue(numpy.dtype(arg['dtype']))
+
+
+def prepare_spec(ctx, spec):
+    """
+    Creates and prepares the computation according to the specification ``spec``.
+    """
+    # Classes and transformation factories can be given either directly or by their names
+    cls = spec['computation']
+    if not callable(cls):
+        cls = resolve_name(cls)
+
+    comp = cls(ctx)
+    if 'argnames' in spec:
+        comp.set_argnames(*spec['argnames'])
+
+    for connection in spec.get('connect', []):
+        tr = connection['transformation']
+        if not isinstance(tr, Transformation) and not callable(tr):
+            tr = resolve_name(tr)
+        if not isinstance(tr, Transformation):
+            tr = tr(*connection.get('args', []))
+        comp.connect(tr, connection['array_arg'], connection['new_array_args'],
+            connection.get('new_scalar_args'))
+
+    args = [_value(arg) for arg in spec['args']]
+    return comp.prepare_for(*args, **spec.get('kwds', {}))
+
+
+def build_bundle(ctx, specs, log=None):
+    """
+    Prepares computations for all the specifications in ``specs``
+    and returns a :py:class:`Bundle` object with the results.
+    """
+    bundle = Bundle(ctx.api.API_ID, ctx.device_params.name)
+
+    old_binary_cache = ctx.binary_cache
+    ctx.binary_cache = bundle.binaries
+    try:
+        for spec in specs:
+            comp = prepare_spec(ctx, spec)
+            if log is not None:
+                log(comp.__class__.__name__ + " " + comp.signature_str())
+    finally:
+        ctx.binary_cache = old_binary_cache
+
+    # Only the limits which can be restored in another process are saved
+    # (the keys contain computation classes, which may not be picklable).
+    for key, limit in computation.work_group_size_limits():
+        if key[:2] != (bundle.api_id, bundle.device_name):
+            continue
+        try:
+            pickle.dumps(key, protocol=2)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            continue
+        bundle.work_group_size_limits[key] = limit
+
+    return bundle
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m tigger.bundle",
+        description="Prepares computations from a JSON file with specifications "
+            "and saves compiled kernels and tuning results to a bundle file.")
+    parser.add_argument('specs', help="JSON file with a list of computation specifications")
+    parser.add_argument('output', help="bundle file to create")
+    parser.add_argument('--api', choices=cluda.APIS,
+        help="API to use (the first supported one by default)")
+    parser.add_argument('--device',
+        help="regular expression to match the device name against (the first device by default)")
+    args = parser.parse_args(argv)
+
+    api_id = args.api if args.api is not None else cluda.supported_apis()[0]
+    api = cluda.api(api_id)
+
+    devices = [device for platform in api.get_platforms() for device in platform.get_devices()
+        if args.device is None or re.search(args.device, device.name)]
+    if len(devices) == 0:
+        parser.error("No matching devices found")
+
+    with open(args.specs) as f:
+        specs = json.load(f)
+
+    ctx = api.Context.create(device=devices[0])
+    print("Device " + api_id + ":" + ctx.device_params.name)
+    bundle = build_bundle(ctx, specs, log=lambda s: print("  " + s))
+    bundle.save(args.output)
+    print("Saved " + str(len(bundle.binaries)) + " kernels to " + args.output)
+    ctx.release()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
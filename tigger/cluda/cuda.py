@@ -1,16 +1,21 @@
 import itertools
-from logging import error
+from logging import error, debug, warning
+import time
 
 import numpy
 import pycuda.gpuarray as gpuarray
 import pycuda.driver as cuda
-from pycuda.compiler import SourceModule
+from pycuda.compiler import SourceModule, compile as compile_cubin
 from pycuda.tools import DeviceData
 
 import tigger.cluda as cluda
 import tigger.cluda.dtypes as dtypes
-from tigger.helpers import factors, wrap_in_tuple, product
+from tigger.helpers import factors, wrap_in_tuple, product, timed_phase
 from tigger.cluda.kernel import render_prelude, render_template_source
+from tigger.cluda.source import compact_source, binary_key
+from tigger.cluda.memory import HostPool, check_host_transfer
+from tigger.cluda.queues import ThreadQueues
+from tigger.cluda.events import WAITER, future_for
 from tigger.cluda.vsize import VirtualSizes, render_stub_vsize_funcs
 
 
@@ -60,16 +65,32 @@ class Context:
         kwds['owns_context'] = True
         return cls(ctx, **kwds)
 
-    def __init__(self, context, queue=None, fast_math=True, async=True, owns_context=False):
+    def __init__(self, context, queue=None, fast_math=True, async=True, owns_context=False,
+            occupancy=True, profile=False, compact_source=True, binary_cache=None,
+            thread_queues=False):
         self.api = cluda.api(API_ID)
         self._fast_math = fast_math
+        self._compact_source = compact_source
+        self.binary_cache = binary_cache
+        # PyCUDA needs the context to be current in the thread where a module is loaded
+        self.compile_threads = 1
+        self._occupancy = occupancy
+        self._profile = profile
         self._context = context
         self._async = async
         self.device_params = DeviceParameters(context.get_device())
 
-        self._stream = self.create_queue() if queue is None else queue
+        self._streams = ThreadQueues(self.create_queue() if queue is None else queue,
+            create_queue=cuda.Stream if thread_queues else None)
+        self.host_pool = HostPool(cuda.pagelocked_empty)
         self._released = False if owns_context else True
 
+        if self._profile:
+            # CUDA events only provide relative times,
+            # so all the profiling times are measured from this event.
+            self._profiling_origin = cuda.Event()
+            self._profiling_origin.record(self._streams.default_queue)
+
     def override_device_params(self, **kwds):
         for kwd in kwds:
             if hasattr(self.device_params, kwd):
@@ -80,6 +101,13 @@ class Context:
     def create_queue(self):
         return cuda.Stream()
 
+    @property
+    def _stream(self):
+        return self._streams.current()
+
+    def use_queue(self, queue):
+        return self._streams.use(queue)
+
     def supports_dtype(self, dtype):
         if dtypes.is_double(dtype):
             major, minor = self._context.get_device().compute_capability()
@@ -114,6 +142,36 @@ class Context:
         if dest is None:
             return arr_cpu
 
+    def wrap_host(self, arr):
+        # Zero-copy is not supported for CUDA yet
+        return self.to_device(arr)
+
+    def allocate_host(self, shape, dtype):
+        return cuda.pagelocked_empty(shape, dtype)
+
+    def to_device_async(self, arr, dest):
+        check_host_transfer(arr, dest)
+        cuda.memcpy_htod_async(dest.gpudata, arr, stream=self._stream)
+        return self._record_event(arr, result=dest)
+
+    def from_device_async(self, arr, dest=None):
+        if dest is None:
+            dest = self.allocate_host(arr.shape, arr.dtype)
+        check_host_transfer(dest, arr)
+        cuda.memcpy_dtoh_async(dest, arr.gpudata, stream=self._stream)
+        return self._record_event(dest, result=dest)
+
+    def record_event(self):
+        return self._record_event()
+
+    def wait_for_event(self, event):
+        self._stream.wait_for_event(event._event)
+
+    def _record_event(self, host_arr=None, result=None):
+        event = cuda.Event()
+        event.record(self._stream)
+        return Event(self._context, event, host_arr, result=result)
+
     def copy_array(self, arr, dest=None, src_offset=0, dest_offset=0, size=None):
 
         if dest is None:
@@ -141,26 +199,58 @@ class Context:
         if not self._async:
             self.synchronize()
 
-    def _compile(self, src):
+    def _process_source(self, src):
+        if self._compact_source:
+            with timed_phase('compact'):
+                return compact_source(src)
+        else:
+            return src
+
+    def _compile(self, src, keep_binary=False):
+        # If ``keep_binary`` is ``True``, returns the binary of the module together with it
+        # (SourceModule does not keep it, so the module is loaded from a cubin in this case).
         options = ['-use_fast_math'] if self._fast_math else []
+        binary_cache = self.binary_cache
+        binary = None
         try:
-            module = SourceModule(src, no_extern_c=True, options=options)
+            if binary_cache is None and not keep_binary:
+                module = SourceModule(src, no_extern_c=True, options=options)
+            else:
+                if binary_cache is None:
+                    binary = compile_cubin(src, no_extern_c=True, options=options)
+                else:
+                    key = binary_key(API_ID, self.device_params.name, options, src)
+                    if key not in binary_cache:
+                        binary_cache[key] = compile_cubin(src, no_extern_c=True, options=options)
+                    binary = binary_cache[key]
+                module = self._load_binary(binary)
         except:
             listing = "\n".join([str(i+1) + ":" + l for i, l in enumerate(src.split('\n'))])
             error("Failed to compile:\n" + listing)
             raise
+        if keep_binary:
+            return module, binary
         return module
 
+    def _load_binary(self, binary):
+        return cuda.module_from_buffer(binary)
+
     def compile(self, template_src, render_kwds=None):
         return Module(self, template_src, render_kwds=render_kwds)
 
     def compile_static(self, template_src, name, global_size,
-            local_size=None, local_mem=0, render_kwds=None):
+            local_size=None, local_mem=0, render_kwds=None, persistent=False,
+            max_work_group_size=None, keep_binary=False):
         return StaticKernel(self, template_src, name, global_size,
-            local_size=local_size, render_kwds=render_kwds)
+            local_size=local_size, render_kwds=render_kwds, persistent=persistent,
+            max_work_group_size=max_work_group_size, keep_binary=keep_binary)
+
+    def load_static(self, name, source, global_size, local_size, binary=None):
+        return LoadedStaticKernel(self, name, source, global_size, local_size, binary=binary)
 
     def release(self):
         if not self._released:
+            self.host_pool.clear()
             self._context.detach()
             self._released = True
 
@@ -168,10 +258,47 @@ class Context:
         self.release()
 
 
+class Event:
+
+    def __init__(self, context, event, host_arr=None, result=None):
+        self._context = context
+        self._event = event
+        # The host array taking part in the transfer must not be deleted before it is finished
+        self._host_arr = host_arr
+        self.result = result
+
+    def is_done(self):
+        return self._event.query()
+
+    def wait(self):
+        self._event.synchronize()
+        self._host_arr = None
+        return self.result
+
+    def _wait_in_thread(self):
+        # The helper thread does not have a current context by default
+        self._context.push()
+        try:
+            self._event.synchronize()
+        finally:
+            cuda.Context.pop()
+        self._host_arr = None
+
+    def _add_callback(self, callback):
+        # CUDA does not have host callbacks for events, so a helper thread waits for them.
+        # The bound method keeps the event (and the host array in it) alive until it is completed.
+        WAITER.call_when_done(self._wait_in_thread, callback)
+
+    def __await__(self):
+        return future_for(self._add_callback, self.result).__await__()
+
+
 class DeviceParameters:
 
     def __init__(self, device):
 
+        self.name = device.name()
+
         self.max_work_group_size = device.max_threads_per_block
         self.max_work_item_sizes = [
             device.max_block_dim_x,
@@ -192,6 +319,14 @@ class DeviceParameters:
         self.min_mem_coalesce_width = {
             size:devdata.align_words(word_size=size) for size in [4, 8, 16]}
         self.local_mem_size = device.max_shared_memory_per_block
+        self.compute_units = device.multiprocessor_count
+        self.host_unified_memory = bool(device.get_attribute(cuda.device_attribute.INTEGRATED))
+
+        # Limits used by the occupancy model
+        self.max_work_groups_per_unit = devdata.thread_blocks_per_mp
+        self.max_work_items_per_unit = devdata.warps_per_mp * devdata.warp_size
+        self.registers_per_unit = devdata.registers
+        self.local_mem_per_unit = devdata.shared_memory
 
 
 class Module:
@@ -204,7 +339,7 @@ class Module:
         prelude = render_prelude(self._ctx)
         src = render_template_source(src, **render_kwds)
 
-        self.source = prelude + src
+        self.source = ctx._process_source(prelude + src)
         self._module = ctx._compile(self.source)
 
     def __getattr__(self, name):
@@ -273,7 +408,8 @@ class Kernel:
 
 class StaticKernel:
 
-    def __init__(self, ctx, src, name, global_size, local_size=None, render_kwds=None):
+    def __init__(self, ctx, src, name, global_size, local_size=None, render_kwds=None,
+            persistent=False, max_work_group_size=None, keep_binary=False):
         self._ctx = ctx
 
         if render_kwds is None:
@@ -285,26 +421,119 @@ class StaticKernel:
 
         # We need the first approximation of the maximum thread number for a kernel.
         # Stub virtual size functions instead of real ones will not change it (hopefully).
-        stub_module = ctx._compile(str(prelude + stub_vsize_funcs + src))
+        stub_src = str(ctx._process_source(prelude + stub_vsize_funcs + src))
+        with timed_phase('stub_compile'):
+            stub_module = ctx._compile(stub_src)
         stub_kernel = stub_module.get_function(name)
-        max_work_group_size = stub_kernel.get_attribute(
+        stub_max_work_group_size = stub_kernel.get_attribute(
             cuda.function_attribute.MAX_THREADS_PER_BLOCK)
-
-        vs = VirtualSizes(ctx.device_params, max_work_group_size, global_size, local_size)
+        if max_work_group_size is not None:
+            stub_max_work_group_size = min(stub_max_work_group_size, max_work_group_size)
+        registers = stub_kernel.get_attribute(cuda.function_attribute.NUM_REGS)
+        local_mem = stub_kernel.get_attribute(cuda.function_attribute.SHARED_SIZE_BYTES)
+
+        vs = VirtualSizes(ctx.device_params, stub_max_work_group_size, global_size, local_size,
+            persistent=persistent, registers=registers, local_mem=local_mem,
+            use_occupancy=ctx._occupancy)
+        self.local_size_report = vs.local_size_report
+        debug(name + ": " + self.local_size_report)
         static_prelude = vs.render_vsize_funcs()
-        self._global_size, self._local_size = vs.get_call_sizes()
-        self._grid = tuple(g // l for g, l in zip(self._global_size, self._local_size))
+        self.global_size, self.local_size = vs.get_call_sizes()
 
-        self.source = prelude + static_prelude + src
-        self._module = ctx._compile(self.source)
+        self.source = ctx._process_source(prelude + static_prelude + src)
+        with timed_phase('compile'):
+            if keep_binary:
+                self._module, self.binary = ctx._compile(self.source, keep_binary=True)
+            else:
+                self._module = ctx._compile(self.source)
+                self.binary = None
+
+        self._set_kernel(name)
 
+    def _set_kernel(self, name):
+        self._grid = tuple(g // l for g, l in zip(self.global_size, self.local_size))
         self._kernel = self._module.get_function(name)
 
+        # The kernel is prepared for the argument types on the first call,
+        # which allows the subsequent calls to use the faster prepared call path.
+        self._prepared = False
+
         self.max_work_group_size = self._kernel.get_attribute(
             cuda.function_attribute.MAX_THREADS_PER_BLOCK)
-        if self.max_work_group_size < product(self._local_size):
+        if self.max_work_group_size < product(self.local_size):
             raise cluda.OutOfResourcesError("Not enough registers/local memory for this local size")
 
+    def _launch(self, args):
+        if not self._prepared:
+            self._kernel.prepare([_prepared_arg_type(arg) for arg in args])
+            self._prepared = True
+        args = [arg.gpudata if isinstance(arg, gpuarray.GPUArray) else arg for arg in args]
+        self._kernel.prepared_async_call(self._grid, self.local_size, self._ctx._stream, *args)
+
     def __call__(self, *args):
-        self._kernel(*args, grid=self._grid, block=self._local_size, stream=self._ctx._stream)
-        self._ctx._synchronize()
+        if self._ctx._profile:
+            start = cuda.Event()
+            end = cuda.Event()
+            launch_start = time.time()
+            start.record(self._ctx._stream)
+            self._launch(args)
+            end.record(self._ctx._stream)
+            launch_time = time.time() - launch_start
+            self._ctx._synchronize()
+            return ProfilingEvent(self._ctx._profiling_origin, start, end, launch_time,
+                self.global_size, self.local_size)
+        else:
+            self._launch(args)
+            self._ctx._synchronize()
+
+
+class LoadedStaticKernel(StaticKernel):
+
+    def __init__(self, ctx, name, source, global_size, local_size, binary=None):
+        self._ctx = ctx
+        self.source = source
+        self.global_size = tuple(global_size)
+        self.local_size = tuple(local_size)
+        self.local_size_report = "loaded with the saved call sizes"
+        self.binary = binary
+
+        self._module = None
+        if binary is not None:
+            try:
+                self._module = ctx._load_binary(binary)
+            except cuda.Error as e:
+                warning(name + ": cannot load the saved binary (" + str(e) + "), recompiling")
+        else:
+            warning(name + ": no saved binary, recompiling")
+
+        if self._module is None:
+            # The new binary is kept, so that the kernel could be saved again
+            with timed_phase('compile'):
+                self._module, self.binary = ctx._compile(self.source, keep_binary=True)
+
+        self._set_kernel(name)
+
+
+def _prepared_arg_type(arg):
+    if isinstance(arg, (gpuarray.GPUArray, cuda.DeviceAllocation)):
+        return 'P'
+    else:
+        return arg.dtype
+
+
+class ProfilingEvent:
+
+    def __init__(self, origin, start, end, launch_time, global_size, local_size):
+        self._origin = origin
+        self._start = start
+        self._end = end
+        self.launch_time = launch_time
+        self.global_size = global_size
+        self.local_size = local_size
+
+    def get_times(self):
+        self._end.synchronize()
+        # time_since() returns milliseconds
+        return (
+            self._start.time_since(self._origin) * 1e-3,
+            self._end.time_since(self._origin) * 1e-3)
@@ -0,0 +1,79 @@
+"""
+API-independent helpers for waiting for device events in ``asyncio`` event loops.
+"""
+
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class Waiter:
+    """
+    Calls blocking wait functions in a helper thread,
+    and the corresponding callbacks after they return.
+    The thread is started on the first call to :py:meth:`call_when_done`.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _run(self):
+        while True:
+            wait, callback = self._queue.get()
+            try:
+                wait()
+            except Exception as e:
+                error = e
+            else:
+                error = None
+
+            # The thread serves all the waits, so it must survive any errors
+            try:
+                callback(error)
+            except Exception:
+                logging.exception("Error in an event callback")
+
+    def call_when_done(self, wait, callback):
+        """
+        Calls ``callback(error)`` in the helper thread after ``wait()`` returns,
+        where ``error`` is the exception raised by ``wait()``, or ``None``.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put((wait, callback))
+
+
+WAITER = Waiter()
+
+
+def _set_result(future, result, error):
+    if future.done():
+        return
+    if error is None:
+        future.set_result(result)
+    else:
+        future.set_exception(error)
+
+
+def future_for(add_callback, result=None):
+    """
+    Returns an ``asyncio`` future attached to the current event loop.
+    ``add_callback`` is given a function taking an exception (or ``None``),
+    which can be called from any thread;
+    the future is resolved with ``result``, or fails with the given exception.
+    """
+    import asyncio
+
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+    add_callback(lambda error=None: loop.call_soon_threadsafe(_set_result, future, result, error))
+    return future
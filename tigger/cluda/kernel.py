@@ -2,11 +2,9 @@ import os.path
 from logging import error
 
 import numpy
-from mako.template import Template
-from mako import exceptions
 
 from tigger.cluda import dtypes
-from tigger.helpers import template_for
+from tigger.helpers import template_for, template_from, timed_phase
 
 TEMPLATE = template_for(__file__)
 
@@ -90,7 +88,8 @@ class FuncCollector:
 
     def render(self):
         src = []
-        for func_name, params in self.functions.items():
+        # sorting to make the source independent of the order of function requests
+        for func_name, params in sorted(self.functions.items()):
             tmpl_name, args = params
             src.append(TEMPLATE.get_def(tmpl_name).render(func_name, *args, dtypes=dtypes))
         return "\n".join(src)
@@ -108,14 +107,18 @@ def render_without_funcs(template, func_c, *args, **kwds):
     try:
         src = template.render(*args, **render_kwds)
     except:
+        from mako import exceptions
         error("Failed to render template:\n" + exceptions.text_error_template().render())
         raise Exception("Template rendering failed")
     return src
 
 def render_template_source(template_src, *args, **kwds):
-    return render_template(Template(template_src), *args, **kwds)
+    with timed_phase('render'):
+        template = template_from(template_src)
+    return render_template(template, *args, **kwds)
 
 def render_template(template, *args, **kwds):
-    func_c = FuncCollector()
-    src = render_without_funcs(template, func_c, *args, **kwds)
-    return func_c.render() + src
+    with timed_phase('render'):
+        func_c = FuncCollector()
+        src = render_without_funcs(template, func_c, *args, **kwds)
+        return func_c.render() + src
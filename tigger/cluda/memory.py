@@ -0,0 +1,71 @@
+"""
+API-independent memory management helpers.
+"""
+
+import threading
+
+import numpy
+
+from tigger.helpers import wrap_in_tuple
+
+
+class HostPool:
+    """
+    Pool of page-locked host arrays.
+    Arrays returned with :py:meth:`free` are reused by subsequent
+    :py:meth:`allocate` calls with the same shape and dtype,
+    which avoids the (rather expensive) page-locked allocations in loops.
+    """
+
+    def __init__(self, allocate_host):
+        self._allocate_host = allocate_host
+        self._free = {}
+        self._lock = threading.Lock()
+
+    def allocate(self, shape, dtype):
+        """
+        Returns a page-locked array with the given ``shape`` and ``dtype``.
+        """
+        key = (wrap_in_tuple(shape), numpy.dtype(dtype))
+        with self._lock:
+            arrays = self._free.get(key)
+            if arrays:
+                return arrays.pop()
+        return self._allocate_host(shape, dtype)
+
+    def free(self, arr):
+        """
+        Returns the array, previously obtained from :py:meth:`allocate`, to the pool.
+        """
+        key = (arr.shape, arr.dtype)
+        with self._lock:
+            self._free.setdefault(key, []).append(arr)
+
+    @property
+    def held_bytes(self):
+        """
+        Total size of the arrays currently held in the pool.
+        """
+        with self._lock:
+            return sum(arr.nbytes for arrays in self._free.values() for arr in arrays)
+
+    def clear(self):
+        """
+        Releases all the arrays held in the pool.
+        """
+        with self._lock:
+            self._free = {}
+
+
+def check_host_transfer(host_arr, device_arr):
+    """
+    Checks that the host array can be used in an asynchronous transfer
+    to or from the device array.
+    """
+    if host_arr.shape != device_arr.shape or host_arr.dtype != device_arr.dtype:
+        raise ValueError(
+            "Host and device arrays must have the same shape and dtype, got " +
+            str((host_arr.shape, host_arr.dtype)) + " and " +
+            str((device_arr.shape, device_arr.dtype)))
+    if not host_arr.flags.c_contiguous:
+        raise ValueError("Host array must be C-contiguous")
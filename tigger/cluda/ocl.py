@@ -1,5 +1,10 @@
-from logging import error
+from logging import error, debug, warning
+import functools
+import multiprocessing
 import sys
+import threading
+import time
+import weakref
 
 import numpy
 import pyopencl as cl
@@ -7,8 +12,12 @@ import pyopencl.array as clarray
 
 import tigger.cluda as cluda
 import tigger.cluda.dtypes as dtypes
-from tigger.helpers import wrap_in_tuple, product
+from tigger.helpers import wrap_in_tuple, product, timed_phase
 from tigger.cluda.kernel import render_prelude, render_template_source
+from tigger.cluda.source import compact_source, binary_key
+from tigger.cluda.memory import HostPool, check_host_transfer
+from tigger.cluda.queues import ThreadQueues
+from tigger.cluda.events import WAITER, future_for
 from tigger.cluda.vsize import VirtualSizes, render_stub_vsize_funcs
 
 
@@ -48,15 +57,29 @@ class Context:
 
         return cls(ctx, **kwds)
 
-    def __init__(self, context, queue=None, fast_math=True, async=True, owns_context=False):
+    def __init__(self, context, queue=None, fast_math=True, async=True, owns_context=False,
+            occupancy=True, profile=False, compact_source=True, zero_copy=None,
+            compile_threads=None, binary_cache=None, thread_queues=False):
         self.api = cluda.api(API_ID)
         self._fast_math = fast_math
+        self._compact_source = compact_source
+        self.binary_cache = binary_cache
+        self.compile_threads = multiprocessing.cpu_count() if compile_threads is None \
+            else compile_threads
+        self._occupancy = occupancy
+        self._profile = profile
         self._context = context
         self._async = async
         self.device_params = DeviceParameters(context.get_info(cl.context_info.DEVICES)[0])
         self._device = self._context.devices[0]
-
-        self._queue = self.create_queue() if queue is None else queue
+        self._zero_copy = self.device_params.host_unified_memory if zero_copy is None else zero_copy
+
+        # Partial functions are used instead of bound methods to avoid reference cycles
+        default_queue = self.create_queue() if queue is None else queue
+        self._queues = ThreadQueues(default_queue,
+            create_queue=functools.partial(_create_queue, self._context, self._profile)
+                if thread_queues else None)
+        self.host_pool = HostPool(functools.partial(_allocate_host, self._context, default_queue))
         self._released = False if owns_context else True
 
     def override_device_params(self, **kwds):
@@ -67,7 +90,14 @@ class Context:
                 raise ValueError("Device parameter " + str(kwd) + " does not exist")
 
     def create_queue(self):
-        return cl.CommandQueue(self._context)
+        return _create_queue(self._context, self._profile)
+
+    @property
+    def _queue(self):
+        return self._queues.current()
+
+    def use_queue(self, queue):
+        return self._queues.use(queue)
 
     def supports_dtype(self, dtype):
         if dtypes.is_double(dtype):
@@ -77,7 +107,14 @@ class Context:
             return True
 
     def allocate(self, shape, dtype):
-        return clarray.Array(self._queue, shape, dtype=dtype)
+        if self._zero_copy:
+            return clarray.Array(self._queue, shape, dtype=dtype, allocator=self._allocate_buffer)
+        else:
+            return clarray.Array(self._queue, shape, dtype=dtype)
+
+    def _allocate_buffer(self, size):
+        return cl.Buffer(self._context,
+            cl.mem_flags.READ_WRITE | cl.mem_flags.ALLOC_HOST_PTR, size=size)
 
     def empty_like(self, arr):
         return self.allocate(arr.shape, arr.dtype)
@@ -88,16 +125,73 @@ class Context:
         else:
             arr_device = dest
 
-        arr_device.set(arr, queue=self._queue, async=self._async)
+        if self._shares_memory(arr_device, arr):
+            self._sync_shared(arr_device, cl.map_flags.WRITE)
+        else:
+            arr_device.set(arr, queue=self._queue, async=self._async)
 
         if dest is None:
             return arr_device
 
     def from_device(self, arr, dest=None, async=False):
+        if dest is not None and self._shares_memory(arr, dest):
+            self._sync_shared(arr, cl.map_flags.READ)
+            return
+
         arr_cpu = arr.get(queue=self._queue, ary=dest, async=async)
         if dest is None:
             return arr_cpu
 
+    def wrap_host(self, arr):
+        if not self._zero_copy:
+            return self.to_device(arr)
+
+        if not arr.flags.c_contiguous:
+            raise ValueError("Host array must be C-contiguous")
+        buf = cl.Buffer(self._context,
+            cl.mem_flags.READ_WRITE | cl.mem_flags.USE_HOST_PTR, hostbuf=arr)
+        return clarray.Array(self._queue, arr.shape, dtype=arr.dtype, data=buf)
+
+    def _shares_memory(self, arr_device, arr):
+        if not self._zero_copy or not isinstance(arr, numpy.ndarray):
+            return False
+        buf = arr_device.data
+        if not buf.get_info(cl.mem_info.FLAGS) & cl.mem_flags.USE_HOST_PTR:
+            return False
+        # PyOpenCL does not return the host pointer from get_info(),
+        # but the buffer keeps a reference to the host array it was created with.
+        hostbuf = numpy.asarray(buf.hostbuf)
+        return hostbuf.__array_interface__['data'][0] == arr.__array_interface__['data'][0]
+
+    def _sync_shared(self, arr_device, map_flags):
+        # Mapping and unmapping the buffer is the only portable way
+        # to make the changes visible on the other side.
+        view, _ = cl.enqueue_map_buffer(self._queue, arr_device.data, map_flags, 0,
+            arr_device.shape, arr_device.dtype)
+        view.base.release(queue=self._queue)
+        self._synchronize()
+
+    def allocate_host(self, shape, dtype):
+        return _allocate_host(self._context, self._queue, shape, dtype)
+
+    def to_device_async(self, arr, dest):
+        check_host_transfer(arr, dest)
+        event = cl.enqueue_copy(self._queue, dest.data, arr, is_blocking=False)
+        return Event(event, arr, result=dest)
+
+    def from_device_async(self, arr, dest=None):
+        if dest is None:
+            dest = self.allocate_host(arr.shape, arr.dtype)
+        check_host_transfer(dest, arr)
+        event = cl.enqueue_copy(self._queue, dest, arr.data, is_blocking=False)
+        return Event(event, dest, result=dest)
+
+    def record_event(self):
+        return Event(cl.enqueue_marker(self._queue))
+
+    def wait_for_event(self, event):
+        cl.enqueue_barrier(self._queue, wait_for=[event._event])
+
     def copy_array(self, arr, dest=None, src_offset=0, dest_offset=0, size=None):
         if dest is None:
             arr_device = self.empty_like(arr)
@@ -126,37 +220,129 @@ class Context:
 
     def release(self):
         if not self._released:
+            self.host_pool.clear()
             del self._device
-            del self._queue
+            del self._queues
             del self._context
             self._released = True
 
     def __del__(self):
         self.release()
 
-    def _compile(self, src):
-        options = "-cl-mad-enable -cl-fast-relaxed-math" if self._fast_math else ""
+    def _process_source(self, src):
+        if self._compact_source:
+            with timed_phase('compact'):
+                return compact_source(src)
+        else:
+            return src
+
+    def _compile_options(self):
+        return "-cl-mad-enable -cl-fast-relaxed-math" if self._fast_math else ""
+
+    def _compile(self, src, keep_binary=False):
+        # If ``keep_binary`` is ``True``, returns the binary of the module together with it.
+        options = self._compile_options()
+        binary_cache = self.binary_cache
         try:
-            module = cl.Program(self._context, src).build(options=options)
+            if binary_cache is None:
+                module = cl.Program(self._context, src).build(options=options)
+            else:
+                key = binary_key(API_ID, self.device_params.name, options, src)
+                if key in binary_cache:
+                    module = self._load_binary(binary_cache[key])
+                else:
+                    module = cl.Program(self._context, src).build(options=options)
+                    binary_cache[key] = module.get_info(cl.program_info.BINARIES)[0]
         except:
             listing = "\n".join([str(i+1) + ":" + l for i, l in enumerate(src.split('\n'))])
             error("Failed to compile:\n" + listing)
             raise
+        if keep_binary:
+            return module, module.get_info(cl.program_info.BINARIES)[0]
         return module
 
+    def _load_binary(self, binary):
+        return cl.Program(self._context, [self._device], [binary]).build(
+            options=self._compile_options())
+
     def compile(self, template_src, render_kwds=None):
         return Module(self, template_src, render_kwds=render_kwds)
 
     def compile_static(self, template_src, name, global_size,
-            local_size=None, render_kwds=None):
+            local_size=None, render_kwds=None, persistent=False, max_work_group_size=None,
+            keep_binary=False):
         return StaticKernel(self, template_src, name, global_size,
-            local_size=local_size, render_kwds=render_kwds)
+            local_size=local_size, render_kwds=render_kwds, persistent=persistent,
+            max_work_group_size=max_work_group_size, keep_binary=keep_binary)
+
+    def load_static(self, name, source, global_size, local_size, binary=None):
+        return LoadedStaticKernel(self, name, source, global_size, local_size, binary=binary)
+
+
+def _create_queue(context, profile):
+    if profile:
+        return cl.CommandQueue(context, properties=cl.command_queue_properties.PROFILING_ENABLE)
+    else:
+        return cl.CommandQueue(context)
+
+
+def _allocate_host(context, queue, shape, dtype):
+    # Buffers allocated with ALLOC_HOST_PTR are page-locked in all major implementations.
+    # The mapped array keeps a reference to the buffer, so it will live as long as the array.
+    dtype = numpy.dtype(dtype)
+    shape = wrap_in_tuple(shape)
+    buf = cl.Buffer(context, cl.mem_flags.READ_WRITE | cl.mem_flags.ALLOC_HOST_PTR,
+        size=max(product(shape), 1) * dtype.itemsize)
+    arr, event = cl.enqueue_map_buffer(queue, buf,
+        cl.map_flags.READ | cl.map_flags.WRITE, 0, shape, dtype)
+    event.wait()
+    return arr
+
+
+class Event:
+
+    def __init__(self, event, host_arr=None, result=None):
+        self._event = event
+        # The host array taking part in the transfer must not be deleted before it is finished
+        self._host_arr = host_arr
+        self.result = result
+
+    def is_done(self):
+        return self._event.command_execution_status == cl.command_execution_status.COMPLETE
+
+    def wait(self):
+        self._event.wait()
+        self._host_arr = None
+        return self.result
+
+    def _add_callback(self, callback):
+        # The host array is kept alive by the callbacks until the event is completed
+        # (by the default argument, or by the bound method)
+        try:
+            # Event callbacks are available since OpenCL 1.1
+            self._event.set_callback(cl.command_execution_status.COMPLETE,
+                lambda status, host_arr=self._host_arr: callback(_status_error(status)))
+        except (AttributeError, cl.Error):
+            WAITER.call_when_done(self.wait, callback)
+
+    def __await__(self):
+        return future_for(self._add_callback, self.result).__await__()
+
+
+def _status_error(status):
+    # Negative execution statuses are error codes
+    if status < 0:
+        return RuntimeError("The command failed with the status " + str(status))
+    else:
+        return None
 
 
 class DeviceParameters:
 
     def __init__(self, device):
 
+        self.name = device.name.strip()
+
         if device.platform.name == 'Apple' and device.type == cl.device_type.CPU:
         # Apple is being funny again.
         # On OSX 10.8.0 it reports the maximum block size as 1024, when it is really 128.
@@ -194,6 +380,37 @@ class DeviceParameters:
 
         self.min_mem_coalesce_width = {4: 16, 8: 16, 16: 8}
         self.local_mem_size = device.local_mem_size
+        self.compute_units = device.max_compute_units
+
+        # CL_DEVICE_HOST_UNIFIED_MEMORY is only available since OpenCL 1.1
+        try:
+            host_unified_memory = device.host_unified_memory
+        except (cl.LogicError, AttributeError):
+            host_unified_memory = False
+        self.host_unified_memory = bool(host_unified_memory) or device.type == cl.device_type.CPU
+
+        # Limits used by the occupancy model (``None`` if unknown).
+        # OpenCL does not provide a way to query them directly,
+        # so we are using NV extensions if available, or typical values for known vendors.
+        self.max_work_groups_per_unit = None
+        self.max_work_items_per_unit = None
+        self.registers_per_unit = None
+        self.local_mem_per_unit = None
+
+        if device.type == cl.device_type.CPU:
+            pass
+        elif "cl_nv_device_attribute_query" in device.extensions:
+            major = device.compute_capability_major_nv
+            self.max_work_groups_per_unit = 8 if major < 3 else 16
+            self.max_work_items_per_unit = {1: 768, 2: 1536}.get(major, 2048)
+            self.registers_per_unit = device.registers_per_block_nv
+            self.local_mem_per_unit = self.local_mem_size
+        elif ('Advanced Micro Devices' in device.vendor or
+                "cl_amd_device_attribute_query" in device.extensions):
+            # Typical values for AMD GCN devices
+            self.max_work_groups_per_unit = 40
+            self.max_work_items_per_unit = 2560
+            self.local_mem_per_unit = self.local_mem_size
 
 
 class Module:
@@ -209,7 +426,7 @@ class Module:
         # Casting source code to ASCII explicitly
         # New versions of Mako produce Unicode output by default,
         # and it makes OpenCL compiler unhappy
-        self.source = str(prelude + src)
+        self.source = str(ctx._process_source(prelude + src))
         self._module = ctx._compile(self.source)
 
     def __getattr__(self, name):
@@ -249,7 +466,8 @@ class Kernel:
 
 class StaticKernel:
 
-    def __init__(self, ctx, src, name, global_size, local_size=None, render_kwds=None):
+    def __init__(self, ctx, src, name, global_size, local_size=None, render_kwds=None,
+            persistent=False, max_work_group_size=None, keep_binary=False):
         self._ctx = ctx
 
         if render_kwds is None:
@@ -261,29 +479,151 @@ class StaticKernel:
 
         # We need the first approximation of the maximum thread number for a kernel.
         # Stub virtual size functions instead of real ones will not change it (hopefully).
-        stub_module = ctx._compile(str(prelude + stub_vsize_funcs + src))
+        stub_src = str(ctx._process_source(prelude + stub_vsize_funcs + src))
+        with timed_phase('stub_compile'):
+            stub_module = ctx._compile(stub_src)
         stub_kernel = getattr(stub_module, name)
-        max_work_group_size = stub_kernel.get_work_group_info(
+        stub_max_work_group_size = stub_kernel.get_work_group_info(
             cl.kernel_work_group_info.WORK_GROUP_SIZE, self._ctx._device)
+        if max_work_group_size is not None:
+            stub_max_work_group_size = min(stub_max_work_group_size, max_work_group_size)
 
-        vs = VirtualSizes(ctx.device_params, max_work_group_size, global_size, local_size)
+        # OpenCL does not report the register usage, only the local memory one
+        local_mem = stub_kernel.get_work_group_info(
+            cl.kernel_work_group_info.LOCAL_MEM_SIZE, self._ctx._device)
+
+        vs = VirtualSizes(ctx.device_params, stub_max_work_group_size, global_size, local_size,
+            persistent=persistent, local_mem=local_mem, use_occupancy=ctx._occupancy)
+        self.local_size_report = vs.local_size_report
+        debug(name + ": " + self.local_size_report)
         static_prelude = vs.render_vsize_funcs()
-        self._global_size, self._local_size = vs.get_call_sizes()
+        self.global_size, self.local_size = vs.get_call_sizes()
 
         # Casting source code to ASCII explicitly
         # New versions of Mako produce Unicode output by default,
         # and it makes OpenCL compiler unhappy
-        self.source = str(prelude + static_prelude + src)
-        self._module = ctx._compile(self.source)
+        self.source = str(ctx._process_source(prelude + static_prelude + src))
+        with timed_phase('compile'):
+            if keep_binary:
+                self._module, self.binary = ctx._compile(self.source, keep_binary=True)
+            else:
+                self._module = ctx._compile(self.source)
+                self.binary = None
+
+        self._set_kernel(name)
 
+    def _set_kernel(self, name):
         self._kernel = getattr(self._module, name)
 
+        # Arguments currently set in the kernel object (see _bound_arg()).
+        # The kernel object is not used anywhere else,
+        # so only the arguments that changed since the previous call have to be set again.
+        # Setting arguments and enqueueing must not be interleaved between threads.
+        self._bound_args = []
+        self._lock = threading.Lock()
+
         self.max_work_group_size = self._kernel.get_work_group_info(
             cl.kernel_work_group_info.WORK_GROUP_SIZE, self._ctx._device)
-        if self.max_work_group_size < product(self._local_size):
+        if self.max_work_group_size < product(self.local_size):
             raise cluda.OutOfResourcesError("Not enough registers/local memory for this local size")
 
+    def _set_args(self, args):
+        bound_args = self._bound_args
+        if len(bound_args) != len(args):
+            bound_args[:] = [None] * len(args)
+
+        for i, arg in enumerate(args):
+            bound_arg = bound_args[i]
+            if isinstance(bound_arg, weakref.ref):
+                if bound_arg() is arg:
+                    continue
+            # Scalars are usually new objects with the same value.
+            # Comparing bytes instead of values distinguishes, for example, 0.0 and -0.0.
+            elif bound_arg is not None and type(arg) is type(bound_arg) and \
+                    arg.tobytes() == bound_arg.tobytes():
+                continue
+            self._kernel.set_arg(i, _static_kernel_arg(arg))
+            bound_args[i] = _bound_arg(arg)
+
+    def _launch(self, args):
+        queue = self._ctx._queue
+        with self._lock:
+            self._set_args(args)
+            return cl.enqueue_nd_range_kernel(
+                queue, self._kernel, self.global_size, self.local_size)
+
     def __call__(self, *args):
-        args = [x.data if isinstance(x, clarray.Array) else x for x in args]
-        self._kernel(self._ctx._queue, self._global_size, self._local_size, *args)
-        self._ctx._synchronize()
+        if self._ctx._profile:
+            launch_start = time.time()
+            event = self._launch(args)
+            launch_time = time.time() - launch_start
+            self._ctx._synchronize()
+            return ProfilingEvent(event, launch_time, self.global_size, self.local_size)
+        else:
+            self._launch(args)
+            self._ctx._synchronize()
+
+
+class LoadedStaticKernel(StaticKernel):
+
+    def __init__(self, ctx, name, source, global_size, local_size, binary=None):
+        self._ctx = ctx
+        self.source = source
+        self.global_size = tuple(global_size)
+        self.local_size = tuple(local_size)
+        self.local_size_report = "loaded with the saved call sizes"
+        self.binary = binary
+
+        self._module = None
+        if binary is not None:
+            try:
+                self._module = ctx._load_binary(binary)
+            except cl.Error as e:
+                warning(name + ": cannot load the saved binary (" + str(e) + "), recompiling")
+        else:
+            warning(name + ": no saved binary, recompiling")
+
+        if self._module is None:
+            # The new binary is kept, so that the kernel could be saved again
+            with timed_phase('compile'):
+                self._module, self.binary = ctx._compile(self.source, keep_binary=True)
+
+        self._set_kernel(name)
+
+
+def _bound_arg(arg):
+    """
+    Returns the object used to check if the argument of a static kernel
+    has to be set again on the next call:
+    the value for numpy scalars, a weak reference for arrays
+    (so that they could be freed after the call), or ``None`` if neither is possible.
+    """
+    if isinstance(arg, numpy.generic):
+        return arg
+    try:
+        return weakref.ref(arg)
+    except TypeError:
+        return None
+
+
+def _static_kernel_arg(x):
+    if not isinstance(x, clarray.Array):
+        return x
+
+    # Views are passed as their base buffers;
+    # the offset is applied in the kernel (see ArrayValue.offset).
+    base_data = getattr(x, 'base_data', None)
+    return x.data if base_data is None else base_data
+
+
+class ProfilingEvent:
+
+    def __init__(self, event, launch_time, global_size, local_size):
+        self._event = event
+        self.launch_time = launch_time
+        self.global_size = global_size
+        self.local_size = local_size
+
+    def get_times(self):
+        self._event.wait()
+        return self._event.profile.start * 1e-9, self._event.profile.end * 1e-9
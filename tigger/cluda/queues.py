@@ -0,0 +1,47 @@
+"""
+API-independent helpers for using a context from several threads.
+"""
+
+import contextlib
+import threading
+
+
+class ThreadQueues:
+    """
+    Keeps track of the queue (a stream in case of CUDA) used by a context in every thread.
+
+    :param default_queue: the queue used by threads which do not have their own one.
+    :param create_queue: if given, a function creating a new queue,
+        which is called the first time the context is used in a thread.
+    """
+
+    def __init__(self, default_queue, create_queue=None):
+        self.default_queue = default_queue
+        self._create_queue = create_queue
+        self._local = threading.local()
+
+    def current(self):
+        """
+        Returns the queue for the current thread.
+        """
+        queue = getattr(self._local, 'queue', None)
+        if queue is not None:
+            return queue
+        elif self._create_queue is None:
+            return self.default_queue
+
+        queue = self._create_queue()
+        self._local.queue = queue
+        return queue
+
+    @contextlib.contextmanager
+    def use(self, queue):
+        """
+        Makes ``queue`` the queue for the current thread inside the ``with`` block.
+        """
+        previous = getattr(self._local, 'queue', None)
+        self._local.queue = queue
+        try:
+            yield queue
+        finally:
+            self._local.queue = previous
@@ -0,0 +1,160 @@
+"""
+Post-processing of the generated kernel sources before compilation.
+"""
+
+import re
+import collections
+import hashlib
+
+
+# String and character literals are matched too, so that comment markers inside them are ignored
+_COMMENT_RE = re.compile(
+    r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'',
+    re.DOTALL)
+
+_IDENTIFIER_RE = re.compile(r'\b[A-Za-z_]\w*\b')
+
+# Beginning of a helper function definition (up to the opening parenthesis of arguments)
+_FUNCTION_RE = re.compile(r'^WITHIN_KERNEL\b[\w\s\*]*?\b([A-Za-z_]\w*)\s*\(', re.MULTILINE)
+
+# Macro definition (the continuation lines are processed separately)
+_MACRO_RE = re.compile(r'^#\s*define\s+([A-Za-z_]\w*)', re.MULTILINE)
+
+
+def strip_comments(src):
+    """
+    Removes C and C++ style comments from ``src``.
+    """
+    def replace(match):
+        text = match.group(0)
+        if text.startswith('//'):
+            return ""
+        elif text.startswith('/*'):
+            # keep the line structure, it matters for the preprocessor
+            return " " + "\n" * text.count("\n")
+        else:
+            return text
+
+    return _COMMENT_RE.sub(replace, src)
+
+
+def strip_whitespace(src):
+    """
+    Removes leading and trailing whitespace from every line of ``src``,
+    and removes empty lines.
+    """
+    lines = [line.strip() for line in src.split("\n")]
+    return "\n".join(line for line in lines if len(line) > 0) + "\n"
+
+
+def _function_end(src, start):
+    """
+    Returns the position right after the body of the function whose definition
+    starts at ``start``, or ``None`` if it is only a declaration.
+    """
+    parentheses = 0
+    pos = start
+    length = len(src)
+
+    # skipping the argument list
+    while pos < length:
+        if src[pos] == '(':
+            parentheses += 1
+        elif src[pos] == ')':
+            parentheses -= 1
+            if parentheses == 0:
+                break
+        pos += 1
+
+    # the declaration ends with ';', the definition continues with the body
+    while pos < length and src[pos] not in '{;':
+        pos += 1
+    if pos == length or src[pos] == ';':
+        return None
+
+    braces = 0
+    while pos < length:
+        if src[pos] == '{':
+            braces += 1
+        elif src[pos] == '}':
+            braces -= 1
+            if braces == 0:
+                return pos + 1
+        pos += 1
+
+    return None
+
+
+def _macro_end(src, start):
+    """
+    Returns the position right after the macro definition starting at ``start``
+    (taking into account line continuations).
+    """
+    pos = start
+    while True:
+        end = src.find("\n", pos)
+        if end == -1:
+            return len(src)
+        if src[end - 1] != '\\':
+            return end + 1
+        pos = end + 1
+
+
+def remove_unused_definitions(src):
+    """
+    Removes helper functions (marked with ``WITHIN_KERNEL``) and macros from ``src``
+    which are not referenced anywhere else in it.
+    Should be applied to the source without comments and indentation.
+    """
+    while True:
+        definitions = []
+        for match in _FUNCTION_RE.finditer(src):
+            end = _function_end(src, match.start())
+            if end is not None:
+                definitions.append((match.start(), end, match.group(1)))
+        for match in _MACRO_RE.finditer(src):
+            definitions.append((match.start(), _macro_end(src, match.start()), match.group(1)))
+
+        counts = collections.Counter(_IDENTIFIER_RE.findall(src))
+
+        unused = []
+        for start, end, name in definitions:
+            own_counts = collections.Counter(_IDENTIFIER_RE.findall(src[start:end]))
+            if counts[name] == own_counts[name]:
+                unused.append((start, end))
+
+        if len(unused) == 0:
+            return src
+
+        # Removing one definition can make others unused,
+        # so the search is repeated until nothing changes.
+        parts = []
+        pos = 0
+        for start, end in sorted(unused):
+            if start < pos:
+                # nested in the previous definition (e.g. a macro inside a function)
+                continue
+            parts.append(src[pos:start])
+            pos = end
+        parts.append(src[pos:])
+        src = "".join(parts)
+
+
+def compact_source(src):
+    """
+    Returns the canonical form of the kernel source ``src``:
+    without comments, unused helper functions and macros, and unnecessary whitespace.
+    Equivalent sources produce identical results,
+    which also makes it faster to compile.
+    """
+    src = strip_whitespace(strip_comments(src))
+    return strip_whitespace(remove_unused_definitions(src))
+
+
+def binary_key(api_id, device_name, options, src):
+    """
+    Returns a string identifying the binary compiled from ``src``
+    with given compiler options for the given device.
+    """
+    parts = [api_id, device_name, repr(options), src]
+    return hashlib.sha1("\0".join(parts).encode('utf-8')).hexdigest()
@@ -1,4 +1,4 @@
-<%def name="normal_funcs()">
+<%def name="size_funcs()">
 
 WITHIN_KERNEL int virtual_local_id(int dim)
 {
@@ -18,6 +18,25 @@ WITHIN_KERNEL int virtual_num_groups(int dim)
     return 1;
 }
 
+WITHIN_KERNEL int virtual_global_size(int dim)
+{
+%for dim in range(len(vs.naive_bounding_grid)):
+    if(dim == ${dim}) return ${vs.global_size[dim] if dim < len(vs.global_size) else 1};
+%endfor
+    return 1;
+}
+
+WITHIN_KERNEL int virtual_global_flat_size()
+{
+    return virtual_global_size(0) * virtual_global_size(1) * virtual_global_size(2);
+}
+
+</%def>
+
+<%def name="normal_funcs()">
+
+${size_funcs()}
+
 WITHIN_KERNEL int virtual_group_id(int dim)
 {
 %for dim in range(len(vs.naive_bounding_grid)):
@@ -46,24 +65,11 @@ WITHIN_KERNEL int virtual_group_id(int dim)
     return 0;
 }
 
-WITHIN_KERNEL int virtual_global_size(int dim)
-{
-%for dim in range(len(vs.naive_bounding_grid)):
-    if(dim == ${dim}) return ${vs.global_size[dim] if dim < len(vs.global_size) else 1};
-%endfor
-    return 1;
-}
-
 WITHIN_KERNEL int virtual_global_id(int dim)
 {
     return virtual_local_id(dim) + virtual_group_id(dim) * virtual_local_size(dim);
 }
 
-WITHIN_KERNEL int virtual_global_flat_size()
-{
-    return virtual_global_size(0) * virtual_global_size(1) * virtual_global_size(2);
-}
-
 WITHIN_KERNEL int virtual_global_flat_id()
 {
     <%
@@ -108,6 +114,89 @@ WITHIN_KERNEL bool virtual_skip_workgroups()
 
 #define VIRTUAL_SKIP_THREADS if(virtual_skip_workgroups() || virtual_skip_threads()) return
 
+// Every virtual workgroup has its own real workgroup, so the loop is executed only once.
+#define VIRTUAL_GROUP_LOOP_BEGIN {
+#define VIRTUAL_GROUP_LOOP_END }
+
+</%def>
+
+<%def name="persistent_funcs()">
+
+${size_funcs()}
+
+<%
+    grid = vs.naive_bounding_grid
+    groups_num = product(grid)
+%>
+
+WITHIN_KERNEL int _virtual_group_id(int flat_group_id, int dim)
+{
+%for dim in range(len(grid)):
+    <%
+        width_lower = product(grid[:dim])
+        width_greater = product(grid[:dim+1])
+    %>
+    %if grid[dim] == 1:
+    if (dim == ${dim}) return 0;
+    %elif width_greater == groups_num:
+    if (dim == ${dim}) return flat_group_id / ${width_lower};
+    %else:
+    if (dim == ${dim}) return (flat_group_id / ${width_lower}) % ${grid[dim]};
+    %endif
+%endfor
+    return 0;
+}
+
+WITHIN_KERNEL int _virtual_global_id(int flat_group_id, int dim)
+{
+    return virtual_local_id(dim) + _virtual_group_id(flat_group_id, dim) * virtual_local_size(dim);
+}
+
+WITHIN_KERNEL int _virtual_global_flat_id(int flat_group_id)
+{
+    <%
+    def get_expr(dims):
+        if dims == 1:
+            return "_virtual_global_id(flat_group_id, 0)"
+        else:
+            return "{prev_expr} + _virtual_global_id(flat_group_id, {i}) * {w}".format(
+                prev_expr=get_expr(dims - 1), i=dims-1,
+                w=product(vs.global_size[:dims-1]))
+    %>
+    return ${get_expr(len(vs.global_size))};
+}
+
+WITHIN_KERNEL bool _virtual_skip_threads(int flat_group_id)
+{
+    if(
+    %for i in range(len(vs.global_size)):
+        %if vs.global_size[i] % vs.local_size[i] != 0:
+        _virtual_global_id(flat_group_id, ${i}) > ${vs.global_size[i]} - 1 ||
+        %endif
+    %endfor
+        false
+    ) return true;
+
+    return false;
+}
+
+// These refer to the loop variable of VIRTUAL_GROUP_LOOP_BEGIN,
+// so they can only be used in the kernel body, and not in separate functions.
+#define virtual_group_id(dim) _virtual_group_id(_virtual_flat_group_id, (dim))
+#define virtual_global_id(dim) _virtual_global_id(_virtual_flat_group_id, (dim))
+#define virtual_global_flat_id() _virtual_global_flat_id(_virtual_flat_group_id)
+
+// Real workgroups iterate over the virtual ones.
+// The loop bounds are the same for all the threads in a workgroup,
+// so LOCAL_BARRIER can be used inside the loop before VIRTUAL_SKIP_THREADS.
+// Skipped threads go to the next iteration right away,
+// so barriers after VIRTUAL_SKIP_THREADS lead to undefined behavior
+// (same as in the normal mode, where skipped threads return).
+#define VIRTUAL_GROUP_LOOP_BEGIN for(int _virtual_flat_group_id = get_group_id(0); _virtual_flat_group_id < ${groups_num}; _virtual_flat_group_id += get_num_groups(0)) {
+#define VIRTUAL_GROUP_LOOP_END }
+
+#define VIRTUAL_SKIP_THREADS if(_virtual_skip_threads(_virtual_flat_group_id)) continue
+
 </%def>
 
 <%def name="stub_funcs()">
@@ -133,4 +222,7 @@ WITHIN_KERNEL int virtual_global_flat_id()
 
 #define VIRTUAL_SKIP_THREADS
 
+#define VIRTUAL_GROUP_LOOP_BEGIN {
+#define VIRTUAL_GROUP_LOOP_END }
+
 </%def>
@@ -4,44 +4,123 @@ from tigger.helpers import *
 TEMPLATE = template_for(__file__)
 
 
-def find_local_size(device_params, max_workgroup_size, dims):
+def occupancy(device_params, group_size, registers=None, local_mem=None):
     """
-    Simple algorithm to find local_size with given limitations
+    Estimates how many workgroups of ``group_size`` work items can reside
+    on a single compute unit simultaneously, given that the kernel uses
+    ``registers`` registers per work item and ``local_mem`` bytes of local memory
+    per workgroup (``None`` means unknown).
+    Returns a tuple ``(groups, limited_by)``, where ``limited_by`` is the name
+    of the resource which limits the number of groups.
+    Device limits which are unknown (set to ``None``) are ignored.
     """
 
-    # shortcut for CPU devices
-    if device_params.warp_size == 1:
-        return [max_workgroup_size] + [1] * (dims - 1)
+    # Resources are allocated for the whole warps
+    warp_size = device_params.warp_size
+    allocated_size = min_blocks(group_size, warp_size) * warp_size
 
-    # trying to find local size with dimensions which are multiples of warp_size
-    unit = device_params.warp_size
-    max_dims = device_params.max_work_item_sizes
+    limits = []
 
-    sizes = [1]
-    for i in xrange(1, min_blocks(max_workgroup_size, unit)):
-        if i * unit <= max_workgroup_size:
-            sizes.append(i * unit)
+    if device_params.max_work_groups_per_unit is not None:
+        limits.append((device_params.max_work_groups_per_unit, 'workgroups'))
+    if device_params.max_work_items_per_unit is not None:
+        limits.append((device_params.max_work_items_per_unit // allocated_size, 'work items'))
+    if device_params.registers_per_unit is not None and registers:
+        limits.append((device_params.registers_per_unit // (registers * allocated_size),
+            'registers'))
+    if device_params.local_mem_per_unit is not None and local_mem:
+        limits.append((device_params.local_mem_per_unit // local_mem, 'local memory'))
 
-    total_size = lambda indices: product([sizes[i] for i in indices])
-    result_indices = [0] * dims
-    pos = 0
+    if len(limits) == 0:
+        return 1, None
 
-    while True:
-        result_indices[pos] += 1
+    return min(limits)
 
-        if result_indices[pos] < len(sizes) and total_size(result_indices) <= max_workgroup_size:
-            if sizes[result_indices[pos]] > max_dims[pos]:
-                result_indices[pos] -= 1
 
-                if pos == len(result_indices):
-                    break
+def _fit_local_size(device_params, total, dims):
+    """
+    Distributes ``total`` work items over ``dims`` dimensions of the local size,
+    filling the first dimension first.
+    """
+    max_dims = device_params.max_work_item_sizes
+    result = []
+    for dim in range(dims):
+        size = max(min(total, max_dims[dim]), 1)
+        result.append(size)
+        total //= size
+    return tuple(result)
 
-                pos += 1
-        else:
-            result_indices[pos] -= 1
-            break
 
-    return tuple([sizes[i] for i in result_indices])
+def _choose_local_size(device_params, max_workgroup_size, dims,
+        registers=None, local_mem=None, use_occupancy=True):
+    """
+    Returns the local size and the text report explaining the choice.
+    """
+
+    # shortcut for CPU devices
+    if device_params.warp_size == 1:
+        local_size = tuple([max_workgroup_size] + [1] * (dims - 1))
+        return local_size, (
+            "Local size " + str(local_size) + ": maximum workgroup size for a CPU device")
+
+    # local sizes with total number of work items being a multiple of warp_size
+    unit = device_params.warp_size
+    totals = [unit * i for i in range(1, max_workgroup_size // unit + 1)]
+    if len(totals) == 0:
+        totals = [max_workgroup_size]
+
+    candidates = []
+    for total in totals:
+        local_size = _fit_local_size(device_params, total, dims)
+        group_size = product(local_size)
+        groups, limited_by = occupancy(device_params, group_size,
+            registers=registers, local_mem=local_mem)
+        candidates.append((groups * group_size, group_size, local_size, groups, limited_by))
+
+    if use_occupancy:
+        # Maximizing the number of resident work items.
+        # Among the equal ones larger workgroups are preferred
+        # (this was the choice before the occupancy model was introduced).
+        best = max(candidates, key=lambda c: (c[0], c[1]))
+        header = "chosen by occupancy model"
+    else:
+        best = max(candidates, key=lambda c: c[1])
+        header = "maximum workgroup size (occupancy model disabled)"
+
+    resources = "kernel uses {regs} registers per work item, {lmem} bytes of local memory".format(
+        regs="unknown number of" if registers is None else registers,
+        lmem="unknown amount" if local_mem is None else local_mem)
+
+    lines = ["Local size " + str(best[2]) + ": " + header + "; " + resources]
+    for resident, group_size, local_size, groups, limited_by in sorted(
+            candidates, key=lambda c: (c[0], c[1]), reverse=True)[:5]:
+        lines.append("  {ls}: {g} workgroup(s) ({r} work items) per compute unit{lim}".format(
+            ls=local_size, g=groups, r=resident,
+            lim="" if limited_by is None else ", limited by " + limited_by))
+
+    return best[2], "\n".join(lines)
+
+
+def find_local_size(device_params, max_workgroup_size, dims,
+        registers=None, local_mem=None, use_occupancy=True):
+    """
+    Finds local size with given limitations.
+    If ``use_occupancy`` is ``True``, the local size which maximizes
+    the number of resident work items per compute unit is picked
+    (see :py:func:`occupancy`), otherwise the largest one.
+    """
+    local_size, _ = _choose_local_size(device_params, max_workgroup_size, dims,
+        registers=registers, local_mem=local_mem, use_occupancy=use_occupancy)
+    return local_size
+
+
+def persistent_num_groups(device_params, local_size):
+    """
+    Returns the number of workgroups of size ``local_size``
+    to launch for a kernel in the persistent mode.
+    """
+    groups_per_unit = max(1, (device_params.max_work_group_size * 2) // product(local_size))
+    return device_params.compute_units * groups_per_unit
 
 
 def render_stub_vsize_funcs():
@@ -50,13 +129,20 @@ def render_stub_vsize_funcs():
 
 class VirtualSizes:
 
-    def __init__(self, device_params, max_workgroup_size, global_size, local_size):
+    def __init__(self, device_params, max_workgroup_size, global_size, local_size,
+            persistent=False, registers=None, local_mem=None, use_occupancy=True):
         self.params = device_params
+        self.persistent = persistent
 
         self.global_size = wrap_in_tuple(global_size)
 
         if local_size is None:
-            local_size = find_local_size(device_params, max_workgroup_size, len(global_size))
+            local_size, self.local_size_report = _choose_local_size(
+                device_params, max_workgroup_size, len(self.global_size),
+                registers=registers, local_mem=local_mem, use_occupancy=use_occupancy)
+        else:
+            self.local_size_report = "Local size " + str(wrap_in_tuple(local_size)) + \
+                ": set explicitly"
 
         self.local_size = wrap_in_tuple(local_size)
 
@@ -70,13 +156,25 @@ class VirtualSizes:
 
         if product(self.local_size) > self.params.max_work_group_size:
             raise ValueError("Number of work items is too high")
-        if product(self.naive_bounding_grid) > product(self.params.max_num_groups):
-            raise ValueError("Number of work groups is too high")
 
-        self.grid_parts = self.get_rearranged_grid(self.naive_bounding_grid)
         gdims = len(self.params.max_num_groups)
-        self.grid = [product([row[i] for row in self.grid_parts])
-            for i in range(gdims)]
+
+        if persistent:
+            # Launching a fixed number of workgroups in the first dimension,
+            # which iterate over virtual workgroups in the kernel.
+            groups_num = min(
+                product(self.naive_bounding_grid),
+                persistent_num_groups(self.params, self.local_size),
+                self.params.max_num_groups[0])
+            self.grid = [groups_num] + [1] * (gdims - 1)
+        else:
+            if product(self.naive_bounding_grid) > product(self.params.max_num_groups):
+                raise ValueError("Number of work groups is too high")
+
+            self.grid_parts = self.get_rearranged_grid(self.naive_bounding_grid)
+            self.grid = [product([row[i] for row in self.grid_parts])
+                for i in range(gdims)]
+
         self.k_local_size = list(self.local_size) + [1] * (gdims - len(self.local_size))
         self.k_global_size = [l * g for l, g in zip(self.k_local_size, self.grid)]
 
@@ -167,7 +265,8 @@ class VirtualSizes:
         return [[f] + res[0]]
 
     def render_vsize_funcs(self):
-        return TEMPLATE.get_def('normal_funcs').render(vs=self, product=product)
+        defname = 'persistent_funcs' if self.persistent else 'normal_funcs'
+        return TEMPLATE.get_def(defname).render(vs=self, product=product)
 
     def get_call_sizes(self):
         return tuple(self.k_global_size), tuple(self.k_local_size)
@@ -1,11 +1,19 @@
+import collections
+import copy
 import numpy
 import os, os.path
+import threading
+import time
 
+from tigger.cluda import OutOfResourcesError
 from tigger.cluda.kernel import render_prelude, render_template
 from tigger.cluda.dtypes import ctype, cast
 import tigger.cluda.dtypes as dtypes
 from tigger.core.transformation import *
-from tigger.core.operation import OperationRecorder
+from tigger.core.operation import OperationRecorder, KernelCall, \
+    compilation_deferred, deferred_compilation, deferred_kernel_calls, build_kernel_calls
+from tigger.core.profiling import ProfilingReport
+from tigger.helpers import collect_phase_timings, timed_phase
 
 
 class InvalidStateError(Exception):
@@ -20,6 +28,55 @@ STATE_INITIALIZED = 1
 # Computation is fully prepared and ready to use
 STATE_PREPARED = 2
 
+# Maximum workgroup sizes which were found to work for computations
+# after _construct_operations() raised OutOfResourcesError.
+# Keys are produced by Computation._fallback_key().
+# Only MAX_WORK_GROUP_SIZE_LIMITS most recently used limits are kept.
+MAX_WORK_GROUP_SIZE_LIMITS = 1024
+_WORK_GROUP_SIZE_LIMITS = collections.OrderedDict()
+_work_group_size_limits_lock = threading.Lock()
+
+
+def get_work_group_size_limit(key, default):
+    with _work_group_size_limits_lock:
+        limit = _WORK_GROUP_SIZE_LIMITS.pop(key, None)
+        if limit is None:
+            return default
+        # move to the end of the LRU queue
+        _WORK_GROUP_SIZE_LIMITS[key] = limit
+        return limit
+
+
+def set_work_group_size_limit(key, limit):
+    with _work_group_size_limits_lock:
+        _WORK_GROUP_SIZE_LIMITS.pop(key, None)
+        _WORK_GROUP_SIZE_LIMITS[key] = limit
+        while len(_WORK_GROUP_SIZE_LIMITS) > MAX_WORK_GROUP_SIZE_LIMITS:
+            _WORK_GROUP_SIZE_LIMITS.popitem(last=False)
+
+
+def work_group_size_limits():
+    """
+    Returns a list of ``(key, limit)`` pairs for all the saved limits.
+    """
+    with _work_group_size_limits_lock:
+        return list(_WORK_GROUP_SIZE_LIMITS.items())
+
+
+def reduced_device_params(device_params, max_work_group_size):
+    """
+    Returns a copy of ``device_params`` with the maximum workgroup size
+    (and the maximum sizes of workgroup dimensions) limited by ``max_work_group_size``.
+    """
+    if max_work_group_size >= device_params.max_work_group_size:
+        return device_params
+
+    new_params = copy.copy(device_params)
+    new_params.max_work_group_size = max_work_group_size
+    new_params.max_work_item_sizes = [
+        min(size, max_work_group_size) for size in device_params.max_work_item_sizes]
+    return new_params
+
 
 class Computation:
     """
@@ -29,6 +86,9 @@ class Computation:
     or :py:func:`prepare_for` is called.
     If ``debug`` is ``True``, a couple of additional checks will be performed in runtime
     during preparation and calls to computation.
+    If ``keep_binaries`` is ``True``, the compiled kernel binaries are kept,
+    so that the prepared computation could be saved with
+    :py:func:`~tigger.core.plan.save_computation` and loaded without compilation.
 
     The following methods are for overriding by computations
     inheriting :py:class:`Computation` class.
@@ -70,13 +130,45 @@ class Computation:
         object with actions required to execute the computation.
         See the :py:class:`~tigger.core.operation.OperationRecorder` class reference
         for the list of available actions.
-
-    The rest is public methods.
+        If :py:class:`~tigger.cluda.OutOfResourcesError` is raised from this method,
+        it will be called again with ``device_params`` having
+        the maximum workgroup size reduced by half
+        (the method should use this value instead of the one from the context).
+
+    .. py:method:: _is_batch_independent(basis)
+
+        Must return ``False`` if the results for different elements of the first axis
+        of the arrays depend on each other (for example, if an FFT or a reduction
+        is performed over this axis).
+        Used by :py:class:`~tigger.core.multidevice.MultiDevice` to check
+        that the arrays can be split between devices,
+        and by :py:class:`~tigger.server.PlanServer` to check that requests can be joined.
+        If this method is not overridden, the computation is considered batch-independent.
+
+    The rest is public methods and attributes.
+
+    .. py:attribute:: prepare_timings
+
+        A dictionary with the time (in seconds) spent in different phases
+        of the last :py:meth:`prepare_for` call:
+        ``basis`` (basis derivation), ``transformations`` (transformation code generation),
+        ``render`` (rendering of kernel templates),
+        ``compact`` (source post-processing, see :py:func:`~tigger.cluda.source.compact_source`),
+        ``stub_compile`` and ``compile``
+        (compilation of static kernels), ``allocations`` (allocation of temporary arrays)
+        and ``total``.
+        Phases of nested computations are included.
+        Kernels are compiled concurrently (see ``compile_threads`` in
+        :py:class:`~tigger.cluda.api.Context`), in which case the wall-clock time
+        of the compilation is divided between the corresponding phases.
+        Equals ``None`` if the computation has not been prepared yet.
     """
 
-    def __init__(self, ctx, debug=False):
+    def __init__(self, ctx, debug=False, keep_binaries=False):
         self._ctx = ctx
         self._debug = debug
+        self._keep_binaries = keep_binaries
+        self.prepare_timings = None
 
         self._state = STATE_NOT_INITIALIZED
 
@@ -101,7 +193,7 @@ class Computation:
         Calls ``cls`` constructor with the same arguments and keywords
         as were given to its own constructor.
         """
-        return cls(self._ctx, debug=self._debug)
+        return cls(self._ctx, debug=self._debug, keep_binaries=self._keep_binaries)
 
     def _get_base_names(self):
         """
@@ -109,6 +201,9 @@ class Computation:
         """
         return self._argnames
 
+    def _is_batch_independent(self, basis):
+        return True
+
     def _get_base_values(self):
         """
         Returns a dictionary with names and corresponding value objects for
@@ -195,25 +290,185 @@ class Computation:
     def prepare_for(self, *args, **kwds):
         """
         Prepare the computation so that it could run with ``args`` supplied to :py:meth:`__call__`.
+        The time spent in different phases of the preparation is saved
+        in :py:attr:`prepare_timings`.
         """
         if self._state == STATE_NOT_INITIALIZED:
             raise InvalidStateError("Computation is not fully initialized")
         elif self._state == STATE_PREPARED:
             raise InvalidStateError("Cannot prepare the same computation twice")
 
-        self._basis = self._basis_for(args, kwds)
-        self._leaf_signature = self.leaf_signature()
+        start = time.time()
+        with collect_phase_timings() as timings:
+            with timed_phase('basis'):
+                self._basis = self._basis_for(args, kwds)
+                self._set_leaf_signature()
+
+            self._operations = self._construct_operations_in_parallel()
+
+            with timed_phase('allocations'):
+                self._operations.optimize_execution()
 
-        self._operations = self._construct_operations(self._basis, self._ctx.device_params)
-        self._operations.optimize_execution()
+        self.prepare_timings = dict(timings)
+        self.prepare_timings['total'] = time.time() - start
 
         self._state = STATE_PREPARED
 
         return self
 
+    def _set_leaf_signature(self):
+        self._leaf_signature = self.leaf_signature()
+        # Cast functions are created once to save time in __call__(),
+        # and scalars which already have the required type are not cast at all.
+        self._leaf_casts = [
+            (name, None if value.is_array else (value.dtype.type, cast(value.dtype)))
+            for name, value in self._leaf_signature]
+        # Offsets and strides of array views are fixed in the kernels,
+        # so the arguments of every call must have the same layout.
+        # For zero-offset arrays the strides in bytes are saved too,
+        # so that the common case can be checked without calculating the full layout.
+        self._leaf_layouts = []
+        for i, (name, value) in enumerate(self._leaf_signature):
+            if not value.is_array:
+                continue
+            if value.offset != 0:
+                byte_strides = None
+            elif value.strides is None:
+                byte_strides = contiguous_strides(value.shape, value.dtype)
+            else:
+                byte_strides = value.strides
+            self._leaf_layouts.append((i, name, (value.offset, value.strides), byte_strides))
+
+    def _fallback_key(self):
+        """
+        Returns a hashable key identifying the kernels this computation is going to build
+        for the current basis.
+        """
+        return (
+            self._ctx.api.API_ID, self._ctx.device_params.name,
+            self._ctx.device_params.max_work_group_size,
+            self.__class__, repr(sorted(self._basis.items())),
+            self._tr_tree.signature())
+
+    def _construct_operations_in_parallel(self):
+        """
+        Constructs operations for this computation and all the nested ones,
+        postponing the compilation of kernels, and then compiles them concurrently.
+        """
+        if compilation_deferred():
+            # This is a nested computation, and the kernels will be compiled
+            # by the top-level one.
+            return self._construct_operations_with_fallback()
+
+        with deferred_compilation() as kernel_calls:
+            operations = self._construct_operations_with_fallback()
+
+        try:
+            build_kernel_calls(self._ctx, kernel_calls)
+        except OutOfResourcesError:
+            # Only the computations owning the failed kernels are constructed again,
+            # with the kernels compiled right away and the workgroup size reduced,
+            # letting them handle the error in their fallback loops.
+            # If the top-level computation is among them, the whole tree is reconstructed.
+            owners = []
+            for kernel_call in kernel_calls:
+                if not kernel_call.built and kernel_call.owner not in owners:
+                    owners.append(kernel_call.owner)
+
+            if self in owners:
+                operations = self._reconstruct_operations()
+            else:
+                for owner in owners:
+                    owner._operations = owner._reconstruct_operations()
+                    owner._operations.optimize_execution()
+        finally:
+            for kernel_call in kernel_calls:
+                kernel_call.owner = None
+
+        return operations
+
+    def _reconstruct_operations(self):
+        """
+        Constructs operations again after the kernels built for them
+        raised :py:class:`~tigger.cluda.OutOfResourcesError` during the deferred compilation.
+        """
+        max_work_group_size = self._device_params.max_work_group_size
+        if max_work_group_size == 1:
+            raise OutOfResourcesError("Not enough resources even for the workgroup size 1")
+        return self._construct_operations_with_fallback(max_work_group_size // 2)
+
+    def _construct_operations_with_fallback(self, max_work_group_size=None):
+        """
+        Calls :py:meth:`_construct_operations`, reducing the maximum workgroup size
+        (starting from ``max_work_group_size``, if given)
+        each time it raises :py:class:`~tigger.cluda.OutOfResourcesError`.
+        The successful limit is saved, so that the next preparation with the same basis
+        does not repeat the failed attempts.
+        """
+        device_params = self._ctx.device_params
+        key = self._fallback_key()
+        if max_work_group_size is None:
+            max_work_group_size = get_work_group_size_limit(
+                key, device_params.max_work_group_size)
+
+        # Kernel calls added during a failed attempt must not be compiled
+        kernel_calls = deferred_kernel_calls() if compilation_deferred() else []
+        attempt_start = len(kernel_calls)
+
+        while True:
+            self._device_params = reduced_device_params(device_params, max_work_group_size)
+            try:
+                operations = self._construct_operations(self._basis, self._device_params)
+            except OutOfResourcesError:
+                del kernel_calls[attempt_start:]
+                if max_work_group_size == 1:
+                    raise
+                max_work_group_size //= 2
+            else:
+                break
+
+        if max_work_group_size < device_params.max_work_group_size:
+            set_work_group_size_limit(key, max_work_group_size)
+
+        # Calls of nested computations already have their owners set
+        for kernel_call in kernel_calls[attempt_start:]:
+            if kernel_call.owner is None:
+                kernel_call.owner = self
+
+        return operations
+
     def _get_operation_recorder(self):
         return OperationRecorder(
-            self._ctx, self._tr_tree.copy(), self._basis, self._get_base_values())
+            self._ctx, self._tr_tree.copy(), self._basis, self._get_base_values(),
+            device_params=self._device_params, keep_binaries=self._keep_binaries)
+
+    def _get_profiling_records(self, path, clear):
+        path = path + "/" + self.__class__.__name__ if path is not None \
+            else self.__class__.__name__
+        records = []
+        for operation in self._operations.operations:
+            if isinstance(operation, KernelCall):
+                records += operation.get_profiling_records(path, clear=clear)
+            else:
+                records += operation.computation._get_profiling_records(path, clear)
+        return records
+
+    def profile(self, clear=True):
+        """
+        Returns a :py:class:`~tigger.core.profiling.ProfilingReport` object
+        with the data for all the kernel launches made by this computation
+        (including the ones of nested computations) since the preparation
+        or the previous call to this method (if ``clear`` was ``True``).
+        Only the last ``tigger.core.operation.MAX_PROFILING_EVENTS`` launches
+        of every kernel are kept, so long-running programs should call this method periodically.
+        Requires the context to be created with ``profile=True``.
+        """
+        if self._state != STATE_PREPARED:
+            raise InvalidStateError("The computation must be fully prepared before profiling")
+        if not self._ctx._profile:
+            raise ValueError("The context was created without profiling enabled")
+
+        return ProfilingReport(self._get_profiling_records(None, clear))
 
     def signature_str(self):
         """
@@ -234,6 +489,8 @@ class Computation:
         The order and types of arguments are defined by the base computation
         and connected transformations.
         The signature can be also viewed by means of :py:meth:`signature_str`.
+        Array views must have the same offsets and strides as the arrays
+        the computation was prepared for, otherwise ``ValueError`` is raised.
         """
         if self._state != STATE_PREPARED:
             raise InvalidStateError("The computation must be fully prepared before execution")
@@ -250,17 +507,45 @@ class Computation:
             raise TypeError("Computation takes " + str(len(self._leaf_signature)) +
                 " arguments (" + str(len(args)) + " given)")
 
+        for i, name, layout, byte_strides in self._leaf_layouts:
+            arg = args[i]
+            if byte_strides is not None and getattr(arg, 'offset', 0) == 0 and \
+                    getattr(arg, 'strides', None) == byte_strides:
+                continue
+            arg_layout = array_layout(arg)
+            if arg_layout != layout:
+                raise ValueError(
+                    "Argument " + name + " has offset " + str(arg_layout[0]) +
+                    " and strides " + str(arg_layout[1]) + ", but the computation was prepared " +
+                    "for offset " + str(layout[0]) + " and strides " + str(layout[1]))
+
         # Assign arguments to names and cast scalar values
         arg_dict = dict(self._operations.allocations)
-        for pair, arg in zip(self._leaf_signature, args):
-            name, value = pair
-            if not value.is_array:
-                arg = cast(value.dtype)(arg)
+        for (name, scalar_cast), arg in zip(self._leaf_casts, args):
+            if scalar_cast is not None:
+                scalar_type, cast_arg = scalar_cast
+                if type(arg) is not scalar_type:
+                    arg = cast_arg(arg)
 
             assert name not in arg_dict
             arg_dict[name] = arg
 
+        for name, dynamic_scalar in self._operations.dynamic_scalars.items():
+            dtype, getter = dynamic_scalar
+            arg_dict[name] = cast(dtype)(getter(arg_dict))
+
         # Call kernels with argument list based on their base arguments
         for operation in self._operations.operations:
             op_args = [arg_dict[name] for name in operation.leaf_argnames]
             operation(*op_args)
+
+    def call_async(self, *args):
+        """
+        Same as :py:meth:`__call__`, but also returns an :py:class:`~tigger.cluda.api.Event` object
+        which is completed when all the kernels of the computation are finished.
+        The event can be awaited in an ``asyncio`` coroutine::
+
+            await computation.call_async(output, input)
+        """
+        self(*args)
+        return self._ctx.record_event()
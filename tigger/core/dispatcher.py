@@ -0,0 +1,119 @@
+import collections
+import threading
+
+from tigger.core.transformation import wrap_value
+
+
+def _value_key(value):
+    if value.is_array:
+        return (True, value.shape, value.dtype, value.offset, value.strides)
+    else:
+        return (False, value.dtype)
+
+
+class Dispatcher:
+    """
+    Prepares computations on demand for the shapes and types of the arguments
+    it is called with.
+    Prepared computations (plans) are kept in a cache,
+    so the calls with previously seen arguments do not require any preparation.
+    When the cache is full, the least recently used plan is discarded.
+
+    Types of Python scalars are derived from their values
+    (see :py:func:`~tigger.cluda.dtypes.min_scalar_type`),
+    so passing numpy scalars instead helps avoid unnecessary preparations.
+
+    The dispatcher can be used from several threads.
+    Every thread gets its own prepared computations, since the calls to a computation
+    share its temporary arrays (see :ref:`thread safety notes <cluda-thread-safety>`).
+    The cache is protected by a lock, but the preparation happens outside of it,
+    so the calls with prepared signatures are not blocked by the preparation of new ones.
+
+    :param ctx: a :py:class:`~tigger.cluda.api.Context` object.
+    :param create: a function taking a context and returning a computation
+        with all the necessary transformations connected (for example, a computation class).
+    :param max_plans: maximum number of prepared computations to keep.
+    :param prepare_kwds: keyword arguments for :py:meth:`~tigger.core.Computation.prepare_for`.
+
+    .. py:attribute:: hits
+
+        Number of calls which used an already prepared computation.
+
+    .. py:attribute:: misses
+
+        Number of calls which required a new preparation.
+
+    .. py:attribute:: evictions
+
+        Number of prepared computations discarded because the cache was full.
+    """
+
+    def __init__(self, ctx, create, max_plans=16, prepare_kwds=None):
+        if max_plans < 1:
+            raise ValueError("At least one plan must be kept")
+
+        self._ctx = ctx
+        self._create = create
+        self._max_plans = max_plans
+        self._prepare_kwds = {} if prepare_kwds is None else prepare_kwds
+        self._plans = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def plan_for(self, *args):
+        """
+        Returns the computation prepared for ``args``
+        (in the same format as for :py:meth:`~tigger.core.Computation.prepare_for`),
+        preparing a new one if there is no such computation in the cache.
+        """
+        key = (threading.current_thread().ident,) + \
+            tuple(_value_key(wrap_value(arg)) for arg in args)
+
+        with self._lock:
+            # Reinserting the plan moves it to the end of the LRU order
+            plan = self._plans.pop(key, None)
+            if plan is not None:
+                self.hits += 1
+                self._plans[key] = plan
+                return plan
+            self.misses += 1
+
+        plan = self._create(self._ctx).prepare_for(*args, **self._prepare_kwds)
+
+        with self._lock:
+            # Another thread could have prepared the same plan in the meantime
+            self._plans.pop(key, None)
+            if len(self._plans) == self._max_plans:
+                self._plans.popitem(last=False)
+                self.evictions += 1
+            self._plans[key] = plan
+
+        return plan
+
+    def __call__(self, *args):
+        """
+        Executes the computation prepared for given arguments.
+        """
+        self.plan_for(*args)(*args)
+
+    def statistics(self):
+        """
+        Returns a dictionary with the cache statistics:
+        ``hits``, ``misses``, ``evictions`` and ``plans`` (the number of plans in the cache).
+        """
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                plans=len(self._plans))
+
+    def clear(self):
+        """
+        Discards all the prepared computations and resets the statistics.
+        """
+        with self._lock:
+            self._plans = collections.OrderedDict()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
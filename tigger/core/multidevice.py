@@ -0,0 +1,171 @@
+import numpy
+
+from tigger.cluda import API_CUDA
+from tigger.core.transformation import ArrayValue, wrap_value, NODE_OUTPUT
+from tigger.core.computation import InvalidStateError
+
+
+def split_batch(batch, weights):
+    """
+    Splits ``batch`` items into contiguous ranges with lengths proportional to ``weights``.
+    Returns a list of pairs ``(start, end)``.
+    """
+    total = float(sum(weights))
+    bounds = [0]
+    accumulated = 0
+    for weight in weights:
+        accumulated += weight
+        # numpy.round() rounds halves to even in both Python 2 and 3
+        bounds.append(int(numpy.round(batch * accumulated / total)))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class MultiDevice:
+    """
+    Executes a computation on several devices, splitting given array arguments
+    along their first (batch) dimension.
+    One copy of the computation is prepared for every device,
+    and each call scatters the data from host arrays, runs the copies and gathers the results.
+    All the transfers are asynchronous, so the transfers to and from one device
+    overlap with the execution on the others.
+
+    :param ctxs: a list of :py:class:`~tigger.cluda.api.Context` objects, one for every device.
+        In case of ``API_CUDA`` all of them must wrap the same CUDA context
+        (switching between CUDA contexts is not supported).
+    :param create: a function taking a context and returning a computation
+        with all the necessary transformations connected.
+        The computation must process the elements of the first axis of split arrays
+        independently (see :py:meth:`~tigger.core.Computation._is_batch_independent`).
+    :param split: a list of names of leaf array arguments which are split between devices.
+        All of them must have the same first dimension (the batch size), and all the outputs
+        must be among them.
+        Other arrays are copied to every device as a whole.
+    :param weights: relative amounts of work for every context (equal by default).
+    """
+
+    def __init__(self, ctxs, create, split, weights=None):
+        if len(ctxs) == 0:
+            raise ValueError("At least one context is required")
+        if any(ctx.api.API_ID == API_CUDA for ctx in ctxs) and \
+                len(set(id(ctx._context) for ctx in ctxs)) > 1:
+            raise ValueError("Several CUDA contexts cannot be used at the same time")
+
+        if weights is None:
+            weights = [1] * len(ctxs)
+        elif len(weights) != len(ctxs):
+            raise ValueError("The number of weights must be equal to the number of contexts")
+
+        self._ctxs = ctxs
+        self._create = create
+        self._split_names = list(split)
+        self._weights = weights
+        self._prepared = False
+
+        # Will be used to get the leaf signature before the preparation
+        self._computations = [create(ctxs[0])]
+
+    def _leaf_names(self):
+        computation = self._computations[0]
+        pairs = computation.leaf_signature()
+        nodes = computation._tr_tree.nodes
+        outputs = [name for name, _ in pairs
+            if name in nodes and nodes[name].type == NODE_OUTPUT]
+        return [name for name, _ in pairs], outputs
+
+    def prepare_for(self, *args, **kwds):
+        """
+        Prepares the computation copies for the arguments ``args``
+        (in the same format as for :py:meth:`~tigger.core.Computation.prepare_for`)
+        describing the whole batch.
+        """
+        if self._prepared:
+            raise InvalidStateError("Cannot prepare the same computation twice")
+
+        names, outputs = self._leaf_names()
+        if len(args) != len(names):
+            raise TypeError("Computation takes " + str(len(names)) +
+                " arguments (" + str(len(args)) + " given)")
+
+        values = [wrap_value(arg) for arg in args]
+        for name in self._split_names:
+            if name not in names or not values[names.index(name)].is_array:
+                raise ValueError("Argument " + name + " does not exist or is not an array")
+        if len(self._split_names) == 0:
+            raise ValueError("At least one array argument must be split")
+
+        self._arrays = [value.is_array for value in values]
+        self._split = [name in self._split_names for name in names]
+        self._outputs = [name in outputs for name in names]
+
+        batches = set(value.shape[0] for value, split in zip(values, self._split) if split)
+        if len(batches) > 1:
+            raise ValueError("Split arrays have different first dimensions")
+        batch = batches.pop()
+
+        for name, split, output in zip(names, self._split, self._outputs):
+            if output and not split:
+                raise ValueError("Output array " + name + " must be split")
+        self._ranges = split_batch(batch, self._weights)
+
+        self._devices = []
+        for i, ctx_range in enumerate(zip(self._ctxs, self._ranges)):
+            ctx, batch_range = ctx_range
+            start, end = batch_range
+            if start == end:
+                # Nothing to do for this device
+                continue
+
+            chunk_values = []
+            for value, split in zip(values, self._split):
+                if split:
+                    value = ArrayValue((end - start,) + value.shape[1:], value.dtype)
+                elif value.is_array:
+                    value = ArrayValue(value.shape, value.dtype)
+                chunk_values.append(value)
+
+            computation = self._computations[0] if i == 0 else self._create(ctx)
+            computation.prepare_for(*chunk_values, **kwds)
+            if not computation._is_batch_independent(computation._basis):
+                raise ValueError(computation.__class__.__name__ +
+                    " does not process the first axis of arrays independently, " +
+                    "so it cannot be split between devices")
+            device_arrays = [ctx.allocate(value.shape, value.dtype) if value.is_array else None
+                for value in chunk_values]
+            self._devices.append((ctx, computation, start, end, device_arrays))
+
+        self._prepared = True
+        return self
+
+    def __call__(self, *args):
+        """
+        Executes the computation.
+        Array arguments must be host arrays (with the full batch);
+        the results are written to the output arrays.
+        """
+        if not self._prepared:
+            raise InvalidStateError("The computation must be fully prepared before execution")
+
+        for arg, output in zip(args, self._outputs):
+            if output and not arg.flags.c_contiguous:
+                raise ValueError("Output arrays must be C-contiguous")
+        args = [numpy.ascontiguousarray(arg) if is_array and not output else arg
+            for arg, is_array, output in zip(args, self._arrays, self._outputs)]
+
+        events = []
+        for ctx, computation, start, end, device_arrays in self._devices:
+            for arg, device_arr, split, output in zip(
+                    args, device_arrays, self._split, self._outputs):
+                if device_arr is not None and not output:
+                    ctx.to_device_async(arg[start:end] if split else arg, device_arr)
+
+            computation(*[arg if device_arr is None else device_arr
+                for arg, device_arr in zip(args, device_arrays)])
+
+            for arg, device_arr, split, output in zip(
+                    args, device_arrays, self._split, self._outputs):
+                if output:
+                    events.append(
+                        ctx.from_device_async(device_arr, arg[start:end] if split else arg))
+
+        for event in events:
+            event.wait()
@@ -1,6 +1,121 @@
+import collections
+import contextlib
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from tigger.cluda import OutOfResourcesError
 import tigger.cluda.dtypes as dtypes
 from tigger.core.transformation import *
+from tigger.core.profiling import KernelRecord
 from tigger.cluda.kernel import render_prelude, render_template
+from tigger.helpers import timed_phase, collect_phase_timings, add_phase_timings
+
+
+_deferred = threading.local()
+
+# Maximum number of profiled launches kept for every kernel call;
+# the data for older launches is discarded.
+MAX_PROFILING_EVENTS = 10000
+
+
+def compilation_deferred():
+    """
+    Returns ``True`` if the compilation of kernels in the current thread
+    is postponed by :py:func:`deferred_compilation`.
+    """
+    return getattr(_deferred, 'kernel_calls', None) is not None
+
+
+@contextlib.contextmanager
+def deferred_compilation():
+    """
+    Context manager which makes :py:class:`KernelCall` objects prepared in the current thread
+    postpone the compilation of their kernels.
+    Returns the list the postponed kernel calls are added to
+    (they can be compiled later with :py:func:`build_kernel_calls`).
+    """
+    kernel_calls = []
+    _deferred.kernel_calls = kernel_calls
+    try:
+        yield kernel_calls
+    finally:
+        _deferred.kernel_calls = None
+
+
+def deferred_kernel_calls():
+    """
+    Returns the list the kernel calls postponed in the current thread are added to
+    (see :py:func:`deferred_compilation`).
+    """
+    return _deferred.kernel_calls
+
+
+def build_kernel_calls(ctx, kernel_calls):
+    """
+    Compiles kernels for ``kernel_calls`` concurrently
+    (up to ``ctx.compile_threads`` at the same time).
+    The wall-clock time of the build is divided between preparation phases
+    in proportion to the time the threads spent in them.
+    If some of the kernels raise :py:class:`~tigger.cluda.OutOfResourcesError`,
+    the rest are still compiled, and the first error is raised afterwards
+    (the failed calls can be found by their ``built`` attribute).
+    """
+    threads = min(ctx.compile_threads, len(kernel_calls))
+    if threads <= 1:
+        errors = []
+        for kernel_call in kernel_calls:
+            try:
+                kernel_call.build(ctx)
+            except OutOfResourcesError as e:
+                errors.append(e)
+        if len(errors) > 0:
+            raise errors[0]
+        return
+
+    def build(kernel_call):
+        with collect_phase_timings() as timings:
+            try:
+                kernel_call.build(ctx)
+            except OutOfResourcesError as e:
+                return timings, e
+        return timings, None
+
+    start = time.time()
+    pool = ThreadPool(threads)
+    try:
+        results = pool.map(build, kernel_calls)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+
+    errors = [error for _, error in results if error is not None]
+
+    totals = {}
+    for timings, _ in results:
+        for name, phase_time in timings.items():
+            totals[name] = totals.get(name, 0) + phase_time
+    threads_time = sum(totals.values())
+    if threads_time > 0:
+        add_phase_timings({name: elapsed * phase_time / threads_time
+            for name, phase_time in totals.items()})
+
+    if len(errors) > 0:
+        raise errors[0]
+
+
+class ArraySize:
+    """
+    Getter for :py:meth:`OperationRecorder.add_dynamic_scalar`
+    returning the size of the array argument ``name``.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, args):
+        return args[self.name].size
 
 
 class Argument:
@@ -18,8 +133,11 @@ class Argument:
 
 class OperationRecorder:
 
-    def __init__(self, ctx, tr_tree, basis, base_values):
+    def __init__(self, ctx, tr_tree, basis, base_values, device_params=None,
+            keep_binaries=False):
         self._ctx = ctx
+        self._keep_binaries = keep_binaries
+        self._device_params = ctx.device_params if device_params is None else device_params
         self._tr_tree = tr_tree
         self.basis = basis
         self.values = AttrDict(base_values)
@@ -27,8 +145,11 @@ class OperationRecorder:
         self._allocations = {}
         self._const_allocations = {}
 
+        self.dynamic_scalars = {}
+
         self._temp_counter = 0
         self._const_counter = 0
+        self._dynamic_counter = 0
 
     def add_allocation(self, shape, dtype):
         """
@@ -54,8 +175,26 @@ class OperationRecorder:
         self._tr_tree.add_temp_node(name, value)
         return name
 
+    def add_dynamic_scalar(self, dtype, getter):
+        """
+        Adds a scalar argument which is calculated on every call to the computation.
+        ``getter`` takes a dictionary with the arguments of the call (indexed by leaf names)
+        and returns the value.
+        It must be picklable (e.g. :py:class:`ArraySize`) for the computation
+        to be saved with :py:func:`~tigger.core.plan.save_computation`.
+        Returns the string which can be used later in the list of argument names for kernels.
+        """
+        name = "_dynamic" + str(self._dynamic_counter)
+        self._dynamic_counter += 1
+
+        value = ScalarValue(dtype)
+        self.values[name] = value
+        self.dynamic_scalars[name] = (value.dtype, getter)
+        self._tr_tree.add_temp_node(name, value)
+        return name
+
     def add_kernel(self, template, defname, argnames,
-            global_size, local_size=None, render_kwds=None, inplace=None):
+            global_size, local_size=None, render_kwds=None, inplace=None, persistent=False):
         """
         Adds kernel execution to the list of actions.
         See :ref:`tutorial-advanced-computation` for details on how to write kernels.
@@ -71,6 +210,9 @@ class OperationRecorder:
         :param render_kwds: dictionary with additional values used to render the template.
         :param inplace: list of pairs (output, input) which can point to the same point in memory
             (used as a hint for the temporary memory manager).
+        :param persistent: if ``True``, the kernel will be launched with a limited number
+            of workgroups which iterate over the virtual ones
+            (see :py:meth:`~tigger.cluda.api.Context.compile_static` for details).
         """
 
         subtemplate = template.get_def(defname)
@@ -95,7 +237,9 @@ class OperationRecorder:
         render_kwds.update(additional_kwds)
         src = render_template(subtemplate, *args, **render_kwds)
 
-        op = KernelCall(defname, argnames, src, global_size, local_size=local_size)
+        op = KernelCall(defname, argnames, src, global_size, local_size=local_size,
+            persistent=persistent, max_work_group_size=self._device_params.max_work_group_size,
+            keep_binary=self._keep_binaries)
         op.prepare(self._ctx, self._tr_tree)
         self.operations.append(op)
 
@@ -109,7 +253,10 @@ class OperationRecorder:
         connections = self._tr_tree.connections_for(operation.argnames)
         for tr, array_arg, new_array_args, new_scalar_args in connections:
             operation.connect(tr, array_arg, new_array_args, new_scalar_args)
-        operation.prepare({name:value for name, value in self._tr_tree.leaf_signature()})
+        values = {name:value for name, value in self._tr_tree.leaf_signature()}
+        # Temporary arrays can be passed to the nested computation too
+        values.update((name, node.value) for name, node in self._tr_tree.temp_nodes.items())
+        operation.prepare(values)
         self.operations.append(operation)
 
     def optimize_execution(self):
@@ -181,19 +328,54 @@ class ComputationCall:
 class KernelCall:
 
     def __init__(self, name, base_argnames, base_src, global_size,
-            local_size=None):
+            local_size=None, persistent=False, max_work_group_size=None, keep_binary=False):
         self.name = name
         self.base_argnames = list(base_argnames)
         self.local_size = local_size
         self.global_size = global_size
+        self.persistent = persistent
+        self.max_work_group_size = max_work_group_size
+        self.keep_binary = keep_binary
         self.src = base_src
+        self.profiling_events = collections.deque(maxlen=MAX_PROFILING_EVENTS)
+        self.built = False
+
+        # The computation which added this call (only set while the compilation is deferred)
+        self.owner = None
 
     def prepare(self, ctx, tr_tree):
-        transformation_code = tr_tree.transformations_for(self.base_argnames)
+        with timed_phase('transformations'):
+            transformation_code = tr_tree.transformations_for(self.base_argnames)
         self.full_src = transformation_code + self.src
-        self.kernel = ctx.compile_static(self.full_src, self.name,
-            self.global_size, local_size=self.local_size)
+        if compilation_deferred():
+            _deferred.kernel_calls.append(self)
+        else:
+            self.build(ctx)
         self.leaf_argnames = [name for name, _ in tr_tree.leaf_signature(self.base_argnames)]
 
+    def build(self, ctx):
+        self.kernel = ctx.compile_static(self.full_src, self.name,
+            self.global_size, local_size=self.local_size, persistent=self.persistent,
+            max_work_group_size=self.max_work_group_size, keep_binary=self.keep_binary)
+        self.built = True
+
+    def get_profiling_records(self, path, clear=True):
+        records = []
+        for event, bytes_moved in self.profiling_events:
+            start, end = event.get_times()
+            records.append(KernelRecord(path, self.name,
+                event.global_size, event.local_size, event.launch_time,
+                start, end, bytes_moved))
+        if clear:
+            self.profiling_events.clear()
+        return records
+
     def __call__(self, *args):
-        self.kernel(*args)
+        event = self.kernel(*args)
+        if event is not None:
+            # Assuming that every element of every array argument is accessed once.
+            # The actual arguments are used, since in the dynamic size mode
+            # they can be smaller than the ones the kernel was prepared for.
+            bytes_moved = sum(arg.size * arg.dtype.itemsize
+                for arg in args if len(getattr(arg, 'shape', ())) > 0)
+            self.profiling_events.append((event, bytes_moved))
@@ -0,0 +1,178 @@
+import collections
+import time
+
+import numpy
+
+from tigger.core.transformation import NODE_OUTPUT
+
+
+class _Stage:
+
+    def __init__(self, computation, scalars):
+        pairs = computation.leaf_signature()
+        nodes = computation._tr_tree.nodes
+        arrays = [(name, value) for name, value in pairs if value.is_array]
+        outputs = [value for name, value in arrays
+            if name in nodes and nodes[name].type == NODE_OUTPUT]
+        inputs = [value for name, value in arrays
+            if not (name in nodes and nodes[name].type == NODE_OUTPUT)]
+
+        if len(outputs) != 1 or len(inputs) != 1:
+            raise ValueError("Pipeline stages must have one output and one input array, got " +
+                computation.signature_str())
+        if len(pairs) - len(arrays) != len(scalars):
+            raise ValueError("Computation takes " + str(len(pairs) - len(arrays)) +
+                " scalar arguments (" + str(len(scalars)) + " given)")
+
+        self.computation = computation
+        self.scalars = tuple(scalars)
+        self.output = outputs[0]
+        self.input = inputs[0]
+        self._output_first = arrays[0][1] is self.output
+
+    def __call__(self, output, input):
+        arrays = (output, input) if self._output_first else (input, output)
+        self.computation(*(arrays + self.scalars))
+
+
+class _BufferSet:
+
+    def __init__(self, ctx, stages):
+        self.queue = ctx.create_queue()
+        first = stages[0].input
+        self.host_input = ctx.allocate_host(first.shape, first.dtype)
+        self.device_input = ctx.allocate(first.shape, first.dtype)
+        self.device_outputs = [ctx.allocate(stage.output.shape, stage.output.dtype)
+            for stage in stages]
+        last = stages[-1].output
+        self.host_output = ctx.allocate_host(last.shape, last.dtype)
+
+
+class Pipeline:
+    """
+    Processes a stream of host arrays (chunks) with a chain of prepared computations.
+    Every chunk is uploaded to the device, passed through the computations
+    (the output of each one is the input of the next one), and the result is downloaded back.
+
+    Several chunks are processed at the same time, each with its own set of buffers
+    and its own queue, so the transfers of some chunks overlap with the computations for others.
+    The computations themselves are executed one chunk after another
+    (they can use the same temporary arrays for all the chunks).
+
+    :param ctx: a :py:class:`~tigger.cluda.api.Context` object.
+    :param stages: a list of prepared computations, each having one output array,
+        one input array and, possibly, some scalar arguments.
+        A stage with scalar arguments is given as a tuple ``(computation, scalars)``.
+    :param in_flight: number of chunks processed at the same time.
+
+    .. py:attribute:: chunks
+
+        Number of chunks processed.
+
+    .. py:attribute:: stall_time
+
+        Time (in seconds) spent waiting for the results, that is, when the host
+        could not give more work to the device.
+    """
+
+    def __init__(self, ctx, stages, in_flight=2):
+        if len(stages) == 0:
+            raise ValueError("At least one stage is required")
+        if in_flight < 1:
+            raise ValueError("At least one chunk must be in flight")
+
+        self._ctx = ctx
+        self._stages = []
+        for stage in stages:
+            computation, scalars = stage if isinstance(stage, tuple) else (stage, ())
+            self._stages.append(_Stage(computation, scalars))
+
+        for i in range(1, len(self._stages)):
+            output = self._stages[i - 1].output
+            input = self._stages[i].input
+            if output.shape != input.shape or output.dtype != input.dtype:
+                raise ValueError(
+                    "Output of stage " + str(i - 1) + " (" + str(output) + ") "
+                    "does not match the input of stage " + str(i) + " (" + str(input) + ")")
+
+        self._buffer_sets = [_BufferSet(ctx, self._stages) for i in range(in_flight)]
+
+        self.chunks = 0
+        self.stall_time = 0
+        self._time = 0
+
+    def _enqueue(self, buffer_set, chunk, previous_computation):
+        ctx = self._ctx
+        with ctx.use_queue(buffer_set.queue):
+            buffer_set.host_input[...] = chunk
+            ctx.to_device_async(buffer_set.host_input, buffer_set.device_input)
+
+            # Computations may use temporary arrays, so they cannot run in parallel
+            if previous_computation is not None:
+                ctx.wait_for_event(previous_computation)
+            input = buffer_set.device_input
+            for stage, output in zip(self._stages, buffer_set.device_outputs):
+                stage(output, input)
+                input = output
+            computed = ctx.record_event()
+
+            download = ctx.from_device_async(input, buffer_set.host_output)
+
+        return computed, download
+
+    def _wait(self, buffer_set, download):
+        t1 = time.time()
+        download.wait()
+        self.stall_time += time.time() - t1
+        self.chunks += 1
+        return numpy.array(buffer_set.host_output)
+
+    def run(self, chunks):
+        """
+        Returns a generator yielding the results for every array in the iterable ``chunks``
+        in the same order.
+        Chunks must have the shape and dtype of the input of the first computation.
+        The results are new arrays, which can be kept by the caller.
+        """
+        input_value = self._stages[0].input
+        in_flight = collections.deque()
+        previous_computation = None
+        free_sets = list(self._buffer_sets)
+
+        t_start = time.time()
+        try:
+            for chunk in chunks:
+                chunk = numpy.asarray(chunk)
+                if chunk.shape != input_value.shape or chunk.dtype != input_value.dtype:
+                    raise ValueError("Chunk does not match the pipeline input " + str(input_value))
+
+                if len(free_sets) == 0:
+                    buffer_set, download = in_flight.popleft()
+                    result = self._wait(buffer_set, download)
+                    free_sets.append(buffer_set)
+                    yield result
+
+                buffer_set = free_sets.pop(0)
+                previous_computation, download = self._enqueue(
+                    buffer_set, chunk, previous_computation)
+                in_flight.append((buffer_set, download))
+
+            while len(in_flight) > 0:
+                buffer_set, download = in_flight.popleft()
+                yield self._wait(buffer_set, download)
+        finally:
+            self._time += time.time() - t_start
+
+    def statistics(self):
+        """
+        Returns a dictionary with the following values:
+        ``chunks`` and ``stall_time`` (see the corresponding attributes),
+        ``time`` (total time from the start to the end of the iteration
+        over the results of :py:meth:`run`, in seconds),
+        ``chunks_per_second`` and ``bytes_per_second`` (for the input chunks).
+        """
+        chunk_bytes = self._buffer_sets[0].host_input.nbytes
+        rate = 1. / self._time if self._time > 0 else 0.
+        return dict(chunks=self.chunks, stall_time=self.stall_time, time=self._time,
+            chunks_per_second=self.chunks * rate,
+            bytes_per_second=self.chunks * chunk_bytes * rate)
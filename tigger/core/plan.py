@@ -0,0 +1,170 @@
+"""
+Saving and loading of prepared computations.
+
+A saved computation (a plan) contains everything necessary to execute it:
+the leaf signature, kernel sources with their call sizes, temporary and constant arrays
+(the latter with their contents), nested computations and compiled kernel binaries.
+Loading a plan does not require the original computation class
+and does not derive the basis, construct operations or pick local sizes.
+
+The binaries are only saved if the computation was created with ``keep_binaries=True``
+(see :py:class:`~tigger.core.Computation`).
+Otherwise, or if a saved binary cannot be loaded (for example, after a driver update),
+the kernel is compiled again from the saved source, and a warning is logged.
+
+Plans are device-specific, and can be loaded only for the same API and device.
+Computations with dynamic scalars (see :py:meth:`~tigger.core.operation.OperationRecorder.add_dynamic_scalar`)
+can only be saved if the corresponding getters are picklable.
+"""
+
+import pickle
+
+from tigger.helpers import AttrDict
+from tigger.core.transformation import NODE_INPUT, NODE_OUTPUT, NODE_SCALAR
+from tigger.core.operation import KernelCall, ComputationCall, build_kernel_calls
+from tigger.core.computation import Computation, InvalidStateError, STATE_PREPARED
+
+
+FORMAT_VERSION = 1
+
+
+class _LoadedKernelCall(KernelCall):
+    """
+    Kernel call restored from a plan, built with the saved source, call sizes and binary.
+    """
+
+    def __init__(self, data):
+        KernelCall.__init__(self, data['name'], [], None, data['global_size'],
+            local_size=data['local_size'])
+        self.source = data['source']
+        self.binary = data['binary']
+        self.leaf_argnames = data['leaf_argnames']
+
+    def build(self, ctx):
+        self.kernel = ctx.load_static(self.name, self.source,
+            self.global_size, self.local_size, binary=self.binary)
+        self.built = True
+
+
+def _computation_data(computation):
+    nodes = computation._tr_tree.nodes
+    names = {NODE_OUTPUT: [], NODE_INPUT: [], NODE_SCALAR: []}
+    for name, value in computation._leaf_signature:
+        names[nodes[name].type].append(name)
+
+    recorder = computation._operations
+    operations = []
+    for operation in recorder.operations:
+        if isinstance(operation, KernelCall):
+            kernel = operation.kernel
+            operations.append(('kernel', dict(
+                name=operation.name, source=kernel.source,
+                global_size=kernel.global_size, local_size=kernel.local_size,
+                binary=kernel.binary, leaf_argnames=operation.leaf_argnames)))
+        else:
+            operations.append(('computation',
+                _computation_data(operation.computation), operation.leaf_argnames))
+
+    return dict(
+        name=computation.__class__.__name__,
+        outputs=names[NODE_OUTPUT], inputs=names[NODE_INPUT], scalars=names[NODE_SCALAR],
+        leaf_signature=list(computation._leaf_signature),
+        allocations={name: (value.shape, value.dtype)
+            for name, value in recorder._allocations.items()},
+        const_allocations=dict(recorder._const_allocations),
+        dynamic_scalars=dict(recorder.dynamic_scalars),
+        operations=operations)
+
+
+def computation_plan(computation):
+    """
+    Returns a picklable dictionary with the plan of the prepared ``computation``.
+    The kernel binaries are included if the computation was created with ``keep_binaries=True``.
+    """
+    if computation._state != STATE_PREPARED:
+        raise InvalidStateError("Only prepared computations can be saved")
+
+    ctx = computation._ctx
+    return dict(version=FORMAT_VERSION,
+        api_id=ctx.api.API_ID, device_name=ctx.device_params.name,
+        computation=_computation_data(computation))
+
+
+class LoadedComputation(Computation):
+    """
+    A computation restored from a plan.
+    Behaves as the original computation in the prepared state.
+
+    .. py:attribute:: name
+
+        Class name of the original computation.
+    """
+
+    def __init__(self, ctx, data, kernel_calls):
+        Computation.__init__(self, ctx)
+        self.name = data['name']
+        self._set_argnames(data['outputs'], data['inputs'], data['scalars'])
+
+        # The leaf arguments become the base ones, which gives the same leaf signature
+        self._tr_tree.propagate_to_base(dict(data['leaf_signature']))
+        self._basis = AttrDict()
+        self._set_leaf_signature()
+
+        allocations = {}
+        for name, shape_dtype in data['allocations'].items():
+            allocations[name] = ctx.allocate(*shape_dtype)
+        for name, arr in data['const_allocations'].items():
+            allocations[name] = ctx.to_device(arr)
+
+        operations = []
+        for operation_data in data['operations']:
+            if operation_data[0] == 'kernel':
+                operation = _LoadedKernelCall(operation_data[1])
+                kernel_calls.append(operation)
+            else:
+                _, nested_data, leaf_argnames = operation_data
+                nested = LoadedComputation(ctx, nested_data, kernel_calls)
+                operation = ComputationCall(nested, *leaf_argnames)
+                operation.leaf_argnames = leaf_argnames
+            operations.append(operation)
+
+        self._operations = AttrDict(operations=operations, allocations=allocations,
+            dynamic_scalars=data['dynamic_scalars'])
+        self._state = STATE_PREPARED
+
+
+def restore_computation(ctx, plan):
+    """
+    Returns a :py:class:`LoadedComputation` object created from ``plan``
+    (returned by :py:func:`computation_plan`) for the context ``ctx``.
+    """
+    if plan['version'] != FORMAT_VERSION:
+        raise ValueError("Unsupported plan format version: " + str(plan['version']))
+    if ctx.api.API_ID != plan['api_id'] or ctx.device_params.name != plan['device_name']:
+        raise ValueError("The plan was created for " + plan['api_id'] + ":" +
+            plan['device_name'] + ", got " + ctx.api.API_ID + ":" + ctx.device_params.name)
+
+    kernel_calls = []
+    computation = LoadedComputation(ctx, plan['computation'], kernel_calls)
+    build_kernel_calls(ctx, kernel_calls)
+
+    return computation
+
+
+def save_computation(computation, path):
+    """
+    Saves the plan of the prepared ``computation`` to the file ``path``.
+    """
+    plan = computation_plan(computation)
+    with open(path, 'wb') as f:
+        pickle.dump(plan, f, protocol=2)
+
+
+def load_computation(ctx, path):
+    """
+    Loads the computation saved with :py:func:`save_computation`
+    and prepares it for the context ``ctx``.
+    """
+    with open(path, 'rb') as f:
+        plan = pickle.load(f)
+    return restore_computation(ctx, plan)
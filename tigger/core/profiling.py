@@ -0,0 +1,133 @@
+import json
+
+
+class KernelRecord:
+    """
+    Profiling data for a single kernel launch.
+
+    .. py:attribute:: path
+
+        Names of the nested computations the kernel belongs to, separated by ``/``.
+
+    .. py:attribute:: name
+
+        Name of the kernel.
+
+    .. py:attribute:: global_size
+    .. py:attribute:: local_size
+
+        Actual call sizes of the kernel.
+
+    .. py:attribute:: launch_time
+
+        Time spent in the host code launching the kernel (in seconds).
+
+    .. py:attribute:: start
+    .. py:attribute:: end
+
+        Start and end of the kernel execution on the device (in seconds).
+        Only the differences between these values are meaningful.
+
+    .. py:attribute:: bytes_moved
+
+        Estimated amount of global memory read and written by the kernel
+        (the total size of its array arguments in the call).
+    """
+
+    def __init__(self, path, name, global_size, local_size, launch_time, start, end, bytes_moved):
+        self.path = path
+        self.name = name
+        self.global_size = tuple(global_size)
+        self.local_size = tuple(local_size)
+        self.launch_time = launch_time
+        self.start = start
+        self.end = end
+        self.bytes_moved = bytes_moved
+
+    @property
+    def time(self):
+        return self.end - self.start
+
+    def as_dict(self):
+        return dict(
+            path=self.path, name=self.name,
+            global_size=list(self.global_size), local_size=list(self.local_size),
+            launch_time=self.launch_time, start=self.start, end=self.end,
+            bytes_moved=self.bytes_moved)
+
+
+class ProfilingReport:
+    """
+    A collection of :py:class:`KernelRecord` objects returned by
+    :py:meth:`~tigger.core.Computation.profile`.
+
+    .. py:attribute:: records
+
+        List of :py:class:`KernelRecord` objects, sorted by the start time.
+    """
+
+    def __init__(self, records):
+        self.records = sorted(records, key=lambda record: record.start)
+
+    def summary(self):
+        """
+        Returns a list of dictionaries with the statistics aggregated over all the launches
+        of each kernel: ``path``, ``name``, ``calls``, ``total_time``, ``mean_time``,
+        ``mean_launch_time`` and ``bandwidth`` (in bytes per second).
+        The list is sorted by the total time in descending order.
+        """
+        kernels = {}
+        for record in self.records:
+            kernels.setdefault((record.path, record.name), []).append(record)
+
+        result = []
+        for (path, name), records in kernels.items():
+            total_time = sum(record.time for record in records)
+            total_bytes = sum(record.bytes_moved for record in records)
+            result.append(dict(
+                path=path, name=name, calls=len(records),
+                total_time=total_time,
+                mean_time=total_time / len(records),
+                mean_launch_time=sum(record.launch_time for record in records) / len(records),
+                bandwidth=total_bytes / total_time if total_time > 0 else None))
+
+        return sorted(result, key=lambda stats: stats['total_time'], reverse=True)
+
+    def to_json(self):
+        """
+        Returns a JSON string with all the records and the summary.
+        """
+        return json.dumps(dict(
+            records=[record.as_dict() for record in self.records],
+            summary=self.summary()))
+
+    def to_chrome_trace(self):
+        """
+        Returns a JSON string in the Chrome trace event format
+        (can be viewed in ``chrome://tracing``).
+        """
+        origin = self.records[0].start if len(self.records) > 0 else 0
+        events = []
+        for record in self.records:
+            events.append(dict(
+                name=record.name, cat=record.path, ph='X', pid=0, tid=0,
+                # the format requires microseconds
+                ts=(record.start - origin) * 1e6,
+                dur=record.time * 1e6,
+                args=dict(
+                    global_size=list(record.global_size), local_size=list(record.local_size),
+                    launch_time=record.launch_time, bytes_moved=record.bytes_moved)))
+        return json.dumps(dict(traceEvents=events))
+
+    def __str__(self):
+        lines = []
+        for stats in self.summary():
+            lines.append(
+                "{path}/{name}: {calls} call(s), {total:.3f} ms total, {mean:.3f} ms mean, "
+                "{launch:.3f} ms launch{bandwidth}".format(
+                    path=stats['path'], name=stats['name'], calls=stats['calls'],
+                    total=stats['total_time'] * 1e3, mean=stats['mean_time'] * 1e3,
+                    launch=stats['mean_launch_time'] * 1e3,
+                    bandwidth="" if stats['bandwidth'] is None
+                        else ", {bw:.2f} GB/s".format(bw=stats['bandwidth'] / 1e9)))
+        return "\n".join(lines)
@@ -1,11 +1,10 @@
 import re
 
 import numpy
-from mako.template import Template
 
 import tigger.cluda.dtypes as dtypes
 from tigger.cluda.kernel import render_without_funcs, FuncCollector
-from tigger.helpers import AttrDict, product, wrap_in_tuple
+from tigger.helpers import AttrDict, product, wrap_in_tuple, template_from
 
 
 INDEX_NAME = "idx"
@@ -22,10 +21,60 @@ def load_macro_name(name):
 def load_function_name(name):
     return "_load_" + name
 
-def leaf_load_macro(name):
-    return "#define {macro_name}({idx}) ({name}[{idx}])".format(
+def collapse_dimensions(shape, strides):
+    """
+    Merges adjacent dimensions which can be traversed with a single stride
+    and removes dimensions of length 1.
+    Returns a list of pairs ``(length, stride)``.
+    """
+    dims = []
+    for length, stride in zip(shape, strides):
+        if length == 1:
+            continue
+        if len(dims) > 0 and dims[-1][1] == stride * length:
+            dims[-1] = (dims[-1][0] * length, stride)
+        else:
+            dims.append((length, stride))
+    return dims
+
+
+def leaf_index(value):
+    """
+    Returns the expression for the position of the element ``idx``
+    (the index in the flattened C-ordered array)
+    in the buffer of the leaf array with the given value.
+    """
+    if value.strides is None:
+        if value.offset == 0:
+            return INDEX_NAME
+        else:
+            return "({idx}) + {offset}".format(idx=INDEX_NAME, offset=value.offset)
+
+    itemsize = value.dtype.itemsize
+    dims = collapse_dimensions(value.shape, [stride // itemsize for stride in value.strides])
+
+    terms = [str(value.offset)] if value.offset != 0 else []
+    for i, dim in enumerate(dims):
+        length, stride = dim
+        if stride == 0:
+            continue
+
+        inner_size = product([l for l, _ in dims[i+1:]])
+        term = "(" + INDEX_NAME + ")"
+        if inner_size > 1:
+            term = "(" + term + " / " + str(inner_size) + ")"
+        if i > 0:
+            term = "(" + term + " % " + str(length) + ")"
+        if stride != 1:
+            term += " * " + str(stride)
+        terms.append(term)
+
+    return " + ".join(terms) if len(terms) > 0 else "0"
+
+def leaf_load_macro(name, value):
+    return "#define {macro_name}({idx}) ({name}[{index}])".format(
         macro_name=load_macro_name(name), name=leaf_name(name),
-        idx=INDEX_NAME, val=VALUE_NAME)
+        idx=INDEX_NAME, index=leaf_index(value))
 
 def node_load_macro(name, argnames):
     return "#define {macro_name}({idx}) {fname}({arglist}, {idx})".format(
@@ -33,10 +82,10 @@ def node_load_macro(name, argnames):
         arglist = ", ".join([leaf_name(name) for name in argnames]),
         idx=INDEX_NAME, val=VALUE_NAME)
 
-def base_leaf_load_macro(name):
-    return "#define {macro_name}({idx}) ({name}[{idx}])".format(
+def base_leaf_load_macro(name, value):
+    return "#define {macro_name}({idx}) ({name}[{index}])".format(
         macro_name=load_macro_name(name), name=leaf_name(name),
-        idx=INDEX_NAME, val=VALUE_NAME)
+        idx=INDEX_NAME, index=leaf_index(value))
 
 def base_node_load_macro(name, argnames):
     return "#define {macro_name}({idx}) {fname}({arglist}, {idx})".format(
@@ -59,10 +108,10 @@ def store_macro_name(name):
 def store_function_name(name):
     return "_store_" + name
 
-def leaf_store_macro(name):
-    return "#define {macro_name}({val}) {name}[{idx}] = ({val})".format(
+def leaf_store_macro(name, value):
+    return "#define {macro_name}({val}) {name}[{index}] = ({val})".format(
         macro_name=store_macro_name(name), name=leaf_name(name),
-        idx=INDEX_NAME, val=VALUE_NAME)
+        index=leaf_index(value), val=VALUE_NAME)
 
 def node_store_macro(name, argnames):
     return "#define {macro_name}({val}) {fname}({arglist}, {idx}, {val})".format(
@@ -70,10 +119,10 @@ def node_store_macro(name, argnames):
         arglist = ", ".join([leaf_name(name) for name in argnames]),
         idx=INDEX_NAME, val=VALUE_NAME)
 
-def base_leaf_store_macro(name):
-    return "#define {macro_name}({idx}, {val}) {name}[{idx}] = ({val})".format(
+def base_leaf_store_macro(name, value):
+    return "#define {macro_name}({idx}, {val}) {name}[{index}] = ({val})".format(
         macro_name=store_macro_name(name), name=leaf_name(name),
-        idx=INDEX_NAME, val=VALUE_NAME)
+        idx=INDEX_NAME, index=leaf_index(value), val=VALUE_NAME)
 
 def base_node_store_macro(name, argnames):
     return "#define {macro_name}({idx}, {val}) {fname}({arglist}, {idx}, {val})".format(
@@ -110,20 +159,38 @@ class ArrayValue(object):
     .. py:attribute:: dtype
 
         :py:class:`numpy.dtype` object specifying the data type of the array.
+
+    .. py:attribute:: offset
+
+        Offset (in elements) of the first element of the array
+        from the beginning of the buffer passed to the kernel.
+
+    .. py:attribute:: strides
+
+        Tuple with strides of the array in bytes (same as :py:attr:`numpy.ndarray.strides`),
+        or ``None`` if the array is C-contiguous.
+        Load and store macros for non-contiguous arrays convert the flat index
+        of the element to its position in memory, so computations can process them directly.
     """
 
-    def __init__(self, shape, dtype):
+    def __init__(self, shape, dtype, offset=0, strides=None):
         self.shape = wrap_in_tuple(shape) if shape is not None else None
         self.dtype = dtypes.normalize_type(dtype) if dtype is not None else None
+        self.offset = offset
+        self.strides = strides
         self.is_array = True
 
     def fill_with(self, other):
         self.shape = other.shape
         self.dtype = other.dtype
+        self.offset = other.offset
+        self.strides = other.strides
 
     def clear(self):
         self.shape = None
         self.dtype = None
+        self.offset = 0
+        self.strides = None
 
     def get_shape(self):
         return self._shape
@@ -147,10 +214,19 @@ class ArrayValue(object):
             props.append(str(self.dtype))
         if self.shape is not None:
             props.append(str(self.shape))
+        if self.offset != 0:
+            props.append("offset " + str(self.offset))
+        if self.strides is not None:
+            props.append("strides " + str(self.strides))
         return ", ".join(props)
 
     def __repr__(self):
-        return "ArrayValue(" + repr(self.shape) + "," + repr(self.dtype) + ")"
+        layout = ""
+        if self.offset != 0:
+            layout += ",offset=" + repr(self.offset)
+        if self.strides is not None:
+            layout += ",strides=" + repr(self.strides)
+        return "ArrayValue(" + repr(self.shape) + "," + repr(self.dtype) + layout + ")"
 
 
 class ScalarValue:
@@ -182,12 +258,53 @@ class ScalarValue:
         return "ScalarValue(" + repr(self.dtype) + ")"
 
 
+def contiguous_strides(shape, dtype):
+    """
+    Returns the strides (in bytes) of a C-contiguous array with given shape and dtype.
+    """
+    strides = []
+    stride = dtypes.normalize_type(dtype).itemsize
+    for length in reversed(shape):
+        strides.insert(0, stride)
+        stride *= length
+    return tuple(strides)
+
+
+def array_layout(value):
+    """
+    Returns the tuple ``(offset, strides)`` for an array (or a view),
+    as expected by :py:class:`ArrayValue`.
+    """
+    itemsize = dtypes.normalize_type(value.dtype).itemsize
+
+    # PyOpenCL views keep the reference to the base buffer and the offset in bytes;
+    # PyCUDA and numpy views point to the first element directly
+    # (``numpy.memmap`` has an ``offset`` attribute too, but it means something else)
+    offset = 0 if isinstance(value, numpy.ndarray) else getattr(value, 'offset', 0)
+    if offset % itemsize != 0:
+        raise ValueError("Array offset must be a multiple of the item size")
+
+    strides = getattr(value, 'strides', None)
+    if strides is not None:
+        strides = tuple(strides)
+        if any(stride % itemsize != 0 for stride in strides):
+            raise ValueError("Array strides must be multiples of the item size")
+        # Strides of dimensions of length 1 do not affect the layout
+        contiguous = contiguous_strides(value.shape, value.dtype)
+        if all(length == 1 or stride == c_stride
+                for length, stride, c_stride in zip(value.shape, strides, contiguous)):
+            strides = None
+
+    return offset // itemsize, strides
+
+
 def wrap_value(value):
     if isinstance(value, ScalarValue) or isinstance(value, ArrayValue):
         return value
     elif hasattr(value, 'dtype'):
         if hasattr(value, 'shape') and len(value.shape) > 0:
-            return ArrayValue(value.shape, value.dtype)
+            offset, strides = array_layout(value)
+            return ArrayValue(value.shape, value.dtype, offset=offset, strides=strides)
         else:
             return ScalarValue(value.dtype)
     else:
@@ -242,7 +359,7 @@ class Transformation:
         self.derive_o_from_is = derive_o_from_is
         self.derive_i_from_os = derive_i_from_os
 
-        self.code = Template(code)
+        self.code = template_from(code)
 
 
 NODE_INPUT = 0
@@ -341,7 +458,7 @@ class TransformationTree:
                 visited.add(name)
 
                 # assuming that if we got a name not from the tree,
-                # it is a temporary array
+                # it is a temporary array (or a dynamic scalar, see OperationRecorder)
                 if name not in self.nodes:
                     arrays.append(name)
                     continue
@@ -456,7 +573,8 @@ class TransformationTree:
                 return
 
             if node.children is None:
-                code_list.append("// leaf node " + node.name + "\n" + leaf_macro(node.name))
+                code_list.append(
+                    "// leaf node " + node.name + "\n" + leaf_macro(node.name, node.value))
                 return
 
             for child in node.children:
@@ -515,13 +633,36 @@ class TransformationTree:
             if name in self.base_names:
                 process(name)
             else:
-                code_list.append(base_leaf_load_macro(name))
-                code_list.append(base_leaf_store_macro(name))
+                value = self.nodes[name].value if name in self.nodes \
+                    else self.temp_nodes[name].value
+                if value.is_array:
+                    code_list.append(base_leaf_load_macro(name, value))
+                    code_list.append(base_leaf_store_macro(name, value))
 
         leaf_names = [name for name, _ in self.leaf_signature(names)]
         return func_c.render() + "\n\n" + "\n\n".join(code_list) + \
             "\n\n" + signature_macro(leaf_names)
 
+    def signature(self):
+        """
+        Returns a hashable and picklable object which identifies the transformation code
+        produced by :py:meth:`transformations_for` for the base names,
+        without generating the code itself.
+        """
+        def value_key(value):
+            if value.is_array:
+                return (value.shape, value.dtype, value.offset, value.strides)
+            else:
+                return (value.dtype,)
+
+        connections = tuple(
+            (array_arg, tuple(array_children), tuple(scalar_children),
+                tr.inputs, tr.outputs, tr.scalars, tr.code.source)
+            for tr, array_arg, array_children, scalar_children
+            in self.connections_for(self.base_names))
+        values = tuple((name, value_key(self.nodes[name].value)) for name in sorted(self.nodes))
+        return (connections, values)
+
     def connections_for(self, names):
         connections = []
 
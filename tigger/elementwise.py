@@ -2,6 +2,7 @@ import numpy
 
 from tigger.helpers import *
 from tigger.core import *
+from tigger.core.operation import ArraySize
 
 
 EMPTY = dict(functions="", kernel="")
@@ -18,10 +19,25 @@ class Elementwise(Computation):
         :py:class:`~tigger.elementwise.Elementwise` object.
         Returns ``self``.
 
-    .. py:method:: prepare_for(*args, code=EMPTY)
+    .. py:method:: prepare_for(*args, code=EMPTY, items_per_thread_override=None, dynamic=False)
 
         :param args: arrays and scalars, according to the lists passed to :py:meth:`set_argnames`.
         :param code: kernel code.
+        :param items_per_thread_override: number of elements processed by a single work item.
+            If ``None``, it will be picked automatically based on the array size
+            and device parameters.
+        :param dynamic: if ``True``, the size of arrays is passed to the kernel on every call
+            instead of being compiled into it, so the prepared computation can be called
+            with arrays of any size (all the leaf arrays must still have the same size
+            and be C-contiguous).
+            The kernel processes elements in a loop with the bound unknown at compile time,
+            and is launched with the number of work items which does not depend on the size,
+            so it can be somewhat slower, especially for small arrays.
+            ``items_per_thread_override`` is ignored in this mode.
+
+    The kernel code is executed once for every index ``idx`` in range ``[0, size)``.
+    Several indices can be processed by the same work item, so the code should not
+    use ``return``, ``continue`` or ``virtual_global_flat_id()``.
     """
 
     # For now I cannot think of any other computation requiring variable number of arguments.
@@ -40,7 +56,8 @@ class Elementwise(Computation):
 
     def _get_argvalues(self, basis):
         outputs, inputs, params = self._get_base_names()
-        values = {name:ArrayValue((basis.size,), basis.argtypes[name])
+        shape = None if basis.dynamic else (basis.size,)
+        values = {name:ArrayValue(shape, basis.argtypes[name])
             for name in outputs + inputs}
         values.update({name:ScalarValue(basis.argtypes[name])
             for name in params})
@@ -51,19 +68,35 @@ class Elementwise(Computation):
 
         # Python 2 does not support explicit kwds after *args
         code = kwds.get('code', EMPTY)
+        items_per_thread_override = kwds.get('items_per_thread_override', None)
+        dynamic = kwds.get('dynamic', False)
 
         # map argument names to values
         outputs, inputs, params = self._get_base_names()
         argtypes = {name:arg.dtype for name, arg in zip(outputs + inputs + params, args)}
 
-        return dict(size=args[0].size, argtypes=argtypes, code=code)
+        return dict(size=None if dynamic else args[0].size, argtypes=argtypes, code=code,
+            items_per_thread_override=items_per_thread_override, dynamic=dynamic)
 
     def _construct_operations(self, basis, device_params):
 
         operations = self._get_operation_recorder()
+        if basis.dynamic:
+            return self._construct_dynamic_operations(operations, basis, device_params)
+
         names = sum(self._get_base_names(), tuple())
         name_str = ", ".join(names)
 
+        ipto = basis.items_per_thread_override
+        items_per_thread = find_items_per_thread(device_params, basis.size) \
+            if ipto is None else ipto
+        threads = min_blocks(basis.size, items_per_thread)
+
+        # Work item number ``tid`` processes elements ``tid + i * threads``.
+        # This way successive work items access successive elements,
+        # which results in coalesced memory access on GPUs and
+        # helps the implicit vectorization across work items on CPUs.
+        # Only the iterations which can go past the end of the array need a bounds check.
         template = template_from(
             template_defs_for_code(basis.code, names) +
             """
@@ -71,17 +104,100 @@ class Elementwise(Computation):
             ${code_functions(""" + name_str + """)}
             ${kernel_definition}
             {
+                VIRTUAL_GROUP_LOOP_BEGIN
                 VIRTUAL_SKIP_THREADS;
-                int idx = virtual_global_flat_id();
-                ${code_kernel(""" + name_str + """)}
+                int tid = virtual_global_flat_id();
+                %for i in range(items_per_thread):
+                {
+                    int idx = tid + ${i * threads};
+                    %if (i + 1) * threads > size:
+                    if (idx < ${size})
+                    %endif
+                    {
+                        ${code_kernel(""" + name_str + """)}
+                    }
+                }
+                %endfor
+                VIRTUAL_GROUP_LOOP_END
             }
             </%def>
             """)
 
+        # Persistent mode lets huge arrays be processed without launching
+        # millions of workgroups and rearranging the grid to fit device limits.
         operations.add_kernel(template, 'elementwise', names,
-            global_size=(basis.size,), render_kwds=dict(size=basis.size))
+            global_size=(threads,),
+            render_kwds=dict(size=basis.size, items_per_thread=items_per_thread,
+                threads=threads),
+            persistent=True)
         return operations
 
+    def _construct_dynamic_operations(self, operations, basis, device_params):
+        names = sum(self._get_base_names(), tuple())
+        name_str = ", ".join(names)
+
+        leaf_arrays = [(name, value) for name, value in self.leaf_signature() if value.is_array]
+        for name, value in leaf_arrays:
+            if value.strides is not None:
+                raise ValueError("Non-contiguous arrays are not supported in the dynamic mode")
+
+        # All the leaf arrays have the same size, so any of them can be used
+        size_source = leaf_arrays[0][0]
+        size = operations.add_dynamic_scalar(numpy.int32, ArraySize(size_source))
+
+        threads = dynamic_threads(device_params)
+        template = template_from(
+            template_defs_for_code(basis.code, names) +
+            """
+            <%def name='elementwise(""" + name_str  + """, dynamic_size)'>
+            ${code_functions(""" + name_str + """)}
+            ${kernel_definition}
+            {
+                VIRTUAL_GROUP_LOOP_BEGIN
+                VIRTUAL_SKIP_THREADS;
+                for (int idx = virtual_global_flat_id(); idx < ${dynamic_size}; idx += ${threads})
+                {
+                    ${code_kernel(""" + name_str + """)}
+                }
+                VIRTUAL_GROUP_LOOP_END
+            }
+            </%def>
+            """)
+
+        operations.add_kernel(template, 'elementwise', names + (size,),
+            global_size=(threads,),
+            render_kwds=dict(threads=threads),
+            persistent=True)
+        return operations
+
+
+# Maximum number of elements processed by a single work item.
+MAX_ITEMS_PER_THREAD = 8
+
+
+def find_items_per_thread(device_params, size):
+    """
+    Returns the number of elements a single work item of an elementwise kernel
+    should process for the array of ``size`` elements.
+    Processing several elements per work item amortizes the index calculations
+    and kernel prologue, but we still want to have enough work items to keep all
+    the compute units of the device busy.
+    """
+    min_threads = device_params.compute_units * device_params.max_work_group_size * 4
+    items_per_thread = 1
+    while items_per_thread < MAX_ITEMS_PER_THREAD and \
+            size // (items_per_thread * 2) >= min_threads:
+        items_per_thread *= 2
+    return items_per_thread
+
+
+def dynamic_threads(device_params):
+    """
+    Returns the number of work items for an elementwise kernel in the dynamic mode,
+    which is enough to keep all the compute units of the device busy.
+    """
+    return device_params.compute_units * device_params.max_work_group_size * 4
+
 
 def specialize_elementwise(outputs, inputs, scalars, code):
     """
@@ -91,6 +207,9 @@ def specialize_elementwise(outputs, inputs, scalars, code):
     :param inputs: a string or a list of strings with input argument names.
     :param scalars: ``None``, a string, or a list of strings with scalar argument names.
     :param code: ``dict(kernel, functions)`` with kernel code.
+
+    The other keywords of :py:meth:`Elementwise.prepare_for` (for example, ``dynamic``)
+    can be passed to ``prepare_for()`` of the returned class.
     """
 
     outputs = wrap_in_tuple(outputs)
@@ -104,10 +223,11 @@ def specialize_elementwise(outputs, inputs, scalars, code):
         def _get_argnames(self):
             return outputs, inputs, scalars
 
-        def _get_basis_for(self, *args):
+        def _get_basis_for(self, *args, **kwds):
             if len(args) != len(argnames):
                 raise TypeError("The computation takes exactly " +
-                    str(len(argnames)) + "arguments")
-            return Elementwise._get_basis_for(self, *args, code=code)
+                    str(len(argnames)) + " arguments")
+            kwds['code'] = code
+            return Elementwise._get_basis_for(self, *args, **kwds)
 
     return SpecializedElementwise
@@ -485,7 +485,7 @@ class FFT(Computation):
         if axes is None:
             axes = tuple(range(len(output.shape)))
         else:
-            axes = tuple(axes)
+            axes = tuple(axis if axis >= 0 else len(output.shape) + axis for axis in axes)
 
         bs.axes = axes
         bs.shape = output.shape
@@ -493,6 +493,9 @@ class FFT(Computation):
 
         return bs
 
+    def _is_batch_independent(self, basis):
+        return 0 not in basis.axes
+
     def _get_argvalues(self, basis):
         return dict(
             output=ArrayValue(basis.shape, basis.dtype),
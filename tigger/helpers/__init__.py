@@ -4,10 +4,12 @@ This module contains various auxiliary functions which are used throughout the l
 
 from __future__ import division
 
+import contextlib
 import functools
 import collections
 import os.path
-from mako.template import Template
+import threading
+import time
 
 
 class AttrDict(dict):
@@ -44,11 +46,36 @@ def template_source_for(filename):
     return open(name + ".mako").read()
 
 
+#: Maximum number of templates kept by :py:func:`template_from`.
+TEMPLATE_CACHE_SIZE = 256
+
+_template_cache = collections.OrderedDict()
+_template_cache_lock = threading.Lock()
+
+
 def template_from(template_str):
     """
     Creates a Mako template object from a given string.
+    Template objects are cached (up to :py:data:`TEMPLATE_CACHE_SIZE` least recently used ones),
+    so the same source is parsed and compiled by Mako only once.
     """
-    return Template(template_str)
+    with _template_cache_lock:
+        template = _template_cache.pop(template_str, None)
+        if template is not None:
+            # move to the end of the LRU queue
+            _template_cache[template_str] = template
+            return template
+
+    # Mako is imported on first use to speed up the import of the library
+    from mako.template import Template
+    template = Template(template_str)
+
+    with _template_cache_lock:
+        _template_cache[template_str] = template
+        while len(_template_cache) > TEMPLATE_CACHE_SIZE:
+            _template_cache.popitem(last=False)
+
+    return template
 
 
 def template_defs_for_code(code, argnames):
@@ -66,13 +93,44 @@ def template_defs_for_code(code, argnames):
         "\n</%def>")
 
 
+class LazyTemplate:
+    """
+    A proxy for the Mako template object created from the file
+    which has the same name as ``filename`` and the extension ``.mako``.
+    The template is loaded and compiled on the first access to any of its attributes.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._template = None
+
+    def _load(self):
+        name, ext = os.path.splitext(self._filename)
+        module_directory = os.environ.get('TIGGER_MAKO_MODULE_DIR')
+        if module_directory is None:
+            return template_from(template_source_for(self._filename))
+        else:
+            from mako.template import Template
+            return Template(filename=name + ".mako", module_directory=module_directory)
+
+    def __getattr__(self, name):
+        if self._template is None:
+            self._template = self._load()
+        return getattr(self._template, name)
+
+
 def template_for(filename):
     """
     Returns the Mako template object created from the file
     which has the same name as ``filename`` and the extension ``.mako``.
     Typically used in computation modules as ``template_for(__filename__)``.
+    The template is loaded lazily (see :py:class:`LazyTemplate`),
+    so this function can be called on module import without any overhead.
+    If the environment variable ``TIGGER_MAKO_MODULE_DIR`` is set,
+    Mako saves compiled template modules to this directory
+    and reuses them until the template file changes.
     """
-    return template_from(template_source_for(filename))
+    return LazyTemplate(filename)
 
 
 def min_blocks(length, block):
@@ -138,3 +196,60 @@ def wrap_in_tuple(x):
         return tuple(x)
     else:
         return (x,)
+
+
+_phase_timings = threading.local()
+
+
+def _timings_stack():
+    if not hasattr(_phase_timings, 'stack'):
+        _phase_timings.stack = []
+    return _phase_timings.stack
+
+
+@contextlib.contextmanager
+def collect_phase_timings():
+    """
+    Context manager which collects the time spent in phases marked with
+    :py:func:`timed_phase` in the current thread.
+    Returns a dictionary ``{phase_name: seconds}``, which is filled while the context is active.
+    Collectors can be nested, in which case the time is added to all of them.
+    """
+    timings = {}
+    stack = _timings_stack()
+    stack.append(timings)
+    try:
+        yield timings
+    finally:
+        stack.pop()
+
+
+def add_phase_timings(timings):
+    """
+    Adds the times from the dictionary ``{phase_name: seconds}``
+    (collected, for example, in another thread)
+    to all the active :py:func:`collect_phase_timings` collectors.
+    """
+    for collector in _timings_stack():
+        for name, elapsed in timings.items():
+            collector[name] = collector.get(name, 0) + elapsed
+
+
+@contextlib.contextmanager
+def timed_phase(name):
+    """
+    Context manager which adds the time spent inside it to the phase ``name``
+    of all the active :py:func:`collect_phase_timings` collectors.
+    """
+    stack = _timings_stack()
+    if len(stack) == 0:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        for timings in stack:
+            timings[name] = timings.get(name, 0) + elapsed
@@ -63,6 +63,9 @@ class Reduce(Computation):
 
         return bs
 
+    def _is_batch_independent(self, basis):
+        return basis.axis != 0
+
     def _construct_operations(self, basis, device_params):
 
         operations = self._get_operation_recorder()
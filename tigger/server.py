@@ -0,0 +1,448 @@
+"""
+Plan server for worker processes sharing one device.
+
+A single process (the server) owns the context and the prepared computations,
+and worker processes call these computations through a Unix socket.
+For every worker the server creates a memory-mapped file (in ``/dev/shm``, if available),
+which is used to pass array data, so only short messages go through the socket.
+The files can only be opened by the user running the server,
+so the workers must be run by the same user.
+Messages are pickled, so the server and the workers must share an authentication key.
+Computations are prepared by the server on demand for the shapes and types
+of the arguments they are called with (see :py:class:`~tigger.core.dispatcher.Dispatcher`).
+
+If a computation is registered with ``batch=True``, requests for it
+which arrive from different workers at the same time are joined into a single call,
+with arrays concatenated along their first dimension.
+The joined arrays are padded with zeros to a power of 2 length,
+so that only a few computations have to be prepared for different combinations of requests.
+This is only correct if the computation processes every element of the first dimension
+independently (as, for example, a batched FFT over other axes does),
+so the requests are not joined if the prepared computation reports otherwise
+(see :py:meth:`~tigger.core.Computation._is_batch_independent`).
+
+Server::
+
+    server = PlanServer(ctx, '/tmp/tigger.sock', authkey=b'secret')
+    server.register('fft', FFT, prepare_kwds=dict(axes=(1,)), batch=True)
+    server.serve_forever()
+
+Worker::
+
+    client = PlanClient('/tmp/tigger.sock', authkey=b'secret')
+    client.call('fft', output, input, numpy.int32(-1))
+"""
+
+import mmap
+import os
+import os.path
+import tempfile
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy
+
+from tigger.core.dispatcher import Dispatcher
+from tigger.core.transformation import NODE_OUTPUT
+
+
+# Arrays are placed in the shared memory at offsets which are multiples of this value
+ALIGNMENT = 64
+
+
+def _aligned(size):
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _shm_dir():
+    # Files in /dev/shm are never written to the disk
+    return '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def _is_array(arg):
+    return hasattr(arg, 'shape') and len(arg.shape) > 0
+
+
+def _padded_length(length):
+    padded = 1
+    while padded < length:
+        padded *= 2
+    return padded
+
+
+def _joined(arrays):
+    # Concatenates arrays along the first dimension, padding the result with zeros
+    length = sum(arr.shape[0] for arr in arrays)
+    joined = numpy.zeros((_padded_length(length),) + arrays[0].shape[1:], arrays[0].dtype)
+    start = 0
+    for arr in arrays:
+        joined[start:start + arr.shape[0]] = arr
+        start += arr.shape[0]
+    return joined
+
+
+def _check_connection_params(address, authkey):
+    if not authkey:
+        raise ValueError("An authentication key is required")
+    if isinstance(address, tuple):
+        raise ValueError("Only Unix socket addresses (file names) are supported")
+
+
+def _output_indices(computation):
+    nodes = computation._tr_tree.nodes
+    return [i for i, pair in enumerate(computation.leaf_signature())
+        if pair[0] in nodes and nodes[pair[0]].type == NODE_OUTPUT]
+
+
+def _resize_file(path, size):
+    with open(path, 'r+b') as f:
+        f.truncate(size)
+
+
+class _SharedMemory:
+
+    def __init__(self, path, size):
+        self.path = path
+        self.remap(size)
+
+    @classmethod
+    def create(cls, size):
+        # The file is only accessible by its owner
+        fd, path = tempfile.mkstemp(prefix='tigger-', dir=_shm_dir())
+        os.close(fd)
+        _resize_file(path, size)
+        return cls(path, size)
+
+    def resize(self, size):
+        _resize_file(self.path, size)
+        self.remap(size)
+
+    def remove(self):
+        os.remove(self.path)
+
+    def remap(self, size):
+        # The previous mapping is closed automatically
+        # when the arrays created from it are not used anymore.
+        with open(self.path, 'r+b') as f:
+            self.mmap = mmap.mmap(f.fileno(), size)
+        self.size = size
+
+    def array(self, offset, shape, dtype):
+        dtype = numpy.dtype(dtype)
+        count = int(numpy.prod(shape)) if len(shape) > 0 else 1
+        return numpy.frombuffer(self.mmap, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+
+class _Plan:
+
+    def __init__(self, dispatcher, batch):
+        self.dispatcher = dispatcher
+        self.batch = batch
+
+        # Known after the computation is prepared for the first time
+        self.batch_independent = None
+
+
+class _Request:
+
+    def __init__(self, connection, shm, name, descriptors):
+        self.connection = connection
+        self.name = name
+        self.descriptors = descriptors
+        self.args = []
+        for descriptor in descriptors:
+            if descriptor[0] == 'array':
+                _, offset, shape, dtype = descriptor
+                self.args.append(shm.array(offset, shape, dtype))
+            else:
+                self.args.append(descriptor[1])
+
+    def batch_key(self):
+        """
+        Requests with equal keys can be joined into one call.
+        """
+        key = [self.name]
+        for descriptor in self.descriptors:
+            if descriptor[0] == 'array':
+                _, _, shape, dtype = descriptor
+                key.append((tuple(shape[1:]), dtype))
+            else:
+                key.append(descriptor[1])
+        return tuple(key)
+
+
+class PlanServer:
+    """
+    Owns the context and the prepared computations, and executes requests from workers.
+
+    :param ctx: a :py:class:`~tigger.cluda.api.Context` object.
+    :param address: a file name for the Unix socket to listen on
+        (network addresses are not supported, since the workers
+        have to access the shared memory files).
+    :param authkey: authentication key (a byte string) the workers must use.
+    :param max_batch: maximum number of requests joined into a single call.
+    :param max_plans: maximum number of prepared computations kept for every registered name.
+    """
+
+    def __init__(self, ctx, address, authkey, max_batch=16, max_plans=16):
+        _check_connection_params(address, authkey)
+        self._ctx = ctx
+        self._listener = Listener(address, family='AF_UNIX', authkey=authkey)
+        self.address = self._listener.address
+        self._max_batch = max_batch
+        self._max_plans = max_plans
+        self._plans = {}
+        self._requests = queue.Queue()
+        self._stopped = False
+
+        self.batched_calls = 0
+        self.requests = 0
+
+    def register(self, name, create, prepare_kwds=None, batch=False):
+        """
+        Makes a computation available to workers under ``name``.
+
+        :param create: a function taking a context and returning a computation
+            with all the necessary transformations connected (for example, a computation class).
+        :param prepare_kwds: keyword arguments for :py:meth:`~tigger.core.Computation.prepare_for`.
+        :param batch: whether requests can be joined along the first dimension of arrays
+            (they are still executed separately if the computation is not batch-independent).
+        """
+        dispatcher = Dispatcher(self._ctx, create,
+            max_plans=self._max_plans, prepare_kwds=prepare_kwds)
+        self._plans[name] = _Plan(dispatcher, batch)
+
+    def statistics(self):
+        """
+        Returns a dictionary with the number of ``requests`` executed,
+        the number of ``batched_calls`` (calls executing several requests at once),
+        and the statistics of the computation caches for every registered name
+        (see :py:meth:`~tigger.core.dispatcher.Dispatcher.statistics`).
+        """
+        return dict(requests=self.requests, batched_calls=self.batched_calls,
+            plans={name: plan.dispatcher.statistics() for name, plan in self._plans.items()})
+
+    def _accept(self):
+        while not self._stopped:
+            try:
+                connection = self._listener.accept()
+            except (IOError, OSError, EOFError, AuthenticationError):
+                # either the listener was closed, or the connection
+                # was broken or failed the authentication
+                continue
+            thread = threading.Thread(target=self._receive, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def _receive(self, connection):
+        shm = None
+        try:
+            _, size = connection.recv()
+            shm = _SharedMemory.create(int(size))
+            connection.send(('attached', shm.path))
+            while True:
+                message = connection.recv()
+                if message[0] == 'call':
+                    _, name, descriptors = message
+                    self._requests.put(_Request(connection, shm, name, descriptors))
+                elif message[0] == 'resize':
+                    shm.resize(int(message[1]))
+                    connection.send(('ok',))
+                elif message[0] == 'close':
+                    break
+        except (IOError, OSError, EOFError):
+            # the worker has disconnected
+            pass
+        finally:
+            connection.close()
+            # Arrays created from the mapping stay valid after the file is removed
+            if shm is not None:
+                shm.remove()
+
+    def _execute(self, requests):
+        plan = self._plans[requests[0].name]
+        ctx = self._ctx
+
+        if len(requests) == 1:
+            args = requests[0].args
+        else:
+            args = [_joined([request.args[i] for request in requests])
+                if _is_array(arg) else arg
+                for i, arg in enumerate(requests[0].args)]
+            self.batched_calls += 1
+
+        computation = plan.dispatcher.plan_for(*args)
+        outputs = _output_indices(computation)
+
+        device_args = []
+        for i, arg in enumerate(args):
+            if not _is_array(arg):
+                device_args.append(arg)
+            elif i in outputs:
+                device_args.append(ctx.allocate(arg.shape, arg.dtype))
+            else:
+                device_args.append(ctx.to_device(numpy.ascontiguousarray(arg)))
+
+        computation(*device_args)
+
+        for i in outputs:
+            ctx.from_device(device_args[i], dest=args[i])
+            if len(requests) > 1:
+                start = 0
+                for request in requests:
+                    length = request.args[i].shape[0]
+                    request.args[i][...] = args[i][start:start + length]
+                    start += length
+
+        self.requests += len(requests)
+        return outputs
+
+    def _can_join(self, plan, request):
+        if not plan.batch:
+            return False
+
+        if plan.batch_independent is None:
+            try:
+                computation = plan.dispatcher.plan_for(*request.args)
+            except Exception:
+                # The error will be reported when the request is executed
+                return False
+            plan.batch_independent = computation._is_batch_independent(computation._basis)
+
+        return plan.batch_independent
+
+    def _group(self, requests):
+        groups = []
+        batched = {}
+        for request in requests:
+            plan = self._plans.get(request.name)
+            if plan is None or not self._can_join(plan, request):
+                groups.append([request])
+                continue
+
+            key = request.batch_key()
+            if key not in batched:
+                batched[key] = []
+                groups.append(batched[key])
+            batched[key].append(request)
+
+        return groups
+
+    def serve_forever(self):
+        """
+        Executes requests until :py:meth:`stop` is called.
+        All the device operations happen in the thread calling this method.
+        """
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+        while True:
+            request = self._requests.get()
+            if request is None:
+                break
+
+            # Requests which arrived at the same time are candidates for joining
+            requests = [request]
+            while len(requests) < self._max_batch:
+                try:
+                    request = self._requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._requests.put(None)
+                    break
+                requests.append(request)
+
+            for group in self._group(requests):
+                try:
+                    if group[0].name not in self._plans:
+                        raise KeyError("Unknown computation: " + group[0].name)
+                    reply = ('ok', self._execute(group))
+                except Exception as e:
+                    reply = ('error', repr(e))
+                for request in group:
+                    try:
+                        request.connection.send(reply)
+                    except (IOError, OSError, EOFError):
+                        # The worker has disconnected; this also stops its receiving thread
+                        request.connection.close()
+
+    def stop(self):
+        """
+        Makes :py:meth:`serve_forever` return after the current requests are executed.
+        """
+        self._stopped = True
+        self._listener.close()
+        self._requests.put(None)
+
+
+class PlanClient:
+    """
+    Calls computations registered in a :py:class:`PlanServer`.
+
+    :param address: the address of the server.
+    :param authkey: the authentication key of the server.
+    :param size: initial size of the shared memory (in bytes);
+        it is increased automatically if necessary.
+    """
+
+    def __init__(self, address, authkey, size=2 ** 20):
+        _check_connection_params(address, authkey)
+        self._connection = Client(address, family='AF_UNIX', authkey=authkey)
+        self._connection.send(('attach', size))
+        _, path = self._connection.recv()
+        self._shm = _SharedMemory(path, size)
+
+    def _reserve(self, size):
+        if size <= self._shm.size:
+            return
+        size = max(size, self._shm.size * 2)
+        # The server resizes the file before replying
+        self._connection.send(('resize', size))
+        self._connection.recv()
+        self._shm.remap(size)
+
+    def call(self, name, *args):
+        """
+        Executes the computation registered as ``name`` with given arguments
+        (host arrays and scalars in the order of the computation signature).
+        The results are written to the output arrays.
+        """
+        args = [numpy.asarray(arg) if _is_array(arg) else arg for arg in args]
+        self._reserve(sum(_aligned(arg.nbytes) for arg in args if _is_array(arg)))
+
+        offset = 0
+        descriptors = []
+        views = []
+        for arg in args:
+            if _is_array(arg):
+                view = self._shm.array(offset, arg.shape, arg.dtype)
+                view[...] = arg
+                views.append(view)
+                descriptors.append(('array', offset, arg.shape, arg.dtype.str))
+                offset += _aligned(arg.nbytes)
+            else:
+                views.append(None)
+                descriptors.append(('scalar', arg))
+
+        self._connection.send(('call', name, descriptors))
+        reply = self._connection.recv()
+        if reply[0] == 'error':
+            raise RuntimeError("Plan server error: " + reply[1])
+
+        for i in reply[1]:
+            args[i][...] = views[i]
+
+    def close(self):
+        """
+        Disconnects from the server (which removes the shared memory file).
+        """
+        self._connection.send(('close',))
+        self._connection.close()
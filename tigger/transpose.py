@@ -103,6 +103,9 @@ class Transpose(Computation):
 
         return bs
 
+    def _is_batch_independent(self, basis):
+        return basis.axes[0] == 0
+
     def _get_argvalues(self, basis):
 
         output_shape = transpose_shape(basis.input_shape, basis.axes)